@@ -1,11 +1,18 @@
 import attr
 import asyncio
+import logging
 from functools import wraps
 
-from . import ChainedIntent, TypeDispatcher, Effect
+from . import ChainedIntent, ParallelIntent, BackgroundIntent, TypeDispatcher, Effect
 from .intents import Delay
 
 
+logger = logging.getLogger(__name__)
+# The event loop only keeps weak references to the tasks, background ones are
+# kept here until done so they can't be garbage collected mid-flight
+_background_tasks = set()
+
+
 def async_do(f):
     assert asyncio.iscoroutinefunction(f)
 
@@ -63,6 +70,12 @@ async def asyncio_perform(dispatcher, effect):
                     sub_effect = intent.generator.send(ret)
         except StopIteration as exc:
             return exc.value
+    elif isinstance(intent, ParallelIntent):
+        return await _perform_parallel(dispatcher, intent)
+    elif isinstance(intent, BackgroundIntent):
+        task = asyncio.ensure_future(asyncio_perform(dispatcher, intent.effect))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_task_done)
     else:
         performer = dispatcher(intent)
         ret = performer(intent)
@@ -74,3 +87,36 @@ async def asyncio_perform(dispatcher, effect):
             return await ret.coroutine
         else:
             return ret
+
+
+def _background_task_done(task):
+    _background_tasks.discard(task)
+    # Nobody awaits background effects, their errors would go unnoticed otherwise
+    if not task.cancelled() and task.exception() is not None:
+        logger.error('Background effect failed.', exc_info=task.exception())
+
+
+async def _perform_parallel(dispatcher, intent):
+    if intent.limit:
+        # Pool of `limit` workers pulling from the effects, so they are only
+        # created once a worker is free to perform them
+        effects = intent.effects
+        workers_count = intent.limit
+    else:
+        effects = list(intent.effects)
+        workers_count = len(effects)
+    effects = enumerate(effects)
+    results = {}
+
+    async def worker():
+        for index, sub_effect in effects:
+            results[index] = await asyncio_perform(dispatcher, sub_effect)
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(workers_count)]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        # Don't leave the other effects running if one of them failed
+        for task in workers:
+            task.cancel()
+    return [results[index] for index in range(len(results))]
@@ -13,11 +13,44 @@ class ChainedIntent:
     generator = attr.ib()
 
 
+@attr.s
+class ParallelIntent:
+    """
+    Perform several effects concurrently (at most `limit` at a time if provided)
+    and result in the list of their results, in the order of `effects`.
+
+    `effects` can be any iterable, with a `limit` it is consumed lazily so
+    the effects can be generated as they get performed.
+
+    Synchronous performing runs them one after another.
+    """
+    effects = attr.ib()
+    limit = attr.ib(default=None)
+
+
+@attr.s
+class BackgroundIntent:
+    """
+    Start performing `effect` without waiting for it, results in None.
+
+    Synchronous performing runs it right away.
+    """
+    effect = attr.ib()
+
+
 @attr.s
 class Effect:
     intent = attr.ib()
 
 
+def parallel(effects, limit=None):
+    return Effect(ParallelIntent(effects, limit))
+
+
+def background(effect):
+    return Effect(BackgroundIntent(effect))
+
+
 def do(f):
 
     @wraps(f)
@@ -1,6 +1,6 @@
 import time
 
-from . import ChainedIntent, TypeDispatcher, Effect
+from . import ChainedIntent, ParallelIntent, BackgroundIntent, TypeDispatcher, Effect
 from .intents import Delay
 
 
@@ -26,6 +26,10 @@ def sync_perform(dispatcher, effect):
                     sub_effect = intent.generator.send(ret)
         except StopIteration as exc:
             return exc.value
+    elif isinstance(intent, ParallelIntent):
+        return [sync_perform(dispatcher, sub_effect) for sub_effect in intent.effects]
+    elif isinstance(intent, BackgroundIntent):
+        sync_perform(dispatcher, intent.effect)
     else:
         performer = dispatcher(intent)
         ret = performer(intent)
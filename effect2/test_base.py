@@ -2,7 +2,10 @@ import attr
 import asyncio
 import pytest
 
-from . import Effect, asyncio_perform, sync_perform, TypeDispatcher, ChainedIntent, do
+from . import (
+    Effect, asyncio_perform, sync_perform, TypeDispatcher, ChainedIntent, do, parallel,
+    background)
+from .asyncio import _background_tasks
 from .testing import conste
 
 
@@ -139,6 +142,36 @@ class TestSynPerform:
         ret = sync_perform(dispatcher, effect)
         assert ret == 'bar'
 
+    def test_parallel(self):
+        @attr.s
+        class ENumToString:
+            num = attr.ib()
+
+        @do
+        def double(i):
+            res = yield Effect(ENumToString(i))
+            return res * 2
+
+        dispatcher = TypeDispatcher({
+            ENumToString: lambda intent: str(intent.num)
+        })
+        ret = sync_perform(dispatcher, parallel([double(i) for i in range(3)], limit=2))
+        assert ret == ['00', '11', '22']
+        assert sync_perform(dispatcher, parallel([])) == []
+
+    def test_background(self):
+        @attr.s
+        class EDoSomething:
+            arg = attr.ib()
+
+        done = []
+        dispatcher = TypeDispatcher({
+            EDoSomething: lambda intent: done.append(intent.arg)
+        })
+        ret = sync_perform(dispatcher, background(Effect(EDoSomething('foo'))))
+        assert ret is None
+        assert done == ['foo']
+
 
 class TestAsynIOPerform:
 
@@ -294,3 +327,121 @@ class TestAsynIOPerform:
         effect = Effect(EDoA())
         ret = await asyncio_perform(dispatcher, effect)
         assert ret == 'bar'
+
+    @pytest.mark.asyncio
+    async def test_parallel(self):
+        @attr.s
+        class EWait:
+            num = attr.ib()
+
+        running = []
+        max_running = []
+
+        async def performer(intent):
+            running.append(intent.num)
+            max_running.append(len(running))
+            # Last effects finish first
+            await asyncio.sleep(0.01 * (5 - intent.num))
+            running.remove(intent.num)
+            return intent.num
+
+        dispatcher = TypeDispatcher({
+            EWait: performer
+        })
+        effect = parallel([Effect(EWait(i)) for i in range(5)], limit=3)
+        ret = await asyncio_perform(dispatcher, effect)
+        # Results keep the order of the effects
+        assert ret == [0, 1, 2, 3, 4]
+        assert max(max_running) == 3
+
+    @pytest.mark.asyncio
+    async def test_parallel_lazy(self):
+        @attr.s
+        class EWait:
+            num = attr.ib()
+
+        created = []
+        max_pending = []
+
+        async def performer(intent):
+            # Effects are only created once a worker is free
+            max_pending.append(len(created) - intent.num)
+            await asyncio.sleep(0.01)
+            return intent.num
+
+        def effects():
+            for i in range(10):
+                created.append(i)
+                yield Effect(EWait(i))
+
+        dispatcher = TypeDispatcher({
+            EWait: performer
+        })
+        ret = await asyncio_perform(dispatcher, parallel(effects(), limit=2))
+        assert ret == list(range(10))
+        assert max(max_pending) <= 2
+
+    @pytest.mark.asyncio
+    async def test_parallel_error(self):
+        @attr.s
+        class EWait:
+            num = attr.ib()
+
+        done = []
+
+        async def performer(intent):
+            if intent.num == 0:
+                raise RuntimeError()
+            await asyncio.sleep(0.01)
+            done.append(intent.num)
+
+        dispatcher = TypeDispatcher({
+            EWait: performer
+        })
+        effect = parallel([Effect(EWait(i)) for i in range(3)])
+        with pytest.raises(RuntimeError):
+            await asyncio_perform(dispatcher, effect)
+        await asyncio.sleep(0.02)
+        # Remaining effects have been cancelled
+        assert done == []
+
+    @pytest.mark.asyncio
+    async def test_background(self):
+        @attr.s
+        class EWait:
+            pass
+
+        done = []
+
+        async def performer(intent):
+            await asyncio.sleep(0.01)
+            done.append(True)
+
+        dispatcher = TypeDispatcher({
+            EWait: performer
+        })
+        ret = await asyncio_perform(dispatcher, background(Effect(EWait())))
+        assert ret is None
+        assert done == []
+        await asyncio.sleep(0.02)
+        assert done == [True]
+
+    @pytest.mark.asyncio
+    async def test_background_error(self, caplog):
+        @attr.s
+        class EFail:
+            pass
+
+        async def performer(intent):
+            await asyncio.sleep(0.01)
+            raise RuntimeError('boom')
+
+        dispatcher = TypeDispatcher({
+            EFail: performer
+        })
+        await asyncio_perform(dispatcher, background(Effect(EFail())))
+        # Task is kept alive while running
+        assert len(_background_tasks) == 1
+        await asyncio.sleep(0.02)
+        assert not _background_tasks
+        assert 'Background effect failed.' in caplog.text
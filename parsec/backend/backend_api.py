@@ -78,6 +78,7 @@ API_CMDS_ROUTER = {
     'vlob_create': vlob.api_vlob_create,
     'vlob_read': vlob.api_vlob_read,
     'vlob_update': vlob.api_vlob_update,
+    'vlob_head': vlob.api_vlob_head,
 
     'user_vlob_read': user_vlob.api_user_vlob_read,
     'user_vlob_update': user_vlob.api_user_vlob_update,
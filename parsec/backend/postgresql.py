@@ -13,7 +13,7 @@ from parsec.base import EEvent
 from parsec.crypto import load_public_key
 from parsec.tools import ejson_dumps, ejson_loads
 from parsec.backend.message import EMessageNew, EMessageGet
-from parsec.backend.vlob import EVlobCreate, EVlobUpdate, EVlobRead, VlobAtom
+from parsec.backend.vlob import EVlobCreate, EVlobUpdate, EVlobRead, EVlobHead, VlobAtom, VlobHead
 from parsec.backend.user_vlob import EUserVlobUpdate, EUserVlobRead, UserVlobAtom
 from parsec.backend.group import (
     EGroupCreate, EGroupRead, EGroupAddIdentities, EGroupRemoveIdentities, Group
@@ -246,11 +246,26 @@ class PostgreSQLVlobComponent:
                     (intent.id, intent.version, rts, wts, intent.blob))
                 await cur.execute("NOTIFY vlob_updated, %s", (intent.id, ))
 
+    @async_do
+    async def perform_vlob_head(self, intent):
+        if not intent.vlobs:
+            return {}
+        async with self.connection.acquire() as conn:
+            async with conn.cursor() as cur:
+                # Last version of each vlob, walking the (id, version) primary key
+                await cur.execute("SELECT DISTINCT ON (id) id::text, version, read_trust_seed, "
+                                  "octet_length(blob) FROM vlobs WHERE id = ANY(%s) "
+                                  "ORDER BY id, version DESC;", (list(intent.vlobs), ))
+                rows = await cur.fetchall()
+        return {id: VlobHead(id=id, version=version, size=size or 0)
+                for id, version, rts, size in rows if rts == intent.vlobs[id]}
+
     def get_dispatcher(self):
         return TypeDispatcher({
             EVlobRead: self.perform_vlob_read,
             EVlobCreate: self.perform_vlob_create,
-            EVlobUpdate: self.perform_vlob_update
+            EVlobUpdate: self.perform_vlob_update,
+            EVlobHead: self.perform_vlob_head
         })
 
 
@@ -28,6 +28,13 @@ class VlobAtom:
     version = attr.ib(default=1)
 
 
+@attr.s
+class VlobHead:
+    id = attr.ib()
+    version = attr.ib()
+    size = attr.ib()
+
+
 @attr.s
 class EVlobCreate:
     id = attr.ib(default=None)
@@ -49,6 +56,12 @@ class EVlobUpdate:
     blob = attr.ib()
 
 
+@attr.s
+class EVlobHead:
+    # Read trust seeds indexed by vlob id
+    vlobs = attr.ib()
+
+
 class cmd_CREATE_Schema(UnknownCheckedSchema):
     id = fields.String(missing=None, validate=lambda n: 0 < len(n) <= 32)
     blob = fields.Base64Bytes(missing=to_jsonb64(b''))
@@ -67,6 +80,15 @@ class cmd_UPDATE_Schema(UnknownCheckedSchema):
     blob = fields.Base64Bytes(required=True)
 
 
+def _validate_head_vlobs(vlobs):
+    return all(isinstance(id, str) and isinstance(trust_seed, str)
+               for id, trust_seed in vlobs.items())
+
+
+class cmd_HEAD_Schema(UnknownCheckedSchema):
+    vlobs = fields.Dict(required=True, validate=_validate_head_vlobs)
+
+
 @do
 def api_vlob_create(msg):
     msg = cmd_CREATE_Schema().load(msg)
@@ -98,6 +120,17 @@ def api_vlob_update(msg):
     return {'status': 'ok'}
 
 
+@do
+def api_vlob_head(msg):
+    msg = cmd_HEAD_Schema().load(msg)
+    heads = yield Effect(EVlobHead(**msg))
+    return {
+        'status': 'ok',
+        'vlobs': {id: {'version': head.version, 'size': head.size}
+                  for id, head in heads.items()}
+    }
+
+
 class MockedVlob:
     def __init__(self, *args, **kwargs):
         atom = VlobAtom(*args, **kwargs)
@@ -155,9 +188,22 @@ class MockedVlobComponent:
             raise VlobNotFound('Wrong blob version.')
         yield Effect(EEvent('vlob_updated', intent.id))
 
+    @do
+    def perform_vlob_head(self, intent):
+        # Vlobs not found or not readable with the given trust seed are left out
+        heads = {}
+        for id, trust_seed in intent.vlobs.items():
+            vlob = self.vlobs.get(id)
+            if vlob and vlob.read_trust_seed == trust_seed:
+                heads[id] = VlobHead(id=id,
+                                     version=len(vlob.blob_versions),
+                                     size=len(vlob.blob_versions[-1]))
+        return heads
+
     def get_dispatcher(self):
         return TypeDispatcher({
             EVlobCreate: self.perform_vlob_create,
             EVlobRead: self.perform_vlob_read,
             EVlobUpdate: self.perform_vlob_update,
+            EVlobHead: self.perform_vlob_head,
         })
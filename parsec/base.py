@@ -33,7 +33,8 @@ class EventComponent:
     @do
     def perform_trigger_event(self, intent):
         key = (intent.event, intent.sender)
-        for intent_factory in self.listeners[key]:
+        # Listeners are allowed to unregister themselves
+        for intent_factory in list(self.listeners.get(key, ())):
             yield Effect(intent_factory(intent.event, intent.sender))
 
     @do
@@ -45,6 +46,8 @@ class EventComponent:
     def perform_unregister_event(self, intent):
         key = (intent.event, intent.sender)
         self.listeners[key].remove(intent.intent_factory)
+        if not self.listeners[key]:
+            del self.listeners[key]
 
     def get_dispatcher(self):
         return TypeDispatcher({
@@ -19,7 +19,7 @@ from parsec.core import (
     components_factory as core_components_factory,
     register_core_api
 )
-from parsec.exceptions import PubKeyNotFound, PrivKeyNotFound
+from parsec.exceptions import CompressionError, PubKeyNotFound, PrivKeyNotFound
 from parsec.ui.shell import start_shell
 from parsec.crypto import generate_asym_key
 from parsec.tools import logger_stream
@@ -124,7 +124,42 @@ def run_with_pdb(cmd, *args, **kwargs):
 @click.option('--identity', '-i', default=None)
 @click.option('--identity-key', '-I', type=click.File('rb'), default=None)
 @click.option('--I-am-John', is_flag=True, help='Log as dummy John Doe user')
-@click.option('--cache-size', help='Max number of elements in cache', default=1000)
+@click.option('--block-cache-size', type=click.INT, default=64,
+              help='Max size of the blocks cache in MB, 0 to disable (default: 64).')
+@click.option('--vlob-cache-size', type=click.INT, default=16,
+              help='Max size of the vlobs cache in MB, 0 to disable (default: 16).')
+@click.option('--user-vlob-cache-size', type=click.INT, default=4,
+              help='Max size of the user vlob cache in MB, 0 to disable (default: 4).')
+@click.option('--chunking', type=click.Choice(['fixed', 'cdc']), default='fixed',
+              help='Split files into fixed size blocks or content-defined blocks, the'
+              ' latter hashing every byte in pure Python at a few MB/s, which bounds the'
+              ' upload speed (default: fixed).')
+@click.option('--block-size', type=click.INT, default=4096,
+              help='Size of the blocks, average size for content-defined chunking'
+              ' (default: 4096).')
+@click.option('--dedup-secret', default=None,
+              help='Enable blocks deduplication, identical blocks are shared between'
+              ' the users using the same secret (default: disabled).')
+@click.option('--read-parallelism', type=click.IntRange(min=1), default=8,
+              help='Max number of blocks fetched concurrently when reading a file'
+              ' (default: 8).')
+@click.option('--read-ahead-size', type=click.INT, default=1024 * 1024,
+              help='Max amount of data prefetched in the background on sequential reads,'
+              ' 0 to disable (default: 1048576).')
+@click.option('--file-table-size', type=click.INT, default=1000,
+              help='Number of loaded files above which idle ones are evicted (default: 1000).')
+@click.option('--compression', type=click.Choice(['none', 'zlib', 'lz4', 'zstd']),
+              default='none',
+              help='Compress the blocks before encrypting them, blocks that do not shrink'
+              ' are stored raw (default: none).')
+@click.option('--compression-level', type=click.INT, default=None,
+              help='Level of the compression (default: algorithm default).')
+@click.option('--inline-threshold', type=click.INT, default=0,
+              help='Files smaller than this are stored in their vlob instead of blocks,'
+              ' 0 to disable (default: 0).')
+@click.option('--compaction-threshold', type=click.INT, default=32,
+              help='Undersized blocks of a file are merged on synchronization once there are'
+              ' that many, 0 to disable (default: 32).')
 def core(**kwargs):
     if kwargs.pop('pdb'):
         return run_with_pdb(_core, **kwargs)
@@ -133,9 +168,23 @@ def core(**kwargs):
 
 
 def _core(socket, backend_host, backend_watchdog,
-          debug, identity, identity_key, i_am_john, cache_size):
+          debug, identity, identity_key, i_am_john, block_cache_size, vlob_cache_size,
+          user_vlob_cache_size, chunking, block_size,
+          dedup_secret, read_parallelism, read_ahead_size, file_table_size,
+          compression, compression_level, inline_threshold, compaction_threshold):
     app = unix_socket_app.UnixSocketApplication()
-    components = core_components_factory(app, backend_host, backend_watchdog, cache_size)
+    megabyte = 1024 * 1024
+    try:
+        components = core_components_factory(app, backend_host, backend_watchdog,
+                                             block_cache_size * megabyte,
+                                             vlob_cache_size * megabyte,
+                                             user_vlob_cache_size * megabyte,
+                                             chunking, block_size, dedup_secret,
+                                             read_parallelism, read_ahead_size, file_table_size,
+                                             compression, compression_level, inline_threshold,
+                                             compaction_threshold)
+    except CompressionError as exc:
+        raise SystemExit(exc.label)
     dispatcher = components.get_dispatcher()
     register_core_api(app, dispatcher)
 
@@ -5,6 +5,9 @@ from parsec.base import base_dispatcher, EventComponent
 from parsec.core.core_api import register_core_api
 from parsec.core.backend import BackendComponent
 from parsec.core.identity import IdentityComponent
+from parsec.core.chunker import chunker_factory
+from parsec.core.compression import compressor_factory
+from parsec.core.file import File
 from parsec.core.fs import FSComponent
 from parsec.core.synchronizer import SynchronizerComponent
 from parsec.core.block import BlockComponent
@@ -39,7 +42,21 @@ class CoreComponents:
         await self.synchronizer.startup(app)
 
 
-def components_factory(app, backend_host, backend_watchdog=False, cache_size=4000):
+def components_factory(app, backend_host, backend_watchdog=False,
+                       block_cache_size=64 * 1024 * 1024, vlob_cache_size=16 * 1024 * 1024,
+                       user_vlob_cache_size=4 * 1024 * 1024, chunking='fixed', block_size=4096,
+                       dedup_secret=None, read_parallelism=8, read_ahead_size=1024 * 1024,
+                       file_table_size=1000, compression='none', compression_level=None,
+                       inline_threshold=0, compaction_threshold=32):
+    assert read_parallelism >= 1, 'Read parallelism must be at least 1.'
+    File.chunker = chunker_factory(chunking, block_size)
+    File.compressor = compressor_factory(compression, compression_level)
+    File.dedup_secret = dedup_secret.encode() if dedup_secret else None
+    File.read_parallelism = read_parallelism
+    File.read_ahead_size = read_ahead_size
+    File.files.max_size = file_table_size
+    File.inline_threshold = inline_threshold
+    File.compaction_threshold = compaction_threshold
     backend = BackendComponent(backend_host, backend_watchdog)
     block = BlockComponent()
     core_components = CoreComponents(
@@ -48,7 +65,9 @@ def components_factory(app, backend_host, backend_watchdog=False, cache_size=400
         backend=backend,
         fs=FSComponent(),
         identity=IdentityComponent(),
-        synchronizer=SynchronizerComponent(cache_size)
+        synchronizer=SynchronizerComponent(block_cache_size,
+                                           vlob_cache_size,
+                                           user_vlob_cache_size)
     )
     app.components = core_components
     app.on_startup.append(core_components.startup)
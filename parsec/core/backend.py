@@ -222,6 +222,7 @@ class BackendComponent:
             backend_vlob.EBackendVlobCreate: backend_vlob.perform_vlob_create,
             backend_vlob.EBackendVlobUpdate: backend_vlob.perform_vlob_update,
             backend_vlob.EBackendVlobRead: backend_vlob.perform_vlob_read,
+            backend_vlob.EBackendVlobHead: backend_vlob.perform_vlob_head,
             backend_user_vlob.EBackendUserVlobUpdate: backend_user_vlob.perform_user_vlob_update,
             backend_user_vlob.EBackendUserVlobRead: backend_user_vlob.perform_user_vlob_read,
             backend_message.EBackendMessageGet: backend_message.perform_message_get,
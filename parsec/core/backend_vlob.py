@@ -26,6 +26,12 @@ class EBackendVlobUpdate:
     blob = attr.ib(default=b'')
 
 
+@attr.s
+class EBackendVlobHead:
+    # Read trust seeds indexed by vlob id
+    vlobs = attr.ib()
+
+
 @attr.s
 class VlobAccess:
     id = attr.ib()
@@ -40,6 +46,13 @@ class VlobAtom:
     blob = attr.ib()
 
 
+@attr.s
+class VlobHead:
+    id = attr.ib()
+    version = attr.ib()
+    size = attr.ib()
+
+
 @do
 def perform_vlob_create(intent):
     msg = {'blob': to_jsonb64(intent.blob)}
@@ -75,3 +88,14 @@ def perform_vlob_update(intent):
     status = ret['status']
     if status != 'ok':
         raise exception_from_status(status)(ret['label'])
+
+
+@do
+def perform_vlob_head(intent):
+    # Versions and sizes of many vlobs in a single command, without their blobs
+    msg = {'vlobs': intent.vlobs}
+    ret = yield Effect(BackendCmd('vlob_head', msg))
+    status = ret['status']
+    if status != 'ok':
+        raise exception_from_status(status)(ret['label'])
+    return {id: VlobHead(id, head['version'], head['size']) for id, head in ret['vlobs'].items()}
@@ -3,7 +3,8 @@ import aiohttp
 from effect2 import TypeDispatcher, do, Effect, AsyncFunc
 
 from parsec.core.backend import EBackendBlockStoreGetURL
-from parsec.exceptions import BlockError, BlockNotFound, BlockConnectionError
+from parsec.exceptions import (
+    BlockError, BlockNotFound, BlockAlreadyExists, BlockConnectionError)
 
 
 # TODO: id shouldn't be allowed to be decided by user
@@ -18,6 +19,11 @@ class EBlockRead:
     id = attr.ib()
 
 
+@attr.s
+class EBlockExists:
+    id = attr.ib()
+
+
 @attr.s
 class EBlockReset:
     pass
@@ -47,13 +53,24 @@ class RESTBlockConnection:
                 else:
                     raise BlockError(await resp.text())
 
+    async def exists(self, id: str):
+        route = '%s/%s' % (self.url, id)
+        async with aiohttp.ClientSession() as session:
+            async with session.head(route) as resp:
+                if resp.status == 200:
+                    return True
+                elif resp.status == 404:
+                    return False
+                else:
+                    raise BlockError(await resp.text())
+
     async def create(self, id: str, content: bytes):
         route = '%s/%s' % (self.url, id)
         async with aiohttp.ClientSession() as session:
             async with session.post(route, data=content) as resp:
                 if resp.status != 200:
                     if resp.status == 409:
-                        raise BlockError('Block %s already exists' % id)
+                        raise BlockAlreadyExists('Block %s already exists' % id)
                     else:
                         raise BlockError(await resp.text())
 
@@ -108,6 +125,9 @@ class BlockComponent:
         content = await self.connection.read(intent.id)
         return Block(id=intent.id, content=content)
 
+    async def perform_block_exists(self, intent):
+        return await self.connection.exists(intent.id)
+
     async def perform_block_create(self, intent):
         await self.connection.create(intent.id, intent.content)
         return Block(id=intent.id, content=intent.content)
@@ -118,5 +138,7 @@ class BlockComponent:
             EBlockCreate: self.performer_with_connection_factory(
                 self.perform_block_create),
             EBlockRead: self.performer_with_connection_factory(
-                self.perform_block_read)
+                self.perform_block_read),
+            EBlockExists: self.performer_with_connection_factory(
+                self.perform_block_exists)
         })
@@ -0,0 +1,444 @@
+import hashlib
+import struct
+import sys
+from array import array
+from bisect import bisect_right
+from itertools import accumulate, chain
+
+from parsec.core.merkle import MerkleTree, leaf_hash
+from parsec.tools import from_jsonb64, to_jsonb64, ejson_dumps, ejson_loads
+
+
+# Entry flags
+BLOCK = 0x01  # Refers to a stored block
+INLINE = 0x02  # Data stored in the block map itself
+DIGEST = 0x04  # Holes have no digest
+GROUP_KEY = 0x08  # Key shared by the blocks of the group
+OWN_KEY = 0x10  # Key of a content-addressed block
+HEX_ID = 0x20  # Block id stored as the bytes of its hexadecimal form
+GROUP_START = 0x40  # First entry of a group
+
+# Digest recorded for every block when `digest` ignored its input, it says
+# nothing about the content of non-empty blocks
+LEGACY_DIGEST = hashlib.sha512(b'').digest()
+
+# Marks the compact serialized form, JSON block maps never start with a NUL byte
+MAGIC = b'\x00PBM1'
+# Section lengths followed by the widths of the byte columns
+HEADER = struct.Struct('<11Q3H')
+
+# Array type codes are platform dependent, only the sizes are fixed
+INDEX_TYPECODE = 'I' if array('I').itemsize == 4 else 'L'
+assert array(INDEX_TYPECODE).itemsize == 4
+
+
+def _little_endian(values):
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_little_endian(typecode, raw):
+    values = array(typecode)
+    values.frombytes(raw)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+class ByteColumn:
+
+    """
+    Byte strings packed in a single buffer, each one padded to the length of
+    the longest so slices of the column are plain buffer slices.
+    """
+
+    __slots__ = ('width', 'data', 'lengths')
+
+    def __init__(self, width=0):
+        self.width = width
+        self.data = bytearray()
+        self.lengths = array('H')
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, index):
+        start = index * self.width
+        return bytes(self.data[start:start + self.lengths[index]])
+
+    def append(self, value):
+        if len(value) > self.width:
+            self._widen(len(value))
+        self.data += value
+        self.data += bytes(self.width - len(value))
+        self.lengths.append(len(value))
+
+    def extend(self, other, start, stop):
+        if other.width > self.width:
+            self._widen(other.width)
+        if other.width == self.width:
+            self.data += other.data[start * self.width:stop * self.width]
+            self.lengths += other.lengths[start:stop]
+        else:
+            for index in range(start, stop):
+                self.append(other[index])
+
+    def _widen(self, width):
+        values = [self[index] for index in range(len(self))]
+        self.width = width
+        self.data = bytearray()
+        self.lengths = array('H')
+        for value in values:
+            self.append(value)
+
+
+class BlockSlice:
+
+    """Entries [start, stop[ of a block index, to build a new one from."""
+
+    __slots__ = ('index', 'start', 'stop')
+
+    def __init__(self, index, start, stop):
+        self.index = index
+        self.start = start
+        self.stop = stop
+
+
+class BlockIndex:
+
+    """
+    Offset-sorted view over the block map of a given file version.
+
+    Blocks are flattened in file order and stored column-wise: sizes and end
+    offsets (as prefix sums, so locating the blocks covering a range is a
+    bisect) in `array('Q')`, ids, digests and keys as bytes in `ByteColumn`s,
+    each entry referencing its key by index. A file of millions of blocks
+    thus costs around a hundred bytes per block instead of a dict of strings.
+
+    The index is built from parts, either `{'blocks', 'key'}` groups as found
+    in a JSON block map or `BlockSlice`s of another index, which are copied
+    without going through Python objects for each block.
+
+    Entries with `data` are stored inline in the blob, entries with neither
+    `block` nor `data` are holes: they only have a size and read as zeros.
+    The hash tree over the blocks is only built when first needed. Its root is
+    recorded in the compact form, the JSON form has no room for it so the root
+    of such block maps is derived from their entries.
+    """
+
+    def __init__(self, parts=(), version=None):
+        self.version = version
+        self.sizes = array('Q')
+        self.ends = array('Q')
+        self.flags = bytearray()
+        self.ids = ByteColumn()
+        self.digests = ByteColumn()
+        self.key_indexes = array(INDEX_TYPECODE)
+        self.keys = ByteColumn()
+        # Algorithm names, entries reference them by index (0 for uncompressed)
+        self.compressions = [None]
+        self.codecs = bytearray()
+        self.inline = {}
+        self.size = 0
+        self._tree = None
+        # Root recorded in the serialized block map, if any
+        self.stored_root = None
+        # Index whose keys are shared, only needed while building
+        self._key_source = None
+        for part in parts:
+            if isinstance(part, BlockSlice):
+                self._append_slice(part)
+            else:
+                self._append_group(part)
+        self._key_source = None
+
+    def __len__(self):
+        return len(self.flags)
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = MerkleTree([self._leaf(index) for index in range(len(self))])
+        return self._tree
+
+    @property
+    def root(self):
+        if self.stored_root is not None:
+            return self.stored_root
+        return self.tree.root
+
+    def _leaf(self, index):
+        if self.flags[index] & DIGEST:
+            return leaf_hash(self.sizes[index], self.digests[index])
+        return leaf_hash(self.sizes[index])
+
+    def _append_group(self, group):
+        key_index = None
+        for block_properties in group['blocks']:
+            flags = GROUP_START if key_index is None else 0
+            key_index = 0
+            if group['key'] is not None:
+                key_index = self._add_key(group['key'])
+                flags |= GROUP_KEY
+            if block_properties.get('key'):
+                key_index = self._add_key(block_properties['key'])
+                flags |= OWN_KEY
+            block_id = block_properties.get('block')
+            raw_id = b''
+            if block_id is not None:
+                flags |= BLOCK
+                raw_id = block_id.encode()
+                try:
+                    if bytes.fromhex(block_id).hex() == block_id:
+                        raw_id = bytes.fromhex(block_id)
+                        flags |= HEX_ID
+                except ValueError:
+                    pass
+            if 'data' in block_properties:
+                flags |= INLINE
+                self.inline[len(self)] = from_jsonb64(block_properties['data'])
+            raw_digest = b''
+            if 'digest' in block_properties:
+                flags |= DIGEST
+                raw_digest = from_jsonb64(block_properties['digest'])
+            compression = block_properties.get('compression')
+            if compression not in self.compressions:
+                self.compressions.append(compression)
+            self.flags.append(flags)
+            self.ids.append(raw_id)
+            self.digests.append(raw_digest)
+            self.key_indexes.append(key_index)
+            self.codecs.append(self.compressions.index(compression))
+            self.size += block_properties['size']
+            self.sizes.append(block_properties['size'])
+            self.ends.append(self.size)
+
+    def _add_key(self, key):
+        raw_key = from_jsonb64(key)
+        # Blocks of a group share their key, no need to store it again
+        if len(self.keys) and self.keys[len(self.keys) - 1] == raw_key:
+            return len(self.keys) - 1
+        self.keys.append(raw_key)
+        return len(self.keys) - 1
+
+    def _append_slice(self, part):
+        other, start, stop = part.index, part.start, part.stop
+        if start >= stop:
+            return
+        offset = len(self)
+        flags = other.flags[start:stop]
+        # Grouping is recomputed from the keys, as if the entries were regrouped
+        flags[0] |= GROUP_START
+        flags[1:] = flags[1:].translate(_CLEAR_GROUP_START)
+        self.flags += flags
+        self.ids.extend(other.ids, start, stop)
+        self.digests.extend(other.digests, start, stop)
+        self._append_key_indexes(other, start, stop)
+        if other.compressions == self.compressions[:len(other.compressions)]:
+            self.codecs += other.codecs[start:stop]
+        else:
+            for codec in other.codecs[start:stop]:
+                compression = other.compressions[codec]
+                if compression not in self.compressions:
+                    self.compressions.append(compression)
+                self.codecs.append(self.compressions.index(compression))
+        for index, data in other.inline.items():
+            if start <= index < stop:
+                self.inline[index - start + offset] = data
+        sizes = other.sizes[start:stop]
+        self.sizes += sizes
+        base = self.size - other.start(start)
+        if base == 0:
+            self.ends += other.ends[start:stop]
+        else:
+            ends = accumulate(chain((self.size,), sizes))
+            next(ends)
+            self.ends.extend(ends)
+        self.size = self.ends[-1]
+
+    def _append_key_indexes(self, other, start, stop):
+        # Keys of the first index sliced are copied as a whole so its key
+        # indexes stay valid, keys of other indexes are added one by one
+        if self._key_source is None and not len(self.keys):
+            self.keys.extend(other.keys, 0, len(other.keys))
+            self._key_source = other
+        if other is self._key_source:
+            self.key_indexes += other.key_indexes[start:stop]
+            return
+        for index in range(start, stop):
+            if other.flags[index] & (GROUP_KEY | OWN_KEY):
+                self.keys.append(other.keys[other.key_indexes[index]])
+                self.key_indexes.append(len(self.keys) - 1)
+            else:
+                self.key_indexes.append(0)
+
+    def slice(self, start, stop):
+        return BlockSlice(self, start, stop)
+
+    def start(self, index):
+        return self.ends[index - 1] if index else 0
+
+    def length(self, index):
+        return self.sizes[index]
+
+    def has_block(self, index):
+        return bool(self.flags[index] & BLOCK)
+
+    def is_inline(self, index):
+        return bool(self.flags[index] & INLINE)
+
+    def has_digest(self, index):
+        """Whether the content of a block can be checked against its digest."""
+        if not self.flags[index] & DIGEST:
+            return False
+        return not self.sizes[index] or self.digests[index] != LEGACY_DIGEST
+
+    def digest(self, index):
+        return self.digests[index]
+
+    def is_hole(self, index):
+        return not self.flags[index] & (BLOCK | INLINE)
+
+    def block_id(self, index):
+        raw_id = self.ids[index]
+        if self.flags[index] & HEX_ID:
+            return raw_id.hex()
+        return raw_id.decode()
+
+    def block_ids(self):
+        return [self.block_id(index) for index in range(len(self)) if self.flags[index] & BLOCK]
+
+    def dropped_block_ids(self, parts):
+        """
+        Ids of the blocks of this index left out of the new block map built from
+        `parts`, once per entry. Only the entries between the kept slices are
+        visited, so replacing a few blocks doesn't cost a walk over the others.
+        """
+        kept = sorted((part.start, part.stop) for part in parts
+                      if isinstance(part, BlockSlice) and part.index is self)
+        dropped = []
+        position = 0
+        for start, stop in kept + [(len(self), len(self))]:
+            dropped += [self.block_id(index) for index in range(position, start)
+                        if self.flags[index] & BLOCK]
+            position = max(position, stop)
+        return dropped
+
+    def data(self, index):
+        return self.inline[index]
+
+    def key(self, index):
+        if self.flags[index] & (GROUP_KEY | OWN_KEY):
+            return to_jsonb64(self.keys[self.key_indexes[index]])
+        return None
+
+    def _group_key(self, index):
+        if self.flags[index] & GROUP_KEY and not self.flags[index] & OWN_KEY:
+            return self.key(index)
+        return None
+
+    def entry(self, index):
+        """Properties of a block as found in a JSON block map."""
+        flags = self.flags[index]
+        block_properties = {'size': self.sizes[index]}
+        if flags & BLOCK:
+            block_properties['block'] = self.block_id(index)
+        if flags & INLINE:
+            block_properties['data'] = to_jsonb64(self.inline[index])
+        if flags & DIGEST:
+            block_properties['digest'] = to_jsonb64(self.digests[index])
+        if flags & OWN_KEY:
+            block_properties['key'] = self.key(index)
+        if self.codecs[index]:
+            block_properties['compression'] = self.compressions[self.codecs[index]]
+        return block_properties
+
+    def bounds(self, offset, size):
+        """
+        Return the indexes delimiting blocks ending before `offset` and blocks
+        ending before `offset + size`.
+        """
+        first = bisect_right(self.ends, offset)
+        last = bisect_right(self.ends, offset + size, lo=first)
+        return first, last
+
+    def group(self, start, stop):
+        """Rebuild `{'blocks', 'key'}` groups for the blocks in [start, stop[."""
+        groups = []
+        for index in range(start, stop):
+            key = self._group_key(index)
+            if groups and groups[-1]['key'] == key and not self.flags[index] & GROUP_START:
+                groups[-1]['blocks'].append(self.entry(index))
+            else:
+                groups.append({'blocks': [self.entry(index)], 'key': key})
+        return groups
+
+    def dumps(self):
+        """JSON block map, as a list of `{'blocks', 'key'}` groups."""
+        return ejson_dumps(self.group(0, len(self))).encode()
+
+    def to_bytes(self):
+        """
+        Compact serialized form: the columns are written as is, only the keys
+        still referenced are kept.
+        """
+        used = sorted(set(self.key_indexes))
+        keys = ByteColumn()
+        for key_index in used:
+            if key_index < len(self.keys):
+                keys.append(self.keys[key_index])
+        renumbering = {key_index: position for position, key_index in enumerate(used)}
+        key_indexes = array(INDEX_TYPECODE, map(renumbering.__getitem__, self.key_indexes))
+        meta = ejson_dumps({
+            'compressions': self.compressions,
+            'inline': {str(index): to_jsonb64(data) for index, data in self.inline.items()},
+            'root': to_jsonb64(self.root)
+        }).encode()
+        sections = [_little_endian(self.sizes), bytes(self.flags), bytes(self.codecs),
+                    _little_endian(key_indexes), bytes(self.ids.data),
+                    _little_endian(self.ids.lengths), bytes(self.digests.data),
+                    _little_endian(self.digests.lengths), bytes(keys.data),
+                    _little_endian(keys.lengths), meta]
+        header = HEADER.pack(*[len(section) for section in sections],
+                             self.ids.width, self.digests.width, keys.width)
+        return MAGIC + header + b''.join(sections)
+
+    @classmethod
+    def from_bytes(cls, raw, version=None):
+        position = len(MAGIC) + HEADER.size
+        header = HEADER.unpack(raw[len(MAGIC):position])
+        sections = []
+        for length in header[:-3]:
+            sections.append(raw[position:position + length])
+            position += length
+        self = cls(version=version)
+        self.sizes = _from_little_endian('Q', sections[0])
+        self.flags = bytearray(sections[1])
+        self.codecs = bytearray(sections[2])
+        self.key_indexes = _from_little_endian(INDEX_TYPECODE, sections[3])
+        for column, data, lengths, width in ((self.ids, sections[4], sections[5], header[-3]),
+                                             (self.digests, sections[6], sections[7], header[-2]),
+                                             (self.keys, sections[8], sections[9], header[-1])):
+            column.width = width
+            column.data = bytearray(data)
+            column.lengths = _from_little_endian('H', lengths)
+        meta = ejson_loads(sections[10].decode())
+        self.compressions = meta['compressions']
+        self.inline = {int(index): from_jsonb64(data) for index, data in meta['inline'].items()}
+        if 'root' in meta:
+            self.stored_root = from_jsonb64(meta['root'])
+        self.ends = array('Q', accumulate(self.sizes))
+        self.size = self.ends[-1] if self.ends else 0
+        return self
+
+    @classmethod
+    def loads(cls, raw, version=None):
+        """Load a block map in either of its serialized forms."""
+        if raw.startswith(MAGIC):
+            return cls.from_bytes(raw, version)
+        return cls(ejson_loads(raw.decode()), version)
+
+
+_CLEAR_GROUP_START = bytes(flags & ~GROUP_START for flags in range(256))
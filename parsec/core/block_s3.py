@@ -27,6 +27,18 @@ class S3BlockConnection:
             raise BlockNotFound(str(exc))
         return obj['Body'].read()
 
+    async def exists(self, id: str):
+        func = partial(self.s3.head_object, Bucket=self.s3_bucket, Key=id)
+        try:
+            await get_event_loop().run_in_executor(None, func)
+        except S3ClientError as exc:
+            if exc.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+                return False
+            raise BlockError(str(exc))
+        except S3EndpointConnectionError as exc:
+            raise BlockError(str(exc))
+        return True
+
     async def create(self, id: str, content: bytes):
         func = partial(self.s3.put_object, Bucket=self.s3_bucket,
                        Key=id, Body=content)
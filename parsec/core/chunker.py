@@ -0,0 +1,113 @@
+import hashlib
+
+
+MASK_64 = 0xffffffffffffffff
+# Gear table for the rolling hash, it must stay stable across versions given
+# it decides where chunk boundaries are
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], 'big') for i in range(256)]
+
+
+# Bytes rolled between two truncations of the fingerprint to 64 bits
+SEGMENT = 128
+
+
+def _roll(data, begin, stop, mask, fingerprint):
+    """
+    Roll the gear hash over `data[begin:stop]`, return the position following
+    the first byte clearing the `mask` bits of the fingerprint (None if no byte
+    does) along with the fingerprint.
+    """
+    gear = GEAR
+    for offset in range(begin, stop, SEGMENT):
+        # Carries only go up so the low 64 bits stay right without truncating
+        # the fingerprint at each byte, this is the hot loop of the chunker
+        for position, value in enumerate(map(gear.__getitem__,
+                                             data[offset:min(offset + SEGMENT, stop)]),
+                                         offset + 1):
+            fingerprint = (fingerprint << 1) + value
+            if not fingerprint & mask:
+                return position, fingerprint & MASK_64
+        fingerprint &= MASK_64
+    return None, fingerprint
+
+
+class BaseChunker:
+
+    # Only the last chunk of the data can be smaller than this
+    min_block_size = 1
+
+    def split(self, data: bytes):
+        raise NotImplementedError()
+
+
+class FixedSizeChunker(BaseChunker):
+
+    def __init__(self, block_size=4096):
+        if block_size < 1:
+            raise ValueError('Block size must be strictly positive.')
+        self.block_size = block_size
+        self.min_block_size = block_size
+
+    def split(self, data: bytes):
+        block_size = self.block_size
+        return [data[i:i + block_size] for i in range(0, len(data), block_size)]
+
+
+class ContentDefinedChunker(BaseChunker):
+
+    """
+    FastCDC-style chunker: boundaries are found with a gear rolling hash, so an
+    insertion only moves the boundaries of the chunks around it.
+
+    Normalized chunking is used (stricter mask before the average size, looser
+    after it) to keep chunk sizes close to `avg_size`.
+
+    The rolling hash is computed byte by byte in pure Python: only the bytes
+    between `min_size` and the boundary are rolled, yet chunking runs at a few
+    MB/s against hundreds for fixed size chunking and bounds the upload speed.
+    """
+
+    def __init__(self, min_size=1024, avg_size=4096, max_size=32768):
+        if avg_size & (avg_size - 1):
+            raise ValueError('Average size must be a power of two.')
+        if not 0 < min_size <= avg_size <= max_size:
+            raise ValueError('Sizes must verify 0 < min_size <= avg_size <= max_size.')
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        self.min_block_size = min_size
+        bits = avg_size.bit_length() - 1
+        # Gear hash accumulates entropy in the high bits
+        self.mask_small = ((1 << (bits + 1)) - 1) << (64 - bits - 1)
+        self.mask_large = ((1 << max(bits - 1, 1)) - 1) << (64 - max(bits - 1, 1))
+
+    def _cut(self, data, start):
+        remaining = len(data) - start
+        if remaining <= self.min_size:
+            return remaining
+        end = start + min(remaining, self.max_size)
+        normal = start + min(self.avg_size, end - start)
+        position, fingerprint = _roll(data, start + self.min_size, normal, self.mask_small, 0)
+        if position is None:
+            position, fingerprint = _roll(data, normal, end, self.mask_large, fingerprint)
+        return (end if position is None else position) - start
+
+    def split(self, data: bytes):
+        chunks = []
+        start = 0
+        while start < len(data):
+            length = self._cut(data, start)
+            chunks.append(data[start:start + length])
+            start += length
+        return chunks
+
+
+def chunker_factory(chunking='fixed', block_size=4096):
+    if chunking == 'fixed':
+        return FixedSizeChunker(block_size)
+    elif chunking == 'cdc':
+        return ContentDefinedChunker(min_size=block_size // 4,
+                                     avg_size=block_size,
+                                     max_size=block_size * 8)
+    else:
+        raise ValueError('Unknown chunking `%s` (should be `fixed` or `cdc`).' % chunking)
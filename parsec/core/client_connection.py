@@ -2,6 +2,7 @@ import attr
 import random
 import string
 import asyncio
+from uuid import uuid4
 from logbook import Logger
 from blinker import signal
 from websockets import ConnectionClosed
@@ -16,6 +17,11 @@ class EPushClientMsg:
     payload = attr.ib()
 
 
+@attr.s
+class EClientSend:
+    payload = attr.ib()
+
+
 @attr.s
 class EClientSubscribeEvent:
     event = attr.ib()
@@ -34,6 +40,11 @@ class EClientEvent:
     sender = attr.ib()
 
 
+@attr.s
+class EClientId:
+    pass
+
+
 def _unique_enough_id():
     # Colision risk is high, but this is pretty fine (and much more readable
     # than a uuid4) for giving id to connections
@@ -49,6 +60,8 @@ class ClientConnectionContext:
         lambda: Logger('Connection ' + _unique_enough_id())))
     _buffer = attr.ib(default=b'', init=False)
     subscribed_events = attr.ib(default=attr.Factory(dict))
+    # Scopes the resources (e.g. file handles) owned by the connection
+    id = attr.ib(default=attr.Factory(lambda: uuid4().hex))
 
     async def recv(self):
         while True:
@@ -70,11 +83,23 @@ class ClientConnectionContext:
         except BrokenPipeError:
             raise ConnectionClosed()
 
+    async def drain(self):
+        try:
+            await self.writer.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            raise ConnectionClosed()
+
 
 def client_dispatcher_factory(client_context):
     def perform_push_client_msg(intent):
         client_context.queued_pushed_events.put_nowait(intent.payload)
 
+    async def perform_client_send(intent):
+        # Sent right away (unlike pushed messages) and waits for the socket
+        # buffer to be flushed so a slow client throttles the sender
+        await client_context.send(intent.payload)
+        await client_context.drain()
+
     @do
     def perform_client_subscribe_event(intent):
         yield Effect(ERegisterEvent(EClientEvent, intent.event, intent.sender))
@@ -103,11 +128,16 @@ def client_dispatcher_factory(client_context):
         payload = ejson_dumps({'event': intent.event, 'sender': intent.sender})
         client_context.queued_pushed_events.put_nowait(payload)
 
+    def perform_client_id(intent):
+        return client_context.id
+
     return TypeDispatcher({
         EPushClientMsg: perform_push_client_msg,
+        EClientSend: perform_client_send,
         EClientSubscribeEvent: perform_client_subscribe_event,
         EClientUnsubscribeEvent: perform_client_unsubscribe_event,
-        EClientEvent: perform_client_event
+        EClientEvent: perform_client_event,
+        EClientId: perform_client_id
     })
 
 
@@ -151,5 +181,7 @@ def on_connection_factory(execute_cmd, base_dispatcher):
         finally:
             get_event.cancel()
             get_cmd.cancel()
+            # Let the components release what the connection held
+            await asyncio_perform(dispatcher, Effect(EEvent('client_disconnected', context.id)))
 
     return on_connection
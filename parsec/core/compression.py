@@ -0,0 +1,110 @@
+import zlib
+
+from parsec.exceptions import CompressionError
+
+
+class BaseCompressor:
+
+    # Name recorded in the block properties to decompress the block back
+    algorithm = None
+
+    def compress(self, data: bytes):
+        raise NotImplementedError()
+
+    def decompress(self, data: bytes):
+        raise NotImplementedError()
+
+
+class ZlibCompressor(BaseCompressor):
+
+    algorithm = 'zlib'
+
+    def __init__(self, level=6):
+        if not 0 <= level <= 9:
+            raise ValueError('Zlib compression level must be between 0 and 9.')
+        self.level = level
+
+    def compress(self, data: bytes):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data: bytes):
+        return zlib.decompress(data)
+
+
+class LZ4Compressor(BaseCompressor):
+
+    algorithm = 'lz4'
+
+    def __init__(self, level=0):
+        import lz4.frame
+        self._lz4 = lz4.frame
+        self.level = level
+
+    def compress(self, data: bytes):
+        return self._lz4.compress(data, compression_level=self.level)
+
+    def decompress(self, data: bytes):
+        return self._lz4.decompress(data)
+
+
+class ZstdCompressor(BaseCompressor):
+
+    algorithm = 'zstd'
+
+    def __init__(self, level=3):
+        import zstandard
+        self._compressor = zstandard.ZstdCompressor(level=level)
+        self._decompressor = zstandard.ZstdDecompressor()
+        self.level = level
+
+    def compress(self, data: bytes):
+        return self._compressor.compress(data)
+
+    def decompress(self, data: bytes):
+        return self._decompressor.decompress(data)
+
+
+COMPRESSORS = {
+    'zlib': ZlibCompressor,
+    'lz4': LZ4Compressor,
+    'zstd': ZstdCompressor,
+}
+# Decompressors are shared, the level only matters when compressing
+_decompressors = {}
+
+
+# Packages providing the optional algorithms, see the setup.py extras
+PACKAGES = {
+    'lz4': 'lz4',
+    'zstd': 'zstandard',
+}
+
+
+def _load_compressor(algorithm, *args):
+    try:
+        compressor_cls = COMPRESSORS[algorithm]
+    except KeyError:
+        raise CompressionError('Unknown compression `%s` (should be `none`, `zlib`, `lz4` or'
+                               ' `zstd`).' % algorithm)
+    try:
+        return compressor_cls(*args)
+    except ImportError as exc:
+        raise CompressionError('%s compression needs the `%s` package, install parsec with the'
+                               ' `%s` extra (error: %s).' %
+                               (algorithm, PACKAGES[algorithm], algorithm, exc))
+
+
+def compressor_factory(compression='none', level=None):
+    if compression == 'none':
+        return None
+    if level is None:
+        return _load_compressor(compression)
+    return _load_compressor(compression, level)
+
+
+def decompress(algorithm, data: bytes):
+    try:
+        decompressor = _decompressors[algorithm]
+    except KeyError:
+        decompressor = _decompressors[algorithm] = _load_compressor(algorithm)
+    return decompressor.decompress(data)
@@ -9,6 +9,7 @@ from parsec.core.client_connection import (
     EClientSubscribeEvent, EClientUnsubscribeEvent
 )
 from parsec.core.backend import EBackendStatus
+from parsec.core.synchronizer import ECacheStats
 from parsec.exceptions import ParsecError, BadMessageError
 
 
@@ -78,6 +79,12 @@ def api_backend_status(msg):
     return {'status': 'ok'}
 
 
+@do
+def api_cache_stats(msg):
+    stats = yield Effect(ECacheStats())
+    return {'status': 'ok', **stats}
+
+
 @do
 def api_ping(msg):
     return {'status': 'ok', 'pong': msg.get('ping', '')}
@@ -88,6 +95,7 @@ API_CMDS_ROUTER = {
     'subscribe_event': api_subscribe_event,
     'unsubscribe_event': api_unsubscribe_event,
     'backend_status': api_backend_status,
+    'cache_stats': api_cache_stats,
 
     'identity_signup': identity_api.api_identity_signup,
     'identity_login': identity_api.api_identity_login,
@@ -101,9 +109,14 @@ API_CMDS_ROUTER = {
     'history': fs_api.api_manifest_history,  # TODO Integrate api_file_history
     'restore': fs_api.api_manifest_restore,  # TODO Integrate api_file_restore
     'file_create': fs_api.api_file_create,
+    'file_open': fs_api.api_file_open,
+    'file_close': fs_api.api_file_close,
     'file_read': fs_api.api_file_read,
     'file_write': fs_api.api_file_write,
     'file_truncate': fs_api.api_file_truncate,
+    'file_root_hash': fs_api.api_file_root_hash,
+    'file_verify': fs_api.api_file_verify,
+    'file_copy': fs_api.api_file_copy,
     'folder_create': fs_api.api_folder_create,
     'stat': fs_api.api_stat,
     'move': fs_api.api_move,
@@ -1,69 +1,231 @@
 import sys
+import hashlib
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
 
-from effect2 import Effect, do
+from effect2 import Effect, background, do, parallel
 
-from parsec.crypto import generate_sym_key, load_sym_key
+from parsec.crypto import InvalidTag, derive_sym_key, generate_sym_key, load_sym_key
+from parsec.core.block_map import BlockIndex
+from parsec.core.chunker import FixedSizeChunker
+from parsec.core.compression import decompress
+from parsec.core.merkle import data_leaf_hash
 from parsec.core.synchronizer import (
     EVlobCreate, EVlobList, EVlobRead, EVlobUpdate, EVlobDelete, EVlobSynchronize, EBlockCreate,
-    EBlockSynchronize, EBlockRead, EBlockDelete)
-from parsec.exceptions import BlockNotFound, FileError, VlobNotFound
-from parsec.tools import from_jsonb64, to_jsonb64, ejson_dumps, ejson_loads, digest
+    EBlockSynchronize, EBlockRead, EBlockPrefetch, EBlockReference, EBlockRelease)
+from parsec.exceptions import BlockIntegrityError, BlockNotFound, FileError, VlobNotFound
+from parsec.tools import from_jsonb64, to_jsonb64, ejson_dumps, digest
+
+
+def concat(pieces):
+    """
+    Join bytes-like objects (typically memoryview slices of blocks) copying each
+    of them once into a buffer preallocated to the final size.
+    """
+    data = bytearray(sum(len(piece) for piece in pieces))
+    position = 0
+    for piece in pieces:
+        data[position:position + len(piece)] = piece
+        position += len(piece)
+    return data
 
 
 class ContentBuilder:
 
+    """
+    Sparse write buffer: non-overlapping extents sorted by offset.
+
+    Each extent is a `bytearray` updated in place, so a write only bisects for
+    the extents it touches, merges them and never copies data that is already
+    buffered (sequential writes simply extend the last extent).
+    """
+
     def __init__(self):
-        self.contents = {}
+        self.offsets = []
+        self.buffers = []
+
+    @property
+    def contents(self):
+        return {offset: bytes(buffer) for offset, buffer in self.items()}
+
+    def items(self):
+        return zip(self.offsets, self.buffers)
 
     def write(self, data, offset):
+        if not data:
+            return
         end_offset = offset + len(data)
-        offsets_to_delete = []
-        new_data = data
-        for current_offset in self.contents:
-            current_content = self.contents[current_offset]
-            # Insert inside
-            if offset >= current_offset and end_offset <= current_offset + len(current_content):
-                new_data = current_content[:offset - current_offset]
-                new_data += data
-                new_data += current_content[offset - current_offset + len(data):]
-                offset = current_offset
-            # Insert before and merge
-            elif offset <= current_offset and end_offset >= current_offset:
-                new_data = data + current_content[offset + len(data) - current_offset:]
-                offsets_to_delete.append(current_offset)
-            # Insert after
-            elif offset == current_offset + len(current_content):
-                new_data = current_content[:offset] + new_data
-                offset = current_offset
-        for offset_to_delete in offsets_to_delete:
-            del self.contents[offset_to_delete]
-        self.contents[offset] = new_data
+        offsets = self.offsets
+        buffers = self.buffers
+        # First extent ending at or after the write start (contiguous extents are merged)
+        first = bisect_right(offsets, offset) - 1
+        if first < 0 or offsets[first] + len(buffers[first]) < offset:
+            first += 1
+        # Last extent starting at or before the write end
+        last = bisect_right(offsets, end_offset) - 1
+        if first > last:
+            offsets.insert(first, offset)
+            buffers.insert(first, bytearray(data))
+            return
+        if offsets[first] <= offset:
+            new_offset = offsets[first]
+            buffer = buffers[first]
+            buffer[offset - new_offset:end_offset - new_offset] = data
+        else:
+            new_offset = offset
+            buffer = bytearray(data)
+        last_end_offset = offsets[last] + len(buffers[last])
+        if last_end_offset > end_offset and buffers[last] is not buffer:
+            buffer += memoryview(buffers[last])[end_offset - offsets[last]:]
+        offsets[first:last + 1] = [new_offset]
+        buffers[first:last + 1] = [buffer]
 
     def truncate(self, length):
-        offsets_to_delete = []
-        for current_offset in self.contents:
-            if current_offset > length:
-                offsets_to_delete.append(current_offset)
-            elif current_offset + len(self.contents[current_offset]) > length:
-                data = self.contents[current_offset][:length - current_offset]
-                self.contents[current_offset] = data
-        for offset_to_delete in offsets_to_delete:
-            del self.contents[offset_to_delete]
+        index = bisect_left(self.offsets, length)
+        del self.offsets[index:]
+        del self.buffers[index:]
+        if index:
+            del self.buffers[-1][length - self.offsets[-1]:]
+
+
+def hole_group(size):
+    """Group of a single hole of `size` bytes."""
+    return {'blocks': [{'size': size}], 'key': None}
+
+
+def inline_group(data):
+    """Group of a single entry holding `data` in the blob itself."""
+    return {'blocks': [{'data': to_jsonb64(data), 'digest': digest(data), 'size': len(data)}],
+            'key': None}
+
+
+class OpenFileTable:
+
+    """
+    Files loaded by the core, indexed by vlob id and kept in LRU order.
+
+    Once there are more than `max_size` files, the least recently used idle
+    ones are evicted. A file is idle if no handle references it (see
+    `acquire`/`release`) and it holds neither pending modifications nor
+    changes not yet synchronized.
+    """
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._files = OrderedDict()
+        self._references = {}
+
+    def __contains__(self, id):
+        return id in self._files
+
+    def __len__(self):
+        return len(self._files)
+
+    def __getitem__(self, id):
+        file = self._files[id]
+        self._files.move_to_end(id)
+        return file
+
+    def __setitem__(self, id, file):
+        self._files[id] = file
+        self._files.move_to_end(id)
+        self._evict()
+
+    def __delitem__(self, id):
+        del self._files[id]
+        self._references.pop(id, None)
+
+    def clear(self):
+        self._files.clear()
+        self._references.clear()
+
+    def rename(self, file, new_id):
+        # Vlob id changes on reencryption or first synchronization, handles follow it
+        self._files.pop(file.id, None)
+        if file.id in self._references:
+            self._references[new_id] = self._references.pop(file.id)
+        self._files[new_id] = file
+
+    def acquire(self, file):
+        if file.id not in self._files:
+            self._files[file.id] = file
+        self._references[file.id] = self._references.get(file.id, 0) + 1
+
+    def release(self, file):
+        references = self._references.get(file.id, 0) - 1
+        if references > 0:
+            self._references[file.id] = references
+        else:
+            self._references.pop(file.id, None)
+            self._evict()
+
+    def _is_idle(self, id, file):
+        return id not in self._references and not file.modifications and not file.dirty
+
+    def _evict(self):
+        excess = len(self._files) - self.max_size
+        if excess <= 0:
+            return
+        idle_ids = []
+        for id, file in self._files.items():
+            if self._is_idle(id, file):
+                idle_ids.append(id)
+                if len(idle_ids) == excess:
+                    break
+        for id in idle_ids:
+            del self._files[id]
+
+
+class ReadAhead:
+
+    """
+    Read-ahead state of a reader of a file (a handle, or the reads by path),
+    the window grows as long as its reads are sequential.
+    """
+
+    def __init__(self):
+        self.last_read_end = None
+        self.window = 0
+        # Version and position in the block index of the first block not prefetched yet
+        self.next = (None, 0)
 
 
 class File:
 
-    files = {}
+    files = OpenFileTable()
+    chunker = FixedSizeChunker()
+    # Secret scoping convergent encryption, deduplication is disabled if not set
+    dedup_secret = None
+    # Compression applied to the blocks before encryption, disabled if not set
+    compressor = None
+    # Files smaller than this are stored inline in their blob, 0 to disable
+    inline_threshold = 0
+    # Block maps with more entries than this are stored in their compact binary form
+    compact_block_map_threshold = 1024
+    # Undersized blocks are merged on commit once there are that many, 0 to disable
+    compaction_threshold = 32
+    # Max number of blocks fetched concurrently
+    read_parallelism = 8
+    # Max amount of data prefetched ahead of sequential reads, 0 to disable
+    read_ahead_size = 1024 * 1024
+
+    def __init__(self):
+        self._block_index = None
+        # Shared by the reads not going through a handle
+        self.read_ahead = ReadAhead()
 
     @classmethod
     @do
     def create(cls):
         self = File()
-        blob = yield self._build_file_blocks(b'')
-        blob = [blob]
-        blob = ejson_dumps(blob).encode()
+        if cls.inline_threshold > 0:
+            blob = [inline_group(b'')]
+        else:
+            blocks = yield self._build_file_blocks(b'')
+            blob = [blocks]
+        raw_blob = ejson_dumps(blob).encode()
         self.encryptor = generate_sym_key()
-        encrypted_blob = self.encryptor.encrypt(blob)
+        encrypted_blob = self.encryptor.encrypt(raw_blob)
         encrypted_blob = to_jsonb64(encrypted_blob)
         vlob = yield Effect(EVlobCreate(encrypted_blob))
         self.id = vlob['id']
@@ -72,9 +234,37 @@ class File:
         self.dirty = True
         self.version = 0
         self.modifications = []
+        self._block_index = BlockIndex(blob, self.get_version())
         File.files[self.id] = self
         return self
 
+    @do
+    def copy(self):
+        """
+        Create a new file sharing the blocks of this one, only the block map is
+        written. Blocks are never modified in place so both files diverge on
+        their next writes.
+        """
+        yield self.flush()
+        index = yield self._get_block_index()
+        block_ids = yield self.get_blocks()
+        yield Effect(EBlockReference(block_ids))
+        copy = File()
+        raw_blob = self._dump_block_index(index)
+        copy.encryptor = generate_sym_key()
+        encrypted_blob = copy.encryptor.encrypt(raw_blob)
+        encrypted_blob = to_jsonb64(encrypted_blob)
+        vlob = yield Effect(EVlobCreate(encrypted_blob))
+        copy.id = vlob['id']
+        copy.read_trust_seed = vlob['read_trust_seed']
+        copy.write_trust_seed = vlob['write_trust_seed']
+        copy.dirty = True
+        copy.version = 0
+        copy.modifications = []
+        copy._block_index = BlockIndex([index.slice(0, len(index))], copy.get_version())
+        File.files[copy.id] = copy
+        return copy
+
     @classmethod
     @do
     def load(cls, id, key, read_trust_seed, write_trust_seed, version=None):
@@ -106,71 +296,194 @@ class File:
 
     @do
     def get_blocks(self):
-        blocks = yield self._find_matching_blocks()
-        block_ids = []
-        # TODO keep pre_excluded_blocks ? (block with size=0)
-        for blocks_and_key in blocks['pre_excluded_blocks'] + blocks['included_blocks']:
-            for block_properties in blocks_and_key['blocks']:
-                block_ids.append(block_properties['block'])
-        return block_ids
+        index = yield self._get_block_index()
+        return index.block_ids()
 
     def get_version(self):
         return self.version + 1 if self.dirty else self.version
 
     @do
-    def read(self, size=None, offset=0):
+    def read(self, size=None, offset=0, read_ahead=None):
+        """
+        Read `size` bytes from `offset`, `read_ahead` is the state of the reader
+        (defaults to the one shared by the reads by path).
+        """
+        if read_ahead is None:
+            read_ahead = self.read_ahead
         yield self.flush()
-        # Get data
-        matching_blocks = yield self._find_matching_blocks(size, offset)
-        data = matching_blocks['pre_included_data']
-        for blocks_and_key in matching_blocks['included_blocks']:
-            block_key = blocks_and_key['key']
-            decoded_block_key = from_jsonb64(block_key)
-            encryptor = load_sym_key(decoded_block_key)
-            for block_properties in blocks_and_key['blocks']:
-                block = yield Effect(EBlockRead(block_properties['block']))
-                # Decrypt
-                # TODO: clean this hack
-                if isinstance(block['content'], str):
-                    block_content = from_jsonb64(block['content'])
-                else:
-                    block_content = from_jsonb64(block['content'].decode())
-                chunk_data = encryptor.decrypt(block_content)
-                # Check integrity
-                assert digest(chunk_data) == block_properties['digest']
-                assert len(chunk_data) == block_properties['size']
-                data += chunk_data
-        data += matching_blocks['post_included_data']
+        index = yield self._get_block_index()
+        ranges = list(self._range_blocks(index, size, offset))
+        pieces = yield self._read_pieces(index, ranges)
+        data = concat(pieces)
+        next_block = ranges[-1][0] + 1 if ranges else len(index)
+        yield self._read_ahead(read_ahead, index, offset, len(data), next_block)
         return data
 
+    @do
+    def _read_ahead(self, state, index, offset, size, next_block):
+        sequential = offset == state.last_read_end
+        state.last_read_end = offset + size
+        if not sequential or not size or not self.read_ahead_size:
+            # Random access, stop reading ahead
+            state.window = 0
+            state.next = (None, 0)
+            return
+        # Window grows while the access pattern stays sequential
+        state.window = min(max(2 * state.window, 2 * size), self.read_ahead_size)
+        version, first = state.next
+        if version != index.version:
+            first = 0
+        block_index = max(next_block, first)
+        window_end = state.last_read_end + state.window
+        block_ids = []
+        while block_index < len(index) and index.start(block_index) < window_end:
+            if index.has_block(block_index):
+                block_ids.append(index.block_id(block_index))
+            block_index += 1
+        state.next = (index.version, block_index)
+        if block_ids:
+            yield background(Effect(EBlockPrefetch(block_ids)))
+
+    @do
+    def read_stream(self, consumer, size=None, offset=0):
+        """
+        Read the range block by block, passing each piece of data to `consumer`
+        (a function returning an effect) as soon as its block is fetched, so only
+        a window of `read_parallelism` blocks is held in memory at a time.
+        """
+        yield self.flush()
+        index = yield self._get_block_index()
+        ranges = list(self._range_blocks(index, size, offset))
+        total = 0
+        for window_start in range(0, len(ranges), self.read_parallelism):
+            window = ranges[window_start:window_start + self.read_parallelism]
+            pieces = yield self._read_pieces(index, window)
+            for piece in pieces:
+                total += len(piece)
+                yield consumer(piece)
+        return total
+
+    def _range_blocks(self, index, size, offset):
+        if size is None:
+            size = sys.maxsize
+        first, last = index.bounds(offset, size)
+        # The block straddling the end of the range is needed as well
+        if last < len(index) and index.start(last) < offset + size:
+            last += 1
+        for block_index in range(first, last):
+            start = index.start(block_index)
+            yield block_index, max(offset - start, 0), offset + size - start
+
+    @do
+    def _read_pieces(self, index, ranges):
+        # Blocks are fetched concurrently but returned in file order, inline data
+        # and holes (read as zeros) need no fetch
+        fetched = [block_index for block_index, _, _ in ranges if index.has_block(block_index)]
+        chunks = yield parallel((self._read_checked_block(index, block_index)
+                                 for block_index in fetched),
+                                limit=self.read_parallelism)
+        chunks = dict(zip(fetched, chunks))
+        pieces = []
+        for block_index, start, stop in ranges:
+            if block_index in chunks:
+                pieces.append(memoryview(chunks[block_index])[start:stop])
+            elif index.is_inline(block_index):
+                pieces.append(memoryview(index.data(block_index))[start:stop])
+            else:
+                size = index.length(block_index)
+                stop = size if stop is None else min(stop, size)
+                pieces.append(memoryview(bytes(stop - start)))
+        return pieces
+
+    @do
+    def _read_checked_block(self, index, block_index):
+        block_properties = index.entry(block_index)
+        chunk_data = yield self._read_block(block_properties, index.key(block_index))
+        # Digests are authenticated along with the block map, checking one needs
+        # neither the hash tree nor the other blocks
+        if (index.has_digest(block_index) and
+                hashlib.sha512(chunk_data).digest() != index.digest(block_index)):
+            raise BlockIntegrityError('Block %s is corrupted.' % block_properties['block'])
+        return chunk_data
+
+    @do
+    def get_root_hash(self, version=None):
+        """
+        Root hash of the block map of a version, no block is fetched so files and
+        versions can be compared cheaply.
+        """
+        yield self.flush()
+        if version is None or version == self.get_version():
+            index = yield self._get_block_index()
+        else:
+            if version < 1 or version > self.get_version():
+                raise FileError('bad_version', 'Bad version number.')
+            vlob = yield Effect(EVlobRead(self.id, self.read_trust_seed, version))
+            index = self._load_block_index(vlob, version)
+        return to_jsonb64(index.root)
+
+    @do
+    def verify(self, start=0, max_blocks=None, root=None):
+        """
+        Scrub at most `max_blocks` blocks from the `start`-th one and return the
+        offsets of the corrupted ones along with where to resume (None when
+        done). Scrubbing restarts from the beginning if `root` (as returned by
+        the previous call) shows the file changed in between.
+        """
+        yield self.flush()
+        index = yield self._get_block_index()
+        # Blocks are checked against the recorded root, which the entries must match
+        if index.stored_root is not None and index.tree.root != index.stored_root:
+            raise FileError('bad_root', 'Block map does not match its root hash.')
+        current_root = to_jsonb64(index.root)
+        if root is not None and root != current_root:
+            start = 0
+        stop = len(index) if max_blocks is None else min(len(index), start + max_blocks)
+        checked = [block_index for block_index in range(start, stop)
+                   if index.has_block(block_index)]
+        valid = yield parallel((self._verify_block(index, block_index)
+                                for block_index in checked),
+                               limit=self.read_parallelism)
+        return {'root': current_root,
+                'next': stop if stop < len(index) else None,
+                'corrupted': [index.start(block_index)
+                              for block_index, ok in zip(checked, valid) if not ok]}
+
+    @do
+    def _verify_block(self, index, block_index):
+        try:
+            chunk_data = yield self._read_block(index.entry(block_index), index.key(block_index))
+        except (BlockNotFound, InvalidTag):
+            return False
+        # Content of blocks with a legacy digest is unknown, being readable is all
+        # that can be checked
+        if not index.has_digest(block_index):
+            return True
+        return index.tree.verify(block_index, data_leaf_hash(chunk_data), index.root)
+
     def write(self, data, offset):
         self.modifications.append((self.write, data, offset))
 
     def truncate(self, length):
         self.modifications.append((self.truncate, length))
 
-    @do
-    def stat(self):
-        version = self.get_version()
-        vlob = yield Effect(EVlobRead(self.id, self.read_trust_seed, version))
-        encrypted_blob = vlob['blob']
-        encrypted_blob = from_jsonb64(encrypted_blob)
-        blob = self.encryptor.decrypt(encrypted_blob)
-        blob = ejson_loads(blob.decode())
-        size = 0
-        for blocks_and_key in blob:
-            for block in blocks_and_key['blocks']:
-                size += block['size']
+    def _get_pending_size(self, size):
+        # Size of the file once the pending modifications are applied
         for modification in self.modifications:
             if modification[0] == self.write:
                 end_offset = modification[2] + len(modification[1])
                 if size < end_offset:
                     size = end_offset
             elif modification[0] == self.truncate:
-                if size > modification[1]:
-                    size = modification[1]
+                size = modification[1]
             else:
                 raise NotImplementedError()
+        return size
+
+    @do
+    def stat(self):
+        index = yield self._get_block_index()
+        size = self._get_pending_size(index.size)
         # TODO don't provide atime field if we don't know it?
         # TODO real date
         return {
@@ -179,7 +492,7 @@ class File:
             'created': '2012-01-01T00:00:00',
             'updated': '2012-01-01T00:00:00',
             'size': size,
-            'version': vlob['version']
+            'version': index.version
         }
 
     # def history(self):
@@ -198,6 +511,7 @@ class File:
                                  self.write_trust_seed,
                                  self.version + 1,
                                  vlob['blob']))
+        self._block_index = None
         self.dirty = True
 
     @do
@@ -212,17 +526,18 @@ class File:
         new_encrypted_blob = self.encryptor.encrypt(new_blob)
         new_encrypted_blob = to_jsonb64(new_encrypted_blob)
         new_vlob = yield Effect(EVlobCreate(new_encrypted_blob))
-        del File.files[self.id]
+        File.files.rename(self, new_vlob['id'])
         self.id = new_vlob['id']
         self.read_trust_seed = new_vlob['read_trust_seed']
         self.write_trust_seed = new_vlob['write_trust_seed']
-        File.files[self.id] = self
         self.dirty = True
 
     @do
     def flush(self):
         if not self.modifications:
             return
+        index = yield self._get_block_index()
+        final_size = self._get_pending_size(index.size)
         # Merge all modifications to build final content
         builder = ContentBuilder()
         shortest_truncate = None
@@ -236,67 +551,165 @@ class File:
             else:
                 raise NotImplementedError()
         self.modifications = []
+        if final_size < self.inline_threshold:
+            yield self._flush_inline(index, builder, shortest_truncate, final_size)
+            return
+        # Blocks replaced along the way, including the ones created by this flush
+        released_block_ids = []
         # Truncate file
-        previous_block_ids = yield self.get_blocks()
-        if shortest_truncate is not None:
+        if shortest_truncate is not None and shortest_truncate < index.size:
             matching_blocks = yield self._find_matching_blocks(shortest_truncate, 0)
             blob = []
             blob += matching_blocks['included_blocks']
             new_blocks = yield self._build_file_blocks(matching_blocks['post_included_data'])
             blob.append(new_blocks)
-            blob = ejson_dumps(blob)
-            blob = blob.encode()
-            encrypted_blob = self.encryptor.encrypt(blob)
-            encrypted_blob = to_jsonb64(encrypted_blob)
-            yield Effect(EVlobUpdate(self.id,
-                                     self.write_trust_seed,
-                                     self.version + 1,
-                                     encrypted_blob))
-            self.dirty = True
+            released_block_ids += yield self._update_blob(blob)
         # Write new contents
-        for offset, content in builder.contents.items():
+        for offset, content in builder.items():
+            index = yield self._get_block_index()
+            if offset >= index.size:
+                # Append, existing blocks are kept as is and only the new data is chunked
+                blob = [index.slice(0, len(index))]
+                if offset > index.size:
+                    # Writing past the end of the file leaves a hole
+                    blob.append(hole_group(offset - index.size))
+                new_blocks = yield self._build_file_blocks(content)
+                yield self._update_blob(blob + [new_blocks])
+                continue
             matching_blocks = yield self._find_matching_blocks(len(content), offset)
-            new_data = matching_blocks['pre_excluded_data']
-            new_data += content
-            new_data += matching_blocks['post_excluded_data']
+            new_data = concat([matching_blocks['pre_excluded_data'],
+                               content,
+                               matching_blocks['post_excluded_data']])
             blob = []
             blob += matching_blocks['pre_excluded_blocks']
             new_blocks = yield self._build_file_blocks(new_data)
             blob.append(new_blocks)
             blob += matching_blocks['post_excluded_blocks']
-            blob = ejson_dumps(blob)
-            blob = blob.encode()
-            encrypted_blob = self.encryptor.encrypt(blob)
-            encrypted_blob = to_jsonb64(encrypted_blob)
-            yield Effect(EVlobUpdate(self.id,
-                                     self.write_trust_seed,
-                                     self.version + 1,
-                                     encrypted_blob))
-            self.dirty = True
-        # Clean blocks
-        current_block_ids = yield self.get_blocks()
-        for block_id in previous_block_ids:
-            if block_id not in current_block_ids:
-                try:
-                    yield Effect(EBlockDelete(block_id))
-                except BlockNotFound:
-                    pass
+            released_block_ids += yield self._update_blob(blob)
+        released_block_ids += yield self._pack_tail()
+        index = yield self._get_block_index()
+        if index.size < final_size:
+            # Extended by truncate, the new space is a hole
+            yield self._update_blob([index.slice(0, len(index)),
+                                     hole_group(final_size - index.size)])
+        released_block_ids += yield self._promote_inline_data()
+        yield self._release_blocks(released_block_ids)
+
+    @do
+    def _release_blocks(self, released_block_ids):
+        # Each occurrence holds a reference given deduplicated blocks can appear
+        # several times, the synchronizer only deletes them with the last one
+        if released_block_ids:
+            # Actual deletion is left to the synchronizer garbage collection
+            yield Effect(EBlockRelease(released_block_ids))
+
+    @do
+    def _flush_inline(self, index, builder, shortest_truncate, final_size):
+        # Small file, its whole content is rewritten in the blob without any block
+        ranges = list(self._range_blocks(index, shortest_truncate, 0))
+        pieces = yield self._read_pieces(index, ranges)
+        data = bytearray(concat(pieces))
+        for offset, content in builder.items():
+            if len(data) < offset:
+                data += bytes(offset - len(data))
+            data[offset:offset + len(content)] = content
+        data += bytes(final_size - len(data))
+        released_block_ids = yield self._update_blob([inline_group(bytes(data))])
+        yield self._release_blocks(released_block_ids)
+
+    @do
+    def _promote_inline_data(self):
+        # Inline data moves to blocks once the file grows past the threshold
+        index = yield self._get_block_index()
+        inline = [block_index for block_index in range(len(index))
+                  if index.is_inline(block_index)]
+        if not inline:
+            return []
+        blob = []
+        start = 0
+        for block_index in inline:
+            blob.append(index.slice(start, block_index))
+            new_blocks = yield self._build_file_blocks(index.data(block_index))
+            blob.append(new_blocks)
+            start = block_index + 1
+        blob.append(index.slice(start, len(index)))
+        released_block_ids = yield self._update_blob(blob)
+        return released_block_ids
+
+    @do
+    def _pack_tail(self):
+        # Appends leave small blocks at the end of the file, they are packed
+        # together once they are enough to fill a block
+        index = yield self._get_block_index()
+        min_block_size = self.chunker.min_block_size
+        start = len(index)
+        while (start > 0 and not index.is_hole(start - 1) and
+               index.length(start - 1) < min_block_size):
+            start -= 1
+        if len(index) - start < 2 or index.size - index.start(start) < min_block_size:
+            return []
+        ranges = [(block_index, 0, None) for block_index in range(start, len(index))]
+        pieces = yield self._read_pieces(index, ranges)
+        new_blocks = yield self._build_file_blocks(concat(pieces))
+        released_block_ids = yield self._update_blob([index.slice(0, start), new_blocks])
+        return released_block_ids
+
+    def _undersized_runs(self, index):
+        # Runs of consecutive blocks smaller than the chunker would make them,
+        # typically left by small writes, each one can be merged into full blocks
+        min_block_size = self.chunker.min_block_size
+        runs = []
+        for block_index in [block_index for block_index, size in enumerate(index.sizes)
+                            if size < min_block_size and index.has_block(block_index)]:
+            if runs and runs[-1][1] == block_index:
+                runs[-1][1] += 1
+            else:
+                runs.append([block_index, block_index + 1])
+        return [(start, stop) for start, stop in runs if stop - start > 1]
+
+    @do
+    def compact(self, threshold=1):
+        """
+        Rechunk the runs of undersized blocks if there are at least `threshold`
+        of them, return the number of blocks replaced.
+        """
+        yield self.flush()
+        index = yield self._get_block_index()
+        runs = self._undersized_runs(index)
+        replaced = sum(stop - start for start, stop in runs)
+        if not runs or replaced < threshold:
+            return 0
+        blob = []
+        previous_stop = 0
+        for start, stop in runs:
+            blob.append(index.slice(previous_stop, start))
+            pieces = yield self._read_pieces(index, [(block_index, 0, None)
+                                                     for block_index in range(start, stop)])
+            new_blocks = yield self._build_file_blocks(concat(pieces))
+            blob.append(new_blocks)
+            previous_stop = stop
+        blob.append(index.slice(previous_stop, len(index)))
+        released_block_ids = yield self._update_blob(blob)
+        yield self._release_blocks(released_block_ids)
+        return replaced
 
     @do
     def commit(self):
         yield self.flush()
+        if self.compaction_threshold:
+            # Fragmented files are compacted before their blocks are uploaded
+            yield self.compact(self.compaction_threshold)
         block_ids = yield self.get_blocks()
         for block_id in block_ids:
             yield Effect(EBlockSynchronize(block_id))
         new_vlob = yield Effect(EVlobSynchronize(self.id))
         if new_vlob:
             if new_vlob is not True:
-                del File.files[self.id]
+                File.files.rename(self, new_vlob['id'])
                 self.id = new_vlob['id']
                 self.read_trust_seed = new_vlob['read_trust_seed']
                 self.write_trust_seed = new_vlob['write_trust_seed']
                 new_vlob = self.get_vlob()
-                File.files[self.id] = self
             self.version += 1
         self.dirty = False
         return new_vlob
@@ -306,35 +719,38 @@ class File:
         already_synchronized = False
         self.modifications = []
         block_ids = yield self.get_blocks()
-        for block_id in block_ids:
-            try:
-                yield Effect(EBlockDelete(block_id))
-            except BlockNotFound:
-                already_synchronized = True
+        yield Effect(EBlockRelease(block_ids))
         try:
             yield Effect(EVlobDelete(self.id))
         except VlobNotFound:
             already_synchronized = True
+        self._block_index = None
         self.dirty = False
         return not already_synchronized
 
     @do
     def _build_file_blocks(self, data):
         # Create chunks
-        chunk_size = 4096  # TODO modify size
-        chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+        chunks = self.chunker.split(data)
         # Force a chunk even if the data is empty
         if not chunks:
             chunks = [b'']
+        if self.dedup_secret:
+            blob = yield self._build_deduplicated_file_blocks(chunks)
+            return blob
         encryptor = generate_sym_key()
         blocks = []
         for chunk in chunks:
-            cypher_chunk = encryptor.encrypt(chunk)
+            payload, compression = self._compress_chunk(chunk)
+            cypher_chunk = encryptor.encrypt(payload)
             cypher_chunk = to_jsonb64(cypher_chunk)
             block_id = yield Effect(EBlockCreate(cypher_chunk))
-            blocks.append({'block': block_id,
-                           'digest': digest(chunk),
-                           'size': len(chunk)})
+            block_properties = {'block': block_id,
+                                'digest': digest(chunk),
+                                'size': len(chunk)}
+            if compression:
+                block_properties['compression'] = compression
+            blocks.append(block_properties)
         # New vlob atom
         block_key = to_jsonb64(encryptor.key)
         blob = {'blocks': blocks,
@@ -342,64 +758,151 @@ class File:
         self.dirty = True
         return blob
 
+    def _compress_chunk(self, chunk):
+        # Chunks not shrunk by the compression are stored raw
+        if self.compressor is None:
+            return chunk, None
+        compressed = self.compressor.compress(chunk)
+        if len(compressed) >= len(chunk):
+            return chunk, None
+        return compressed, self.compressor.algorithm
+
+    @do
+    def _build_deduplicated_file_blocks(self, chunks):
+        # Convergent encryption: key and id only depend on the chunk content (and
+        # the dedup secret) so identical chunks end up in the same block
+        blocks = []
+        for chunk in chunks:
+            encryptor = derive_sym_key(self.dedup_secret, chunk)
+            payload, compression = self._compress_chunk(chunk)
+            # Compressed and raw payloads of the same chunk must not share a block
+            block_id = hashlib.sha256(encryptor.key + (compression or '').encode()).hexdigest()
+            cypher_chunk = encryptor.encrypt(payload)
+            cypher_chunk = to_jsonb64(cypher_chunk)
+            block_id = yield Effect(EBlockCreate(cypher_chunk, block_id))
+            block_properties = {'block': block_id,
+                                'digest': digest(chunk),
+                                'key': to_jsonb64(encryptor.key),
+                                'size': len(chunk)}
+            if compression:
+                block_properties['compression'] = compression
+            blocks.append(block_properties)
+        blob = {'blocks': blocks,
+                'key': None}
+        self.dirty = True
+        return blob
+
+    @do
+    def _get_block_index(self):
+        version = self.get_version()
+        if self._block_index is None or self._block_index.version != version:
+            vlob = yield Effect(EVlobRead(self.id, self.read_trust_seed, version))
+            self._block_index = self._load_block_index(vlob, version)
+        return self._block_index
+
+    def _load_block_index(self, vlob, version):
+        encrypted_blob = from_jsonb64(vlob['blob'])
+        blob = self.encryptor.decrypt(encrypted_blob)
+        return BlockIndex.loads(blob, version)
+
+    def _dump_block_index(self, index):
+        if len(index) > self.compact_block_map_threshold:
+            return index.to_bytes()
+        return index.dumps()
+
+    @do
+    def _update_blob(self, blob):
+        """
+        Write the new block map, made of groups and slices of the current block
+        index for the existing blocks, and return the ids of the blocks dropped.
+        """
+        index = BlockIndex(blob)
+        dropped_block_ids = []
+        if self._block_index is not None:
+            dropped_block_ids = self._block_index.dropped_block_ids(blob)
+        raw_blob = self._dump_block_index(index)
+        encrypted_blob = self.encryptor.encrypt(raw_blob)
+        encrypted_blob = to_jsonb64(encrypted_blob)
+        yield Effect(EVlobUpdate(self.id,
+                                 self.write_trust_seed,
+                                 self.version + 1,
+                                 encrypted_blob))
+        self.dirty = True
+        # New block map is already known, no need to read it back
+        index.version = self.get_version()
+        self._block_index = index
+        return dropped_block_ids
+
+    @do
+    def _read_block(self, block_properties, key):
+        block = yield Effect(EBlockRead(block_properties['block']))
+        # TODO: clean this hack
+        if isinstance(block['content'], str):
+            block_content = from_jsonb64(block['content'])
+        else:
+            block_content = from_jsonb64(block['content'].decode())
+        encryptor = load_sym_key(from_jsonb64(key))
+        block_content = encryptor.decrypt(block_content)
+        if 'compression' in block_properties:
+            block_content = decompress(block_properties['compression'], block_content)
+        return block_content
+
     @do
     def _find_matching_blocks(self, size=None, offset=0):
         if size is None:
             size = sys.maxsize
-        pre_excluded_blocks = []
-        post_excluded_blocks = []
-        version = self.get_version()
-        vlob = yield Effect(EVlobRead(self.id, self.read_trust_seed, version))
-        blob = vlob['blob']
-        encrypted_blob = from_jsonb64(blob)
-        blob = self.encryptor.decrypt(encrypted_blob)
-        blob = ejson_loads(blob.decode())
-        pre_excluded_blocks = []
-        included_blocks = []
-        post_excluded_blocks = []
-        cursor = 0
+        index = yield self._get_block_index()
+        first, last = index.bounds(offset, size)
         pre_excluded_data = b''
         pre_included_data = b''
         post_included_data = b''
         post_excluded_data = b''
-        for blocks_and_key in blob:
-            block_key = blocks_and_key['key']
-            decoded_block_key = from_jsonb64(block_key)
-            encryptor = load_sym_key(decoded_block_key)
-            for block_properties in blocks_and_key['blocks']:
-                cursor += block_properties['size']
-                if cursor <= offset:
-                    if len(pre_excluded_blocks) and pre_excluded_blocks[-1]['key'] == block_key:
-                        pre_excluded_blocks[-1]['blocks'].append(block_properties)
-                    else:
-                        pre_excluded_blocks.append({'blocks': [block_properties], 'key': block_key})
-                elif cursor > offset and cursor - block_properties['size'] < offset:
-                    delta = cursor - offset
-                    block = yield Effect(EBlockRead(block_properties['block']))
-                    content = from_jsonb64(block['content'])
-                    block_data = encryptor.decrypt(content)
-                    pre_excluded_data = block_data[:-delta]
-                    pre_included_data = block_data[-delta:][:size]
-                    if size < len(block_data[-delta:]):
-                        post_excluded_data = block_data[-delta:][size:]
-                elif cursor > offset and cursor <= offset + size:
-                    if len(included_blocks) and included_blocks[-1]['key'] == block_key:
-                        included_blocks[-1]['blocks'].append(block_properties)
-                    else:
-                        included_blocks.append({'blocks': [block_properties], 'key': block_key})
-                elif cursor > offset + size and cursor - block_properties['size'] < offset + size:
-                    delta = offset + size - (cursor - block_properties['size'])
-                    block = yield Effect(EBlockRead(block_properties['block']))
-                    content = from_jsonb64(block['content'])
-                    block_data = encryptor.decrypt(content)
-                    post_included_data = block_data[:delta]
-                    post_excluded_data = block_data[delta:]
-                else:
-                    if len(post_excluded_blocks) and post_excluded_blocks[-1]['key'] == block_key:
-                        post_excluded_blocks[-1]['blocks'].append(block_properties)
-                    else:
-                        post_excluded_blocks.append({'blocks': [block_properties],
-                                                     'key': block_key})
+        # Blocks straddling the beginning and the end of the range
+        head = None
+        tail = None
+        included_start = first
+        if first < len(index) and index.start(first) < offset:
+            head = first
+            included_start = first + 1
+        post_excluded_start = max(last, included_start)
+        if post_excluded_start < len(index) and index.start(post_excluded_start) < offset + size:
+            tail = post_excluded_start
+        straddling = [block_index for block_index in (head, tail)
+                      if block_index is not None and index.has_block(block_index)]
+        blocks_data = yield parallel([self._read_block(index.entry(block_index),
+                                                       index.key(block_index))
+                                      for block_index in straddling])
+        blocks_data = dict(zip(straddling, blocks_data))
+        for block_index in (head, tail):
+            if block_index is not None and index.is_inline(block_index):
+                blocks_data[block_index] = index.data(block_index)
+        pre_excluded_blocks = [index.slice(0, first)]
+        included_blocks = [index.slice(included_start, last)]
+        # Straddling holes are split instead of being materialized as zeros
+        post_hole = []
+        # Slices are views on the blocks, data is copied only once by the caller
+        if head is not None:
+            delta = index.ends[head] - offset
+            if head in blocks_data:
+                block_data = memoryview(blocks_data[head])
+                pre_excluded_data = block_data[:-delta]
+                pre_included_data = block_data[-delta:][:size]
+                if size < len(block_data[-delta:]):
+                    post_excluded_data = block_data[-delta:][size:]
+            else:
+                pre_excluded_blocks.append(hole_group(index.length(head) - delta))
+                if size < delta:
+                    post_hole = [hole_group(delta - size)]
+        if tail is not None:
+            delta = offset + size - index.start(tail)
+            if tail in blocks_data:
+                block_data = memoryview(blocks_data[tail])
+                post_included_data = block_data[:delta]
+                post_excluded_data = block_data[delta:]
+            else:
+                included_blocks.append(hole_group(delta))
+                post_hole = [hole_group(index.length(tail) - delta)]
+            post_excluded_start += 1
         return {
             'pre_excluded_blocks': pre_excluded_blocks,
             'pre_excluded_data': pre_excluded_data,
@@ -407,5 +910,5 @@ class File:
             'included_blocks': included_blocks,
             'post_included_data': post_included_data,
             'post_excluded_data': post_excluded_data,
-            'post_excluded_blocks': post_excluded_blocks
+            'post_excluded_blocks': post_hole + [index.slice(post_excluded_start, len(index))]
         }
@@ -1,12 +1,16 @@
 from copy import deepcopy
+from itertools import count
 
 import attr
 from effect2 import TypeDispatcher, do, Effect
 
-from parsec.core.file import File
+from parsec.base import ERegisterEvent, EUnregisterEvent
+from parsec.core.client_connection import EClientId
+from parsec.core.file import File, ReadAhead
 from parsec.core.manifest import UserManifest
 from parsec.core.identity import EIdentityGet
-from parsec.exceptions import FileNotFound, IdentityNotLoadedError, ManifestError, ManifestNotFound
+from parsec.exceptions import (
+    FileError, FileNotFound, IdentityNotLoadedError, ManifestError, ManifestNotFound)
 
 
 @attr.s
@@ -41,11 +45,39 @@ class EFileCreate:
     path = attr.ib()
 
 
+@attr.s
+class EFileOpen:
+    path = attr.ib()
+
+
+@attr.s
+class EFileClose:
+    handle = attr.ib()
+
+
+@attr.s
+class EFileHandlesRelease:
+    # Listener of the `client_disconnected` event
+    event = attr.ib()
+    client = attr.ib()
+
+
+# File IO is either by path or by handle (path being None)
 @attr.s
 class EFileRead:
     path = attr.ib()
     offset = attr.ib(default=0)
     size = attr.ib(default=None)
+    handle = attr.ib(default=None)
+
+
+@attr.s
+class EFileReadStream:
+    path = attr.ib()
+    consumer = attr.ib()
+    offset = attr.ib(default=0)
+    size = attr.ib(default=None)
+    handle = attr.ib(default=None)
 
 
 @attr.s
@@ -53,12 +85,14 @@ class EFileWrite:
     path = attr.ib()
     content = attr.ib()
     offset = attr.ib()
+    handle = attr.ib(default=None)
 
 
 @attr.s
 class EFileTruncate:
     path = attr.ib()
     length = attr.ib()
+    handle = attr.ib(default=None)
 
 
 @attr.s
@@ -74,6 +108,20 @@ class EFileRestore:
     version = attr.ib(default=None)
 
 
+@attr.s
+class EFileRootHash:
+    path = attr.ib()
+    version = attr.ib(default=None)
+
+
+@attr.s
+class EFileVerify:
+    path = attr.ib()
+    start = attr.ib(default=0)
+    max_blocks = attr.ib(default=None)
+    root = attr.ib(default=None)
+
+
 @attr.s
 class EFolderCreate:
     path = attr.ib()
@@ -90,6 +138,12 @@ class EMove:
     dst = attr.ib()
 
 
+@attr.s
+class ECopy:
+    src = attr.ib()
+    dst = attr.ib()
+
+
 @attr.s
 class EDelete:
     path = attr.ib()
@@ -100,10 +154,28 @@ class EUndelete:
     vlob = attr.ib()
 
 
+@attr.s
+class FileHandle:
+    file = attr.ib()
+    # Manifest holding the file at `path`, updates of the file are recorded there
+    manifest = attr.ib()
+    path = attr.ib()
+    in_dustbin = attr.ib(default=False)
+    # Each reader gets its own read-ahead, interleaved readers would defeat it otherwise
+    read_ahead = attr.ib(default=attr.Factory(ReadAhead))
+
+    def record_update(self):
+        path = None if self.in_dustbin else self.path
+        self.manifest.record_file_update(self.file.id, path)
+
+
 class FSComponent:
 
     def __init__(self):
         self.user_manifest = None
+        # Files opened by handle (resolved once at open time), by client connection
+        self.handles = {}
+        self._handle_ids = count(1)
 
     @do
     def perform_synchronize(self, intent):
@@ -144,21 +216,66 @@ class FSComponent:
             yield file.discard()
             raise ex
 
+    @do
+    def perform_file_open(self, intent):
+        opened = yield self._open_file(intent.path)
+        client = yield Effect(EClientId())
+        if client not in self.handles:
+            # Handles are released along with the connection of their client
+            yield Effect(ERegisterEvent(EFileHandlesRelease, 'client_disconnected', client))
+            self.handles[client] = {}
+        # The handle keeps the file loaded until it is closed
+        File.files.acquire(opened.file)
+        handle = next(self._handle_ids)
+        self.handles[client][handle] = opened
+        return handle
+
+    @do
+    def perform_file_close(self, intent):
+        client = yield Effect(EClientId())
+        opened = self._get_handle(client, intent.handle)
+        del self.handles[client][intent.handle]
+        File.files.release(opened.file)
+
+    @do
+    def perform_file_handles_release(self, intent):
+        for opened in self.handles.pop(intent.client, {}).values():
+            File.files.release(opened.file)
+        yield Effect(EUnregisterEvent(EFileHandlesRelease, 'client_disconnected', intent.client))
+
     @do
     def perform_file_read(self, intent):
-        file = yield self._get_file(intent.path)
-        ret = yield file.read(intent.size, intent.offset)
+        opened = yield self._get_opened_file(intent.path, intent.handle)
+        file = opened.file
+        File.files.acquire(file)
+        try:
+            ret = yield file.read(intent.size, intent.offset, opened.read_ahead)
+        finally:
+            File.files.release(file)
+        return ret
+
+    @do
+    def perform_file_read_stream(self, intent):
+        opened = yield self._get_opened_file(intent.path, intent.handle)
+        file = opened.file
+        File.files.acquire(file)
+        try:
+            ret = yield file.read_stream(intent.consumer, intent.size, intent.offset)
+        finally:
+            File.files.release(file)
         return ret
 
     @do
     def perform_file_write(self, intent):
-        file = yield self._get_file(intent.path)
-        file.write(intent.content, intent.offset)
+        opened = yield self._get_opened_file(intent.path, intent.handle)
+        opened.file.write(intent.content, intent.offset)
+        opened.record_update()
 
     @do
     def perform_file_truncate(self, intent):
-        file = yield self._get_file(intent.path)
-        file.truncate(intent.length)
+        opened = yield self._get_opened_file(intent.path, intent.handle)
+        opened.file.truncate(intent.length)
+        opened.record_update()
 
     @do
     def perform_file_history(self, intent):
@@ -168,8 +285,25 @@ class FSComponent:
 
     @do
     def perform_file_restore(self, intent):
+        opened = yield self._open_file(intent.path)
+        yield opened.file.restore(intent.version)
+        opened.record_update()
+
+    @do
+    def perform_file_root_hash(self, intent):
         file = yield self._get_file(intent.path)
-        yield file.restore(intent.version)
+        root = yield file.get_root_hash(intent.version)
+        return root
+
+    @do
+    def perform_file_verify(self, intent):
+        file = yield self._get_file(intent.path)
+        File.files.acquire(file)
+        try:
+            ret = yield file.verify(intent.start, intent.max_blocks, intent.root)
+        finally:
+            File.files.release(file)
+        return ret
 
     @do
     def perform_folder_create(self, intent):
@@ -187,6 +321,17 @@ class FSComponent:
         user_manifest = yield self._get_manifest()
         user_manifest.move(intent.src, intent.dst)
 
+    @do
+    def perform_copy(self, intent):
+        file = yield self._get_file(intent.src)
+        copy = yield file.copy()
+        user_manifest = yield self._get_manifest()
+        try:
+            user_manifest.add_file(intent.dst, copy.get_vlob())
+        except (ManifestError, ManifestNotFound) as ex:
+            yield copy.discard()
+            raise ex
+
     @do
     def perform_delete(self, intent):
         user_manifest = yield self._get_manifest()
@@ -199,11 +344,19 @@ class FSComponent:
 
     @do
     def _get_file(self, path, group=None):
+        opened = yield self._open_file(path, group)
+        return opened.file
+
+    @do
+    def _open_file(self, path, group=None):
+        in_dustbin = False
         try:
-            properties = yield self._get_properties(path=path, group=group)
+            manifest, properties = yield self._get_properties(path=path, group=group)
         except FileNotFound:
             try:
-                properties = yield self._get_properties(path=path, dustbin=True, group=group)
+                manifest, properties = yield self._get_properties(path=path, dustbin=True,
+                                                                  group=group)
+                in_dustbin = True
             except FileNotFound:
                 raise FileNotFound('Vlob not found.')
         if not properties:
@@ -212,7 +365,25 @@ class FSComponent:
                                properties['key'],
                                properties['read_trust_seed'],
                                properties['write_trust_seed'])
-        return file
+        return FileHandle(file, manifest, path, in_dustbin)
+
+    def _get_handle(self, client, handle):
+        # Clients can only use their own handles
+        try:
+            return self.handles[client][handle]
+        except KeyError:
+            raise FileError('bad_handle', 'Unknown file handle.')
+
+    @do
+    def _get_opened_file(self, path, handle=None):
+        # Handles skip the path resolution through the manifests
+        if handle is not None:
+            client = yield Effect(EClientId())
+            return self._get_handle(client, handle)
+        opened = yield self._open_file(path)
+        # Reads by path share the read-ahead of the file
+        opened.read_ahead = opened.file.read_ahead
+        return opened
 
     @do
     def _get_manifest(self, group=None):
@@ -233,9 +404,10 @@ class FSComponent:
 
     @do
     def _get_properties(self, path=None, id=None, dustbin=False, group=None):  # TODO refactor?
+        # Return the manifest holding the properties along with them
         if group and not id and not path:
             manifest = yield self._get_manifest(group)
-            return manifest.get_vlob()
+            return manifest, manifest.get_vlob()
         user_manifest = yield self._get_manifest()
         groups = [group] if group else [None] + list(user_manifest.get_group_vlobs())
         for current_group in groups:
@@ -243,14 +415,14 @@ class FSComponent:
             if dustbin:
                 for item in manifest.dustbin:
                     if path == item['path'] or id == item['id']:
-                        return deepcopy(item)
+                        return manifest, deepcopy(item)
             else:
                 if path in manifest.entries:
-                    return deepcopy(manifest.entries[path])
+                    return manifest, deepcopy(manifest.entries[path])
                 elif id:
                     for entry in manifest.entries.values():  # TODO bad complexity
                         if entry and entry['id'] == id:
-                            return deepcopy(entry)
+                            return manifest, deepcopy(entry)
         raise FileNotFound('File not found.')
 
     def get_dispatcher(self):
@@ -261,14 +433,21 @@ class FSComponent:
             EManifestHistory: self.perform_manifest_history,
             EManifestRestore: self.perform_manifest_restore,
             EFileCreate: self.perform_file_create,
+            EFileOpen: self.perform_file_open,
+            EFileClose: self.perform_file_close,
+            EFileHandlesRelease: self.perform_file_handles_release,
             EFileRead: self.perform_file_read,
+            EFileReadStream: self.perform_file_read_stream,
             EFileWrite: self.perform_file_write,
             EFileTruncate: self.perform_file_truncate,
             EFileHistory: self.perform_file_history,
             EFileRestore: self.perform_file_restore,
+            EFileRootHash: self.perform_file_root_hash,
+            EFileVerify: self.perform_file_verify,
             EFolderCreate: self.perform_folder_create,
             EStat: self.perform_stat,
             EMove: self.perform_move,
+            ECopy: self.perform_copy,
             EDelete: self.perform_delete,
             EUndelete: self.perform_undelete
         })
@@ -1,12 +1,17 @@
-from marshmallow import fields, validate
+from marshmallow import ValidationError, fields, validate, validates_schema
 from effect2 import Effect, do
 
+from parsec.core.client_connection import EClientSend
 from parsec.core.fs import (
     ESynchronize, EGroupCreate, EDustbinShow, EManifestHistory, EManifestRestore, EFileCreate,
-    EFileRead, EFileWrite, EFileTruncate, EFileHistory, EFileRestore, EFolderCreate, EStat, EMove,
-    EDelete, EUndelete
+    EFileOpen, EFileClose, EFileRead, EFileReadStream, EFileWrite, EFileTruncate, EFileHistory,
+    EFileRestore, EFileRootHash, EFileVerify, EFolderCreate, EStat, EMove, ECopy, EDelete, EUndelete
 )
-from parsec.tools import UnknownCheckedSchema
+from parsec.tools import UnknownCheckedSchema, ejson_dumps, to_jsonb64
+
+
+# Maximum amount of file data carried by a single streamed `file_read` frame
+STREAM_FRAME_SIZE = 65536
 
 
 class PathOnlySchema(UnknownCheckedSchema):
@@ -31,20 +36,32 @@ class cmd_RESTORE_MANIFEST_Schema(UnknownCheckedSchema):
     version = fields.Integer(missing=None, validate=lambda n: n >= 1)
 
 
-class cmd_FILE_READ_Schema(UnknownCheckedSchema):
-    path = fields.String(required=True)
+class PathOrHandleSchema(UnknownCheckedSchema):
+    path = fields.String(missing=None)
+    handle = fields.Int(missing=None)
+
+    @validates_schema
+    def check_path_or_handle(self, data):
+        if (data.get('path') is None) == (data.get('handle') is None):
+            raise ValidationError('Either path or handle is required.')
+
+
+class cmd_FILE_CLOSE_Schema(UnknownCheckedSchema):
+    handle = fields.Int(required=True)
+
+
+class cmd_FILE_READ_Schema(PathOrHandleSchema):
     offset = fields.Int(missing=0, validate=validate.Range(min=0))
     size = fields.Int(missing=None, validate=validate.Range(min=0))
+    stream = fields.Boolean(missing=False)
 
 
-class cmd_FILE_WRITE_Schema(UnknownCheckedSchema):
-    path = fields.String(required=True)
+class cmd_FILE_WRITE_Schema(PathOrHandleSchema):
     offset = fields.Int(missing=0, validate=validate.Range(min=0))
     content = fields.Base64Bytes(required=True)
 
 
-class cmd_FILE_TRUNCATE_Schema(UnknownCheckedSchema):
-    path = fields.String(required=True)
+class cmd_FILE_TRUNCATE_Schema(PathOrHandleSchema):
     length = fields.Int(required=True, validate=validate.Range(min=0))
 
 
@@ -54,6 +71,18 @@ class cmd_FILE_HISTORY_Schema(UnknownCheckedSchema):
     last_version = fields.Int(missing=None, validate=validate.Range(min=1))
 
 
+class cmd_FILE_ROOT_HASH_Schema(UnknownCheckedSchema):
+    path = fields.String(required=True)
+    version = fields.Int(missing=None, validate=validate.Range(min=1))
+
+
+class cmd_FILE_VERIFY_Schema(UnknownCheckedSchema):
+    path = fields.String(required=True)
+    start = fields.Int(missing=0, validate=validate.Range(min=0))
+    max_blocks = fields.Int(missing=None, validate=validate.Range(min=0))
+    root = fields.String(missing=None)
+
+
 class cmd_FILE_RESTORE_Schema(UnknownCheckedSchema):
     path = fields.String(required=True)
     version = fields.Int(required=True, validate=validate.Range(min=1))
@@ -111,9 +140,37 @@ def api_file_create(msg):
     return {'status': 'ok'}
 
 
+@do
+def api_file_open(msg):
+    msg = PathOnlySchema().load(msg)
+    handle = yield Effect(EFileOpen(**msg))
+    return {'status': 'ok', 'handle': handle}
+
+
+@do
+def api_file_close(msg):
+    msg = cmd_FILE_CLOSE_Schema().load(msg)
+    yield Effect(EFileClose(**msg))
+    return {'status': 'ok'}
+
+
+@do
+def send_file_read_frames(data):
+    for start in range(0, len(data), STREAM_FRAME_SIZE):
+        frame = {'status': 'ok',
+                 'content': to_jsonb64(data[start:start + STREAM_FRAME_SIZE]),
+                 'more': True}
+        yield Effect(EClientSend(ejson_dumps(frame)))
+
+
 @do
 def api_file_read(msg):
     msg = cmd_FILE_READ_Schema().load(msg)
+    if msg.pop('stream'):
+        # Content is sent as `more` frames while blocks are fetched, the final
+        # reply closes the stream
+        yield Effect(EFileReadStream(consumer=send_file_read_frames, **msg))
+        return {'status': 'ok', 'content': '', 'more': False}
     content = yield Effect(EFileRead(**msg))
     return {'status': 'ok', 'content': content}
 
@@ -147,6 +204,21 @@ def api_file_restore(msg):
     return {'status': 'ok'}
 
 
+@do
+def api_file_root_hash(msg):
+    msg = cmd_FILE_ROOT_HASH_Schema().load(msg)
+    root = yield Effect(EFileRootHash(**msg))
+    return {'status': 'ok', 'root': root}
+
+
+@do
+def api_file_verify(msg):
+    msg = cmd_FILE_VERIFY_Schema().load(msg)
+    scrub = yield Effect(EFileVerify(**msg))
+    scrub['status'] = 'ok'
+    return scrub
+
+
 @do
 def api_folder_create(msg):
     msg = PathOnlySchema().load(msg)
@@ -169,6 +241,13 @@ def api_move(msg):
     return {'status': 'ok'}
 
 
+@do
+def api_file_copy(msg):
+    msg = cmd_MOVE_Schema().load(msg)
+    yield Effect(ECopy(**msg))
+    return {'status': 'ok'}
+
+
 @do
 def api_delete(msg):
     msg = PathOnlySchema().load(msg)
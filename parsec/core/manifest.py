@@ -1,3 +1,4 @@
+from collections.abc import MutableMapping
 from copy import deepcopy
 from functools import partial
 from datetime import datetime
@@ -7,13 +8,244 @@ from effect2 import Effect, do
 
 from parsec.core.file import File
 from parsec.core.synchronizer import (
-    EUserVlobSynchronize, EUserVlobRead, EUserVlobUpdate, EVlobCreate, EVlobList, EVlobRead,
-    EVlobUpdate, EVlobSynchronize)
+    EUserVlobSynchronize, EUserVlobRead, EUserVlobUpdate, EVlobCreate, EVlobRead,
+    EVlobUpdate, EVlobHead, EVlobSynchronize)
 from parsec.crypto import generate_sym_key, load_private_key, load_sym_key
 from parsec.exceptions import FileError, ManifestError, ManifestNotFound, VlobNotFound
 from parsec.tools import event_handler, from_jsonb64, to_jsonb64, ejson_loads, ejson_dumps
 
 
+# Paths of the tree not being entries themselves (e.g. missing parent folders)
+_ABSENT = object()
+
+
+class EntryNode:
+
+    __slots__ = ('entry', 'children')
+
+    def __init__(self, entry=_ABSENT):
+        self.entry = entry
+        self.children = None
+
+
+class EntryTree(MutableMapping):
+
+    """
+    Manifest entries as a `{path: entry}` mapping stored as a directory tree,
+    each node mapping the names of its children to their nodes.
+
+    A lookup walks the path components, listing a folder only visits its
+    children and moving a subtree only reattaches its root node.
+
+    Paths set, deleted or moved since creation are kept in `touched`, each one
+    standing for itself and everything below it.
+    """
+
+    def __init__(self, entries=()):
+        self._root = EntryNode()
+        self._length = 0
+        self.touched = set()
+        self.update(entries)
+        self.touched.clear()
+
+    @staticmethod
+    def _split(path):
+        return [] if path == '/' else path.split('/')[1:]
+
+    def _find(self, path):
+        node = self._root
+        for name in self._split(path):
+            if not node.children or name not in node.children:
+                return None
+            node = node.children[name]
+        return node
+
+    def _find_parent(self, path, create=False):
+        names = self._split(path)
+        if not names:
+            raise KeyError(path)
+        node = self._root
+        for name in names[:-1]:
+            if not node.children or name not in node.children:
+                if not create:
+                    return None, names[-1]
+                if node.children is None:
+                    node.children = {}
+                node.children[name] = EntryNode()
+            node = node.children[name]
+        return node, names[-1]
+
+    def _prune(self, path):
+        # Drop the absent nodes left without children up to the root
+        names = self._split(path)
+        while names:
+            parent, name = self._find_parent('/' + '/'.join(names))
+            node = parent.children[name]
+            if node.entry is not _ABSENT or node.children:
+                return
+            del parent.children[name]
+            names.pop()
+
+    def __getitem__(self, path):
+        node = self._find(path)
+        if node is None or node.entry is _ABSENT:
+            raise KeyError(path)
+        return node.entry
+
+    def __setitem__(self, path, entry):
+        if path == '/':
+            node = self._root
+        else:
+            parent, name = self._find_parent(path, create=True)
+            if parent.children is None:
+                parent.children = {}
+            node = parent.children.setdefault(name, EntryNode())
+        if node.entry is _ABSENT:
+            self._length += 1
+        node.entry = entry
+        self.touched.add(path)
+
+    def __delitem__(self, path):
+        node = self._find(path)
+        if node is None or node.entry is _ABSENT:
+            raise KeyError(path)
+        node.entry = _ABSENT
+        self._length -= 1
+        self._prune(path)
+        self.touched.add(path)
+
+    def __iter__(self):
+        for path, _ in self.walk('/'):
+            yield path
+
+    def __len__(self):
+        return self._length
+
+    def __deepcopy__(self, memo):
+        # Rebuilt from its entries, the nodes refer to the `_ABSENT` sentinel
+        copy = EntryTree(deepcopy(dict(self), memo))
+        copy.touched = set(self.touched)
+        return copy
+
+    def walk(self, path):
+        """Yield `(path, entry)` for `path` and every entry below it."""
+        node = self._find(path)
+        if node is None:
+            return
+        stack = [(path, node)]
+        while stack:
+            path, node = stack.pop()
+            if node.entry is not _ABSENT:
+                yield path, node.entry
+            if node.children:
+                prefix = path if path.endswith('/') else path + '/'
+                stack.extend((prefix + name, child)
+                             for name, child in reversed(list(node.children.items())))
+
+    def children(self, path):
+        """Return the `{name: entry}` of the entries right below `path`."""
+        node = self._find(path)
+        if node is None or not node.children:
+            return {}
+        return {name: child.entry for name, child in node.children.items()
+                if child.entry is not _ABSENT}
+
+    def move(self, old_path, new_path):
+        """Move the entry at `old_path` along with everything below it."""
+        old_parent, old_name = self._find_parent(old_path)
+        node = old_parent.children[old_name] if old_parent and old_parent.children else None
+        if node is None or node.entry is _ABSENT:
+            raise KeyError(old_path)
+        new_parent, new_name = self._find_parent(new_path, create=True)
+        if new_parent.children and new_name in new_parent.children:
+            # Absent node already holding entries, they are merged one by one
+            moved = list(self.walk(old_path))
+            for path, _ in reversed(moved):
+                del self[path]
+            for path, entry in moved:
+                self[new_path + path[len(old_path):]] = entry
+            return
+        del old_parent.children[old_name]
+        if new_parent.children is None:
+            new_parent.children = {}
+        new_parent.children[new_name] = node
+        self._prune(os.path.dirname(old_path))
+        self.touched.update((old_path, new_path))
+
+    def touched_roots(self):
+        """Return the touched paths not below another touched path."""
+        roots = []
+        for path in self.touched:
+            parent = path
+            while parent != '/':
+                parent = os.path.dirname(parent)
+                if parent in self.touched:
+                    break
+            else:
+                roots.append(path)
+        return roots
+
+
+def _dustbin_key(entry):
+    return tuple(sorted(entry.items()))
+
+
+def mapping_changes(old, new, keys):
+    """
+    Return the `added`/`changed`/`removed` changes between the `old` and `new`
+    mappings for the given keys, in the format of `Manifest.diff`.
+    """
+    changes = {'added': {}, 'changed': {}, 'removed': {}}
+    for key in sorted(keys):
+        old_value = old.get(key, _ABSENT)
+        new_value = new.get(key, _ABSENT)
+        if old_value is _ABSENT:
+            if new_value is not _ABSENT:
+                changes['added'][key] = new_value
+        elif new_value is _ABSENT:
+            changes['removed'][key] = old_value
+        elif old_value != new_value:
+            changes['changed'][key] = (old_value, new_value)
+    return changes
+
+
+def apply_changes(target, changes):
+    """
+    Apply changes made from a common ancestor to the `target` mapping, entries
+    changed on both sides being kept under a `-conflict`, `-deleted` or
+    `-recreated` suffixed key.
+    """
+    for key, value in changes['added'].items():
+        if key in target and target[key] != value:
+            target[key + '-conflict'] = target[key]
+        target[key] = value
+    for key, (old_value, new_value) in changes['changed'].items():
+        if key in target:
+            current_value = target[key]
+            if current_value not in [old_value, new_value]:
+                target[key + '-conflict'] = current_value
+            target[key] = new_value
+        else:
+            target[key + '-deleted'] = new_value
+    for key, value in changes['removed'].items():
+        if key in target:
+            if target[key] != value:
+                target[key + '-recreated'] = target[key]
+            del target[key]
+
+
+def apply_dustbin_changes(dustbin, changes):
+    keys = {_dustbin_key(entry) for entry in dustbin}
+    for entry in changes['added']:
+        key = _dustbin_key(entry)
+        if key not in keys:
+            dustbin.append(entry)
+            keys.add(key)
+    removed_keys = {_dustbin_key(entry) for entry in changes['removed']}
+    if removed_keys & keys:
+        dustbin[:] = [entry for entry in dustbin if _dustbin_key(entry) not in removed_keys]
+
+
 class Manifest:
 
     def __init__(self, id=None):
@@ -21,24 +253,68 @@ class Manifest:
         self.version = 0
         self.entries = {'/': None}
         self.dustbin = []
-        self.original_manifest = {'entries': deepcopy(self.entries),
+        # Files with changes to commit, by vlob id, along with their last known path
+        self.modified_files = {}
+        # Changes outside of the entries (dustbin, groups, keys), the ones to the
+        # entries are listed in `entries.touched`
+        self.modified = False
+        self.original_manifest = {'entries': deepcopy(dict(self.entries)),
                                   'dustbin': deepcopy(self.dustbin),
                                   'versions': {}}
         self.handler = partial(event_handler, self.reload, reset=False)
 
+    @property
+    def entries(self):
+        return self._entries
+
+    @entries.setter
+    def entries(self, entries):
+        self._entries = EntryTree(entries)
+
+    @property
+    def original_manifest(self):
+        return self._original_manifest
+
+    @original_manifest.setter
+    def original_manifest(self, manifest):
+        # Last synchronized entries are walked to find what changed below a path
+        manifest = dict(manifest)
+        manifest['entries'] = EntryTree(manifest['entries'])
+        self._original_manifest = manifest
+
     def reload(self):
         raise NotImplementedError()
 
+    def record_file_update(self, vlob_id, path=None):
+        """Mark the file `vlob_id` at `path` to be committed with the manifest."""
+        if path is None:
+            # Files of the dustbin are synchronized on their own
+            self.modified = True
+        else:
+            self.modified_files[vlob_id] = path
+
+    def modified_entries(self):
+        """Return the `(path, entry)` of the files with changes to commit, by path."""
+        modified_entries = []
+        for vlob_id, path in self.modified_files.items():
+            entry = self.entries.get(path)
+            if not entry or entry['id'] != vlob_id:
+                # Moved by a merge or through a handle opened before the move
+                path, entry = next(((path, entry) for path, entry in self.entries.items()
+                                    if entry and entry['id'] == vlob_id), (None, None))
+                if path is None:
+                    continue
+            modified_entries.append((path, entry))
+        return sorted(modified_entries, key=lambda item: item[0])
+
+    def clear_modified(self):
+        self.modified_files.clear()
+        self.modified = False
+        self.entries.touched.clear()
+
     @do
     def is_dirty(self):
-        dump = yield self.dumps()
-        current_manifest = ejson_loads(dump)
-        diff = self.diff(self.original_manifest, current_manifest)
-        for category in diff.keys():
-            for operation in diff[category].keys():
-                if diff[category][operation]:
-                    return True
-        return False
+        return self.modified or bool(self.modified_files) or bool(self.entries.touched)
 
     def diff(self, old_manifest, new_manifest):
         diff = {}
@@ -62,14 +338,10 @@ class Manifest:
                     removed[key] = value
             diff.update({category: {'added': added, 'changed': changed, 'removed': removed}})
         # Dustbin
-        added = []
-        removed = []
-        for vlob in new_manifest['dustbin']:
-            if vlob not in old_manifest['dustbin']:
-                added.append(vlob)
-        for vlob in old_manifest['dustbin']:
-            if vlob not in new_manifest['dustbin']:
-                removed.append(vlob)
+        old_keys = {_dustbin_key(vlob) for vlob in old_manifest['dustbin']}
+        new_keys = {_dustbin_key(vlob) for vlob in new_manifest['dustbin']}
+        added = [vlob for vlob in new_manifest['dustbin'] if _dustbin_key(vlob) not in old_keys]
+        removed = [vlob for vlob in old_manifest['dustbin'] if _dustbin_key(vlob) not in new_keys]
         diff.update({'dustbin': {'added': added, 'removed': removed}})
         return diff
 
@@ -78,32 +350,43 @@ class Manifest:
         for category in diff.keys():
             if category in ['dustbin', 'versions']:
                 continue
-            for path, entry in diff[category]['added'].items():
-                if path in new_manifest[category] and new_manifest[category][path] != entry:
-                    new_manifest[category][path + '-conflict'] = new_manifest[category][path]
-                new_manifest[category][path] = entry
-            for path, entries in diff[category]['changed'].items():
-                old_entry, new_entry = entries
-                if path in new_manifest[category]:
-                    current_entry = new_manifest[category][path]
-                    if current_entry not in [old_entry, new_entry]:
-                        new_manifest[category][path + '-conflict'] = current_entry
-                    new_manifest[category][path] = new_entry
-                else:
-                    new_manifest[category][path + '-deleted'] = new_entry
-            for path, entry in diff[category]['removed'].items():
-                if path in new_manifest[category]:
-                    if new_manifest[category][path] != entry:
-                        new_manifest[category][path + '-recreated'] = new_manifest[category][path]
-                    del new_manifest[category][path]
-        for entry in diff['dustbin']['added']:
-            if entry not in new_manifest['dustbin']:
-                new_manifest['dustbin'].append(entry)
-        for entry in diff['dustbin']['removed']:
-            if entry in new_manifest['dustbin']:
-                new_manifest['dustbin'].remove(entry)
+            apply_changes(new_manifest[category], diff[category])
+        apply_dustbin_changes(new_manifest['dustbin'], diff['dustbin'])
         return new_manifest
 
+    def local_changes(self):
+        """
+        Return the changes since the last synchronized manifest, in the format
+        of `diff`, only looking at the paths touched since then.
+        """
+        base = self.original_manifest
+        paths = set()
+        for root in self.entries.touched_roots():
+            paths.update(path for path, _ in self.entries.walk(root))
+            paths.update(path for path, _ in base['entries'].walk(root))
+        changes = {'entries': mapping_changes(base['entries'], self.entries, paths)}
+        base_keys = {_dustbin_key(entry) for entry in base['dustbin']}
+        keys = {_dustbin_key(entry) for entry in self.dustbin}
+        changes['dustbin'] = {
+            'added': [entry for entry in self.dustbin if _dustbin_key(entry) not in base_keys],
+            'removed': [entry for entry in base['dustbin'] if _dustbin_key(entry) not in keys]
+        }
+        return changes
+
+    def merge(self, manifest):
+        """
+        Three-way merge of the local changes into `manifest`, a newer version of
+        the last synchronized one, with the conflict resolution of `patch`.
+
+        `manifest` is left untouched but its entries are shared rather than copied.
+        """
+        changes = self.local_changes()
+        merged = {'entries': EntryTree(manifest['entries']),
+                  'dustbin': list(manifest['dustbin'])}
+        apply_changes(merged['entries'], changes['entries'])
+        apply_dustbin_changes(merged['dustbin'], changes['dustbin'])
+        return merged
+
     def diff_versions(self, old_version=None, new_version=None):
         raise NotImplementedError()
 
@@ -132,16 +415,18 @@ class Manifest:
 
     @do
     def get_vlobs_versions(self):
-        versions = {}
-        for entry in [self.entries[entry] for entry in sorted(self.entries)] + self.dustbin:
-            if entry:
-                try:
-                    vlob = yield Effect(EVlobRead(entry['id'], entry['read_trust_seed']))
-                except VlobNotFound:
-                    versions[entry['id']] = None
-                else:
-                    versions[entry['id']] = vlob['version']
-        return versions
+        """
+        Return the versions of the files vlobs (None for the ones not found).
+
+        They are fetched at once without their blobs, the synchronizer answers
+        for the vlobs with local changes.
+        """
+        entries = [self.entries[entry] for entry in sorted(self.entries)] + self.dustbin
+        heads = {entry['id']: entry['read_trust_seed'] for entry in entries if entry}
+        if not heads:
+            return {}
+        head_versions = yield Effect(EVlobHead(heads))
+        return {vlob_id: head_versions.get(vlob_id) for vlob_id in heads}
 
     @do
     def dumps(self, original_manifest=False):
@@ -149,7 +434,7 @@ class Manifest:
             return ejson_dumps(self.original_manifest)
         else:
             versions = yield self.get_vlobs_versions()
-            return ejson_dumps({'entries': self.entries,
+            return ejson_dumps({'entries': dict(self.entries),
                                 'dustbin': self.dustbin,
                                 'versions': versions})
 
@@ -161,6 +446,7 @@ class Manifest:
         if path in self.entries:
             raise ManifestError('already_exists', 'File already exists.')
         self.entries[path] = vlob
+        self.modified_files[vlob['id']] = path
 
     def move(self, old_path, new_path):
         old_path = '/' + old_path.strip('/')
@@ -172,22 +458,23 @@ class Manifest:
             raise ManifestNotFound('Destination Folder not found.')
         if new_path in self.entries:
             raise ManifestError('already_exists', 'File already exists.')
-        for entry, vlob in self.entries.items():
-            if entry.startswith(old_path):
-                new_entry = new_path + entry[len(old_path):]
-                self.entries[new_entry] = vlob
-                del self.entries[entry]
+        if old_path == '/' or new_path.startswith(old_path + '/'):
+            raise ManifestError('invalid_path', 'Cannot move a folder into itself.')
+        self.entries.move(old_path, new_path)
+        for vlob_id, path in self.modified_files.items():
+            if path == old_path or path.startswith(old_path + '/'):
+                self.modified_files[vlob_id] = new_path + path[len(old_path):]
 
     @do
     def delete(self, path):
         path = '/' + path.strip('/')
-        deleted_paths = []
-        for entry in self.entries:
-            if entry == path or entry.startswith(path + '/') or path == '/':
-                deleted_paths.append(entry)
+        deleted_paths = [deleted_path for deleted_path, _ in self.entries.walk(path)]
+        if not deleted_paths:
+            raise ManifestNotFound('File or directory not found.')
         for path in deleted_paths:
             entry = self.entries[path]
             if entry:
+                self.modified_files.pop(entry['id'], None)
                 file = yield File.load(entry['id'],
                                        entry['key'],
                                        entry['read_trust_seed'],
@@ -199,8 +486,6 @@ class Manifest:
                     self.dustbin.append(dustbin_entry)
             if path != '/':
                 del self.entries[path]
-        if not deleted_paths:
-            raise ManifestNotFound('File or directory not found.')
 
     def undelete_file(self, vlob):
         for entry in self.dustbin:
@@ -208,10 +493,11 @@ class Manifest:
                 path = entry['path']
                 if path in self.entries:
                     raise ManifestError('already_exists', 'Restore path already used.')
-                del entry['path']
-                del entry['removed_date']
+                entry = {key: value for key, value in entry.items()
+                         if key not in ('path', 'removed_date')}
                 self.dustbin[:] = [item for item in self.dustbin if item['id'] != vlob]
                 self.entries[path] = entry
+                self.modified_files[entry['id']] = path
                 folder = os.path.dirname(path)
                 self.create_folder(folder, parents=True)
                 return
@@ -226,7 +512,9 @@ class Manifest:
             raise ManifestNotFound('File not found.')
         file = yield File.load(**entry)
         yield file.reencrypt()
-        self.entries[path] = file.get_vlob()
+        new_vlob = file.get_vlob()
+        self.entries[path] = new_vlob
+        self.modified_files[new_vlob['id']] = path
 
     @do
     def stat(self, path):
@@ -241,15 +529,9 @@ class Manifest:
         else:
             # Skip mtime and size given that they are too complicated to provide for folder
             # TODO time except mtime
-            children = {}
-            for entry in self.entries:
-                if (entry != path and
-                        entry.startswith(path) and
-                        entry.count('/', len(path) + 1) == 0):
-                    children[os.path.basename(entry)] = deepcopy(self.entries[entry])
             return {
                 'type': 'folder',
-                'children': sorted(list(children.keys()))
+                'children': sorted(self.entries.children(path))
             }
 
     def create_folder(self, path, parents=False):
@@ -373,17 +655,19 @@ class GroupManifest(Manifest):
         if not reset and vlob['version'] <= self.version:
             return
         new_manifest = ejson_loads(content.decode())
-        backup_new_manifest = deepcopy(new_manifest)
         consistency = yield self.check_consistency(new_manifest)
         if not consistency:
             raise ManifestError('not_consistent', 'Group manifest not consistent.')
+        merged_manifest = new_manifest if reset else self.merge(new_manifest)
+        self.entries = merged_manifest['entries']
         if not reset:
-            diff = yield self.diff_versions()
-            new_manifest = self.patch(new_manifest, diff)
-        self.entries = new_manifest['entries']
-        self.dustbin = new_manifest['dustbin']
+            # Local changes reapplied by the merge are still to be committed
+            self.entries.touched.update(merged_manifest['entries'].touched)
+        self.dustbin = merged_manifest['dustbin']
         self.version = vlob['version']
-        self.original_manifest = backup_new_manifest
+        self.original_manifest = new_manifest
+        if reset:
+            self.clear_modified()
         versions = new_manifest['versions']
         file_vlob = None
         for vlob_id, version in sorted(versions.items()):
@@ -415,25 +699,27 @@ class GroupManifest(Manifest):
         is_dirty = yield self.is_dirty()
         if self.version != 0 and not is_dirty:
             return
+        modified_entries = self.modified_entries()
         # Update manifest entries with new file vlobs (dustbin entries are already commited)
-        vlob_list = yield Effect(EVlobList())
-        for entry in self.entries.values():
-            if entry and entry['id'] in vlob_list:
-                file = yield File.load(entry['id'],
-                                       entry['key'],
-                                       entry['read_trust_seed'],
-                                       entry['write_trust_seed'])
-                new_vlob = yield file.commit()
-                if new_vlob and new_vlob is not True:
-                    entry['id'] = new_vlob['id']
-                    entry['read_trust_seed'] = new_vlob['read_trust_seed']
-                    entry['write_trust_seed'] = new_vlob['write_trust_seed']
+        for path, entry in modified_entries:
+            file = yield File.load(entry['id'],
+                                   entry['key'],
+                                   entry['read_trust_seed'],
+                                   entry['write_trust_seed'])
+            new_vlob = yield file.commit()
+            if new_vlob and new_vlob is not True:
+                # Entries may be shared with the original manifest, they are replaced
+                self.entries[path] = dict(entry,
+                                          id=new_vlob['id'],
+                                          read_trust_seed=new_vlob['read_trust_seed'],
+                                          write_trust_seed=new_vlob['write_trust_seed'])
         # Commit manifest
         blob = yield self.dumps()
         encrypted_blob = self.encryptor.encrypt(blob.encode())
         encrypted_blob = to_jsonb64(encrypted_blob)
         yield Effect(EVlobUpdate(self.id, self.write_trust_seed, self.version + 1, encrypted_blob))
         self.original_manifest = ejson_loads(blob)
+        self.clear_modified()
         new_vlob = yield Effect(EVlobSynchronize(self.id))
         if new_vlob:
             if new_vlob is not True:
@@ -453,6 +739,7 @@ class GroupManifest(Manifest):
                 yield file.reencrypt()
                 new_vlob = file.get_vlob()
                 self.entries[path] = new_vlob
+                self.modified_files[new_vlob['id']] = path
         for index, entry in enumerate(self.dustbin):
             entry = deepcopy(entry)
             path = entry['path']
@@ -475,6 +762,7 @@ class GroupManifest(Manifest):
         self.read_trust_seed = new_vlob['read_trust_seed']
         self.write_trust_seed = new_vlob['write_trust_seed']
         self.version = 0
+        self.modified = True
 
     @do
     def restore(self, version=None):
@@ -500,7 +788,7 @@ class UserManifest(Manifest):
         except ManifestNotFound:
             self.version = 0
             self.group_manifests = {}
-            self.original_manifest = {'entries': deepcopy(self.entries),
+            self.original_manifest = {'entries': deepcopy(dict(self.entries)),
                                       'dustbin': deepcopy(self.dustbin),
                                       'groups': deepcopy(self.group_manifests),
                                       'versions': {}}
@@ -545,11 +833,24 @@ class UserManifest(Manifest):
             return ejson_dumps(manifest)
         else:
             versions = yield self.get_vlobs_versions()
-            return ejson_dumps({'entries': self.entries,
+            return ejson_dumps({'entries': dict(self.entries),
                                 'dustbin': self.dustbin,
                                 'groups': self.get_group_vlobs(),
                                 'versions': versions})
 
+    def local_changes(self):
+        changes = super().local_changes()
+        base_groups = self.original_manifest['groups']
+        groups = self.get_group_vlobs()
+        changes['groups'] = mapping_changes(base_groups, groups, set(base_groups) | set(groups))
+        return changes
+
+    def merge(self, manifest):
+        merged = super().merge(manifest)
+        merged['groups'] = dict(manifest['groups'])
+        apply_changes(merged['groups'], self.local_changes()['groups'])
+        return merged
+
     def get_group_vlobs(self, group=None):
         if group:
             groups = [group]
@@ -576,6 +877,7 @@ class UserManifest(Manifest):
         except KeyError:
             raise ManifestNotFound('Group not found.')
         yield group_manifest.reencrypt()
+        self.modified = True
 
     @do
     def create_group_manifest(self, group):
@@ -583,6 +885,7 @@ class UserManifest(Manifest):
             raise ManifestError('already_exists', 'Group already exists.')
         group_manifest = yield GroupManifest.create()
         self.group_manifests[group] = group_manifest
+        self.modified = True
 
     @do
     def import_group_vlob(self, group, vlob):
@@ -591,6 +894,7 @@ class UserManifest(Manifest):
             yield self.group_manifests[group].reload(reset=False)
         group_manifest = yield GroupManifest.load(**vlob)
         self.group_manifests[group] = group_manifest
+        self.modified = True
 
     def remove_group(self, group):
         # TODO deleted group is not moved in dusbin, but hackers could continue to read/write files
@@ -598,6 +902,7 @@ class UserManifest(Manifest):
             del self.group_manifests[group]
         except KeyError:
             raise ManifestNotFound('Group not found.')
+        self.modified = True
 
     @do
     def reload(self, reset=False):
@@ -609,20 +914,22 @@ class UserManifest(Manifest):
         if not reset and vlob['version'] <= self.version:
             return
         new_manifest = ejson_loads(content.decode())
-        backup_new_manifest = deepcopy(new_manifest)
         consistency = yield self.check_consistency(new_manifest)
         if not consistency:
             raise ManifestError('not_consistent', 'User manifest not consistent.')
+        merged_manifest = new_manifest if reset else self.merge(new_manifest)
+        self.entries = merged_manifest['entries']
         if not reset:
-            diff = yield self.diff_versions()
-            new_manifest = self.patch(new_manifest, diff)
-        self.entries = new_manifest['entries']
-        self.dustbin = new_manifest['dustbin']
+            # Local changes reapplied by the merge are still to be committed
+            self.entries.touched.update(merged_manifest['entries'].touched)
+        self.dustbin = merged_manifest['dustbin']
         self.version = vlob['version']
         self.group_manifests = {}
-        for group, group_vlob in new_manifest['groups'].items():
+        for group, group_vlob in merged_manifest['groups'].items():
             self.import_group_vlob(group, group_vlob)
-        self.original_manifest = backup_new_manifest
+        self.original_manifest = new_manifest
+        if reset:
+            self.clear_modified()
         versions = new_manifest['versions']
         file_vlob = None
         for vlob_id, version in sorted(versions.items()):
@@ -658,8 +965,8 @@ class UserManifest(Manifest):
         is_dirty = yield self.is_dirty()
         if self.version != 0 and not is_dirty:
             return
+        modified_entries = self.modified_entries()
         # Update manifest with new group vlobs
-        vlob_list = yield Effect(EVlobList())
         if recursive:
             for group_manifest in self.group_manifests.values():
                 new_vlob = yield group_manifest.commit()
@@ -668,23 +975,25 @@ class UserManifest(Manifest):
                     new_vlob['key'] = old_vlob['key']
                     group_manifest.update_vlob(new_vlob)
         # Update manifest entries with new file vlobs (dustbin entries are already commited)
-        for entry in self.entries.values():
-            if entry and entry['id'] in vlob_list:
-                file = yield File.load(entry['id'],
-                                       entry['key'],
-                                       entry['read_trust_seed'],
-                                       entry['write_trust_seed'])
-                new_vlob = yield file.commit()
-                if new_vlob and new_vlob is not True:
-                    entry['id'] = new_vlob['id']
-                    entry['read_trust_seed'] = new_vlob['read_trust_seed']
-                    entry['write_trust_seed'] = new_vlob['write_trust_seed']
+        for path, entry in modified_entries:
+            file = yield File.load(entry['id'],
+                                   entry['key'],
+                                   entry['read_trust_seed'],
+                                   entry['write_trust_seed'])
+            new_vlob = yield file.commit()
+            if new_vlob and new_vlob is not True:
+                # Entries may be shared with the original manifest, they are replaced
+                self.entries[path] = dict(entry,
+                                          id=new_vlob['id'],
+                                          read_trust_seed=new_vlob['read_trust_seed'],
+                                          write_trust_seed=new_vlob['write_trust_seed'])
         # Commit manifest
         blob = yield self.dumps()
         encrypted_blob = self.encryptor.pub_key.encrypt(blob.encode())
         encrypted_blob = to_jsonb64(encrypted_blob)
         yield Effect(EUserVlobUpdate(self.version + 1, encrypted_blob))
         self.original_manifest = ejson_loads(blob)
+        self.clear_modified()
         synchronized = yield Effect(EUserVlobSynchronize())
         if synchronized:
             self.version += 1
@@ -0,0 +1,96 @@
+import hashlib
+
+from parsec.tools import from_jsonb64
+
+
+# Domain separation prefixes, so a leaf can never be mistaken for a node
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+HOLE_PREFIX = b'\x02'
+
+
+def leaf_hash(size, data_digest=None):
+    """
+    Hash of a block from its size and raw digest, holes have no digest.
+    """
+    size = size.to_bytes(8, 'big')
+    if data_digest is None:
+        return hashlib.sha256(HOLE_PREFIX + size).digest()
+    return hashlib.sha256(LEAF_PREFIX + size + data_digest).digest()
+
+
+def block_leaf_hash(block_properties):
+    if 'digest' not in block_properties:
+        return leaf_hash(block_properties['size'])
+    return leaf_hash(block_properties['size'], from_jsonb64(block_properties['digest']))
+
+
+def data_leaf_hash(data):
+    return leaf_hash(len(data), hashlib.sha512(data).digest())
+
+
+def node_hash(left, right):
+    return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+
+def verify_proof(leaf, proof, root):
+    """
+    Check a leaf against a root hash given the sibling hashes from the leaf to
+    the root, each as a `(sibling_is_left, hash)` pair.
+    """
+    current = leaf
+    for sibling_is_left, sibling in proof:
+        if sibling_is_left:
+            current = node_hash(sibling, current)
+        else:
+            current = node_hash(current, sibling)
+    return current == root
+
+
+class MerkleTree:
+
+    """
+    Binary hash tree over the blocks of a file.
+
+    Levels are kept from the leaves up, a node without sibling is promoted as is
+    to the next level. The root only depends on the sizes and digests of the
+    blocks, so identical contents chunked the same way have the same root.
+    """
+
+    def __init__(self, leaves):
+        self.levels = [list(leaves)]
+        while len(self.levels[-1]) > 1:
+            level = self.levels[-1]
+            parents = [node_hash(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+            if len(level) % 2:
+                parents.append(level[-1])
+            self.levels.append(parents)
+
+    @classmethod
+    def from_blocks(cls, blocks):
+        return cls([block_leaf_hash(block_properties) for block_properties in blocks])
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    @property
+    def root(self):
+        if not self.levels[0]:
+            return hashlib.sha256(b'').digest()
+        return self.levels[-1][0]
+
+    def proof(self, index):
+        proof = []
+        for level in self.levels[:-1]:
+            sibling = index ^ 1
+            if sibling < len(level):
+                proof.append((sibling < index, level[sibling]))
+            index //= 2
+        return proof
+
+    def verify(self, index, leaf, root):
+        """
+        Check a leaf against a trusted `root`, comparing it with the root of
+        this very tree would only check the tree against itself.
+        """
+        return verify_proof(leaf, self.proof(index), root)
@@ -1,21 +1,28 @@
 import arrow
 import asyncio
+from collections import deque
 from uuid import uuid4
 
 import attr
 from cachetools import LRUCache
-from effect2 import Effect, TypeDispatcher, do, asyncio_perform
+from effect2 import Effect, TypeDispatcher, do, asyncio_perform, parallel, AsyncFunc
 
-from parsec.core.backend_vlob import EBackendVlobCreate, EBackendVlobUpdate, EBackendVlobRead
+from parsec.core.backend_vlob import (
+    EBackendVlobCreate, EBackendVlobUpdate, EBackendVlobRead, EBackendVlobHead)
 from parsec.core.backend_user_vlob import EBackendUserVlobUpdate, EBackendUserVlobRead
-from parsec.core.block import EBlockCreate as EBackendBlockCreate, EBlockRead as EBackendBlockRead
+from parsec.core.block import (
+    EBlockCreate as EBackendBlockCreate, EBlockExists as EBackendBlockExists,
+    EBlockRead as EBackendBlockRead)
 from parsec.core import fs
-from parsec.exceptions import BlockError, BlockNotFound, UserVlobNotFound, VlobNotFound
+from parsec.exceptions import (
+    BlockError, BlockNotFound, BlockAlreadyExists, UserVlobNotFound, VlobNotFound)
+from parsec.tools import logger
 
 
 @attr.s
 class EBlockCreate:
     content = attr.ib()
+    id = attr.ib(default=None)
 
 
 @attr.s
@@ -23,6 +30,26 @@ class EBlockRead:
     id = attr.ib()
 
 
+@attr.s
+class EBlockPrefetch:
+    ids = attr.ib()
+
+
+@attr.s
+class EBlockReference:
+    ids = attr.ib()
+
+
+@attr.s
+class EBlockRelease:
+    ids = attr.ib()
+
+
+@attr.s
+class EBlockGarbageCollect:
+    max_blocks = attr.ib(default=None)
+
+
 @attr.s
 class EBlockDelete:
     id = attr.ib()
@@ -90,6 +117,12 @@ class EVlobDelete:
     version = attr.ib(default=None)
 
 
+@attr.s
+class EVlobHead:
+    # Read trust seeds indexed by vlob id
+    vlobs = attr.ib()
+
+
 @attr.s
 class EVlobList:
     pass
@@ -110,13 +143,81 @@ class ECacheClean:
     pass
 
 
+@attr.s
+class ECacheStats:
+    pass
+
+
+class PayloadLRUCache(LRUCache):
+
+    """
+    LRU cache bounded by the total size in bytes of the payloads it holds
+    (`payload_field` of the cached dicts) instead of a number of entries.
+
+    Inserting a value larger than `maxsize` raises `ValueError`.
+    """
+
+    def __init__(self, maxsize, payload_field):
+        super().__init__(maxsize=maxsize, getsizeof=lambda value: len(value[payload_field]))
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getitem__(self, key):
+        try:
+            value = super().__getitem__(key)
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        return value
+
+    def popitem(self):
+        # Eviction looks the item up, which is not a hit
+        hits = self.hits
+        item = super().popitem()
+        self.hits = hits
+        self.evictions += 1
+        return item
+
+    def stats(self):
+        return {'size': self.currsize,
+                'max_size': self.maxsize,
+                'entries': len(self),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+
 class SynchronizerComponent:
 
-    def __init__(self, cache_size):
-        self.block_cache = LRUCache(maxsize=cache_size)
-        self.user_vlob_cache = LRUCache(maxsize=cache_size)
-        self.vlob_cache = LRUCache(maxsize=cache_size)
+    def __init__(self, block_cache_size, vlob_cache_size=None, user_vlob_cache_size=None,
+                 prefetch_budget=None):
+        # Cache sizes are in bytes, vlob caches default to the block cache size
+        if prefetch_budget is None:
+            prefetch_budget = block_cache_size // 2
+        if vlob_cache_size is None:
+            vlob_cache_size = block_cache_size
+        if user_vlob_cache_size is None:
+            user_vlob_cache_size = vlob_cache_size
+        self.block_cache = PayloadLRUCache(block_cache_size, 'content')
+        self.user_vlob_cache = PayloadLRUCache(user_vlob_cache_size, 'blob')
+        self.vlob_cache = PayloadLRUCache(vlob_cache_size, 'blob')
         self.blocks = {}
+        # Readers waiting for the blocks being fetched from the backend
+        self.block_fetches = {}
+        # Size of the prefetched blocks not read yet, bounded by the budget
+        self.prefetched = {}
+        self.prefetch_budget = prefetch_budget
+        # Max number of blocks prefetched concurrently
+        self.prefetch_parallelism = 8
+        # Reference count of the content-addressed or copied blocks, committed or not
+        self.block_references = {}
+        # Blocks released by the files, deleted in batches in the background
+        self.gc_queue = deque()
+        self.gc_batch_size = 100
+        self.gc_interval = 1
+        self.gc_task = None
         self.vlobs = {}
         self.user_vlob = None
         self.synchronization_idle_interval = 1
@@ -125,16 +226,31 @@ class SynchronizerComponent:
 
     async def startup(self, app):
         self.synchronization_task = asyncio.ensure_future(self.periodic_synchronization(app))
+        self.gc_task = asyncio.ensure_future(self.periodic_garbage_collect(app))
 
     async def shutdown(self, app):
         if self.synchronization_task:
             self.synchronization_task.cancel()
             self.synchronization_task = None
+        if self.gc_task:
+            self.gc_task.cancel()
+            self.gc_task = None
 
     @do
     def perform_block_create(self, intent):
         self.last_modified = arrow.utcnow()
-        block_id = uuid4().hex
+        if intent.id is None:
+            block_id = uuid4().hex
+        else:
+            # Content-addressed block, no need to store it again if we already know it.
+            # References are counted even once the block left the cache, a known
+            # but uncounted block is referenced by the file it was read for.
+            block_id = intent.id
+            known = block_id in self.blocks or block_id in self.block_cache
+            references = self.block_references.get(block_id, 1 if known else 0)
+            self.block_references[block_id] = references + 1
+            if known:
+                return block_id
         self.blocks[block_id] = {'id': block_id, 'content': intent.content}
         return block_id
 
@@ -143,23 +259,113 @@ class SynchronizerComponent:
         try:
             return self.blocks[intent.id]
         except KeyError:
+            pass
+        try:
+            block = self.block_cache[intent.id]
+        except KeyError:
+            block = yield self._fetch_block(intent.id)
+        # Prefetched block is no longer waiting to be read
+        self.prefetched.pop(intent.id, None)
+        return block
+
+    @do
+    def _fetch_block(self, block_id):
+        if block_id in self.block_fetches:
+            # Already being fetched (prefetch or concurrent read), wait for its outcome
+            return (yield AsyncFunc(self._wait_block_fetch(block_id)))
+        waiters = self.block_fetches[block_id] = []
+        try:
             try:
-                return self.block_cache[intent.id]
-            except KeyError:
-                try:
-                    block = yield Effect(EBackendBlockRead(intent.id))
-                    block = {'id': block.id, 'content': block.content}
-                except (BlockNotFound, BlockError):
-                    raise BlockNotFound('Block not found.')
-                try:
-                    self.block_cache[intent.id] = block
-                except ValueError:
-                    pass  # Value too large if cache is disabled
-                return block
+                block = yield Effect(EBackendBlockRead(block_id))
+                block = {'id': block.id, 'content': block.content}
+            except (BlockNotFound, BlockError):
+                raise BlockNotFound('Block not found.')
+            try:
+                self.block_cache[block_id] = block
+            except ValueError:
+                pass  # Value larger than the whole cache (or cache disabled)
+        except Exception as exc:
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(exc)
+            raise
+        else:
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(block)
+        finally:
+            del self.block_fetches[block_id]
+            # Fetch cancelled, so are the readers waiting for it
+            for waiter in waiters:
+                waiter.cancel()
+        return block
+
+    async def _wait_block_fetch(self, block_id):
+        waiter = asyncio.get_event_loop().create_future()
+        self.block_fetches[block_id].append(waiter)
+        return await waiter
+
+    @do
+    def perform_block_prefetch(self, intent):
+        # Prefetched blocks evicted from the cache before being read no longer count
+        for block_id in [block_id for block_id in self.prefetched
+                         if block_id not in self.block_cache]:
+            del self.prefetched[block_id]
+        block_ids = [block_id for block_id in intent.ids
+                     if block_id not in self.blocks and block_id not in self.block_cache]
+        yield parallel((self._prefetch_block(block_id) for block_id in block_ids),
+                       limit=self.prefetch_parallelism)
+
+    @do
+    def _prefetch_block(self, block_id):
+        if sum(self.prefetched.values()) >= self.prefetch_budget:
+            return  # Budget exhausted until the prefetched blocks are read or evicted
+        if block_id in self.block_fetches:
+            return  # Already on its way
+        try:
+            # Block ends up in the cache
+            block = yield self._fetch_block(block_id)
+        except Exception as exc:
+            # Prefetching is best effort, the actual read will report the error
+            logger.warning('Prefetch of block %s failed: %r' % (block_id, exc))
+            return
+        if block_id in self.block_cache:
+            self.prefetched[block_id] = len(block['content'])
+
+    @do
+    def perform_block_reference(self, intent):
+        # Blocks shared by several files are only deleted along with the last one,
+        # committed blocks are counted as well given they may be cached again later
+        for block_id in intent.ids:
+            self.block_references[block_id] = self.block_references.get(block_id, 1) + 1
+
+    @do
+    def perform_block_release(self, intent):
+        self.gc_queue.extend(intent.ids)
+
+    @do
+    def perform_block_garbage_collect(self, intent):
+        count = len(self.gc_queue)
+        if intent.max_blocks is not None:
+            count = min(count, intent.max_blocks)
+        for _ in range(count):
+            block_id = self.gc_queue.popleft()
+            try:
+                yield self.perform_block_delete(EBlockDelete(block_id))
+            except BlockNotFound:
+                pass  # Synchronized and no longer in cache
+        return count
 
     @do
     def perform_block_delete(self, intent):
         self.last_modified = arrow.utcnow()
+        references = self.block_references.get(intent.id, 1)
+        if references > 1:
+            # Content-addressed or copied block still used elsewhere
+            self.block_references[intent.id] = references - 1
+            return
+        self.block_references.pop(intent.id, None)
+        # Only the local copy is deleted, blocks are never removed from the backend
         try:
             del self.blocks[intent.id]
         except KeyError:
@@ -176,11 +382,22 @@ class SynchronizerComponent:
     def perform_block_synchronize(self, intent):
         if intent.id in self.blocks:
             block = self.blocks[intent.id]
-            yield Effect(EBackendBlockCreate(intent.id, block['content']))
+            # Content-addressed blocks may have been uploaded by someone else,
+            # checking first saves sending the whole block again
+            exists = False
+            if intent.id in self.block_references:
+                exists = yield Effect(EBackendBlockExists(intent.id))
+            if not exists:
+                try:
+                    yield Effect(EBackendBlockCreate(intent.id, block['content']))
+                except BlockAlreadyExists:
+                    # Uploaded by someone else in the meantime
+                    if intent.id not in self.block_references:
+                        raise
             try:
                 self.block_cache[intent.id] = block
             except ValueError:
-                pass  # Value too large if cache is disabled
+                pass  # Value larger than the whole cache (or cache disabled)
             del self.blocks[intent.id]
             return True
         return False
@@ -198,7 +415,7 @@ class SynchronizerComponent:
                 try:
                     self.user_vlob_cache[user_vlob['version']] = user_vlob
                 except ValueError:
-                    pass  # Value too large if cache is disabled
+                    pass  # Value larger than the whole cache (or cache disabled)
                 return user_vlob
 
     @do
@@ -229,7 +446,7 @@ class SynchronizerComponent:
             try:
                 self.user_vlob_cache[self.user_vlob['version']] = self.user_vlob
             except ValueError:
-                pass  # Value too large if cache is disabled
+                pass  # Value larger than the whole cache (or cache disabled)
             self.user_vlob = None
             return True
         return False
@@ -276,7 +493,7 @@ class SynchronizerComponent:
                                'blob': vlob['blob']}
                 self.vlob_cache[(intent.id, intent.version)] = cached_vlob
             except ValueError:
-                pass  # Value too large if cache is disabled
+                pass  # Value larger than the whole cache (or cache disabled)
             return vlob
 
     @do
@@ -300,6 +517,22 @@ class SynchronizerComponent:
             except KeyError:
                 raise VlobNotFound('Vlob not found.')
 
+    @do
+    def perform_vlob_head(self, intent):
+        # Current version of the vlobs, the ones not found being left out
+        versions = {}
+        remote_vlobs = {}
+        for vlob_id, trust_seed in intent.vlobs.items():
+            if vlob_id in self.vlobs:
+                versions[vlob_id] = self.vlobs[vlob_id]['version']
+            else:
+                remote_vlobs[vlob_id] = trust_seed
+        if remote_vlobs:
+            # Single command for all of them, no blob is fetched
+            heads = yield Effect(EBackendVlobHead(remote_vlobs))
+            versions.update((vlob_id, head.version) for vlob_id, head in heads.items())
+        return versions
+
     @do
     def perform_vlob_list(self, intent):
         return sorted(self.vlobs.keys())
@@ -311,7 +544,7 @@ class SynchronizerComponent:
             try:
                 self.vlob_cache[(intent.id, vlob['version'])] = vlob
             except ValueError:
-                pass  # Value too large if cache is disabled
+                pass  # Value larger than the whole cache (or cache disabled)
             new_vlob = None
             if vlob['version'] == 1:
                 new_vlob = yield Effect(EBackendVlobCreate(vlob['blob'].encode()))
@@ -339,6 +572,8 @@ class SynchronizerComponent:
     def perform_synchronize(self, intent):
         # TODO dangerous method: new vlobs are not updated in manifest. Remove it?
         synchronization = False
+        # Released blocks must not be uploaded
+        yield self.perform_block_garbage_collect(EBlockGarbageCollect())
         block_list = yield self.perform_block_list(EBlockList())
         for block_id in block_list:
             synchronization |= yield self.perform_block_synchronize(EBlockSynchronize(block_id))
@@ -359,6 +594,12 @@ class SynchronizerComponent:
         for item in list(self.vlob_cache.keys()):
             del self.vlob_cache[item]
 
+    @do
+    def perform_cache_stats(self, intent):
+        return {'blocks': self.block_cache.stats(),
+                'vlobs': self.vlob_cache.stats(),
+                'user_vlob': self.user_vlob_cache.stats()}
+
     async def periodic_synchronization(self, app):
         # TODO: find a better way to do this than using asyncio_perform...
         while True:
@@ -368,10 +609,22 @@ class SynchronizerComponent:
                 await asyncio_perform(
                     app.components.get_dispatcher(), Effect(fs.ESynchronize()))
 
+    async def periodic_garbage_collect(self, app):
+        # Deletions are rate limited to a batch per interval
+        while True:
+            await asyncio.sleep(self.gc_interval)
+            if self.gc_queue:
+                await asyncio_perform(app.components.get_dispatcher(),
+                                      Effect(EBlockGarbageCollect(self.gc_batch_size)))
+
     def get_dispatcher(self):
         return TypeDispatcher({
             EBlockCreate: self.perform_block_create,
             EBlockRead: self.perform_block_read,
+            EBlockPrefetch: self.perform_block_prefetch,
+            EBlockReference: self.perform_block_reference,
+            EBlockRelease: self.perform_block_release,
+            EBlockGarbageCollect: self.perform_block_garbage_collect,
             EBlockDelete: self.perform_block_delete,
             EBlockList: self.perform_block_list,
             EBlockSynchronize: self.perform_block_synchronize,
@@ -384,7 +637,9 @@ class SynchronizerComponent:
             EVlobRead: self.perform_vlob_read,
             EVlobUpdate: self.perform_vlob_update,
             EVlobDelete: self.perform_vlob_delete,
+            EVlobHead: self.perform_vlob_head,
             EVlobList: self.perform_vlob_list,
             EVlobSynchronize: self.perform_vlob_synchronize,
-            ESynchronize: self.perform_synchronize
+            ESynchronize: self.perform_synchronize,
+            ECacheStats: self.perform_cache_stats
         })
@@ -2,6 +2,7 @@ from os import urandom
 import struct
 import base64
 import hashlib
+import hmac
 
 from cryptography.fernet import Fernet
 from cryptography.hazmat.backends import default_backend
@@ -40,6 +41,12 @@ def generate_sym_key():
     return AESKey(raw_key)
 
 
+def derive_sym_key(secret: bytes, data: bytes):
+    # Convergent key: the same secret and data always give the same key
+    raw_key = hmac.new(secret, hashlib.sha256(data).digest(), hashlib.sha256).digest()
+    return AESKey(raw_key)
+
+
 def generate_asym_key(size):
     assert size > 1023
     private_key = rsa.generate_private_key(
@@ -247,6 +254,7 @@ __all__ = (
     'load_public_key',
     'load_sym_key',
     'generate_sym_key',
+    'derive_sym_key',
     'BaseSymKey',
     'BasePrivateAsymKey',
     'BasePublicAsymKey',
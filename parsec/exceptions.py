@@ -128,6 +128,14 @@ class BlockNotFound(BlockError):
     status = 'block_not_found'
 
 
+class BlockAlreadyExists(BlockError):
+    status = 'block_already_exists'
+
+
+class BlockIntegrityError(BlockError):
+    status = 'block_integrity_error'
+
+
 # Core errors
 
 
@@ -139,6 +147,10 @@ class FileNotFound(FileError):
     status = 'file_not_found'
 
 
+class CompressionError(ParsecError):
+    status = 'compression_error'
+
+
 class IdentityError(ParsecError):
     status = 'identity_error'
 
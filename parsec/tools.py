@@ -1,4 +1,5 @@
 import asyncio
+from collections.abc import Mapping
 import sys
 import inspect
 import json
@@ -104,8 +105,10 @@ def _json_serial(obj):
     if isinstance(obj, Arrow):
         serial = obj.isoformat()
         return serial
-    elif isinstance(obj, bytes):
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
         return to_jsonb64(obj)
+    elif isinstance(obj, Mapping):
+        return dict(obj)
     raise TypeError("Type %s not serializable" % type(obj))
 
 
@@ -119,5 +122,5 @@ def ejson_loads(raw):
 
 def digest(data):
     digest = hashes.Hash(hashes.SHA512(), backend=openssl)
-    digest.update(b'')
+    digest.update(bytes(data))
     return to_jsonb64(digest.finalize())
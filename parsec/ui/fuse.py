@@ -31,9 +31,11 @@ def cli(mountpoint, debug, nothreads, socket):
 
 class File:
 
-    def __init__(self, operations, path, fd, flags=0):
+    def __init__(self, operations, path, fd, handle, flags=0):
         self.fd = fd
         self.path = path
+        # Handle of the file opened in the core, IOs skip the path resolution
+        self.handle = handle
         self._operations = operations
         self.flags = flags
         self.modifications = []
@@ -44,7 +46,7 @@ class File:
         self.flush()
         # TODO use flags
         response = self._operations.send_cmd(
-            cmd='file_read', path=self.path, size=size, offset=offset)
+            cmd='file_read', handle=self.handle, size=size, offset=offset)
         if response['status'] != 'ok':
             raise FuseOSError(ENOENT)
         return from_jsonb64(response['content'])
@@ -78,15 +80,15 @@ class File:
         # Truncate file
         if shortest_truncate is not None:
             response = self._operations.send_cmd(
-                cmd='file_truncate', path=self.path, length=shortest_truncate)
+                cmd='file_truncate', handle=self.handle, length=shortest_truncate)
             if response['status'] != 'ok':
                 raise FuseOSError(ENOENT)
         # Write new contents
-        for offset, content in builder.contents.items():
+        for offset, content in builder.items():
             # TODO use flags
             response = self._operations.send_cmd(
                 cmd='file_write',
-                path=self.path,
+                handle=self.handle,
                 content=to_jsonb64(content),
                 offset=offset)
             if response['status'] != 'ok':
@@ -181,19 +183,22 @@ class FuseOperations(LoggingMixIn, Operations):
 
     def open(self, path, flags=0):
         fd_id = self.get_fd_id()
-        resp = self.send_cmd(cmd='stat', path=path)
-        if resp['status'] != 'ok' or resp['type'] != 'file':
+        resp = self.send_cmd(cmd='file_open', path=path)
+        if resp['status'] != 'ok':
             raise FuseOSError(ENOENT)
-        file = File(self, path, fd_id, flags)
+        file = File(self, path, fd_id, resp['handle'], flags)
         self.fds[fd_id] = file
         return fd_id
 
     def release(self, path, fh):
         try:
             file = self.fds.pop(fh)
-            file.flush()
         except KeyError:
             raise FuseOSError(EBADFD)
+        try:
+            file.flush()
+        finally:
+            self.send_cmd(cmd='file_close', handle=file.handle)
 
     def read(self, path, size, offset, fh):
         fd = self._get_fd(fh)
@@ -35,8 +35,10 @@ extra_requirements = {
     'drive': ["pydrive==1.3.1"],
     'dropbox': ["dropbox==7.2.1"],
     'fuse': ['fusepy==2.0.4'],
+    'lz4': ['lz4==0.10.1'],
     'postgresql': ["psycopg2==2.7.1", "aiopg==0.13.0"],
     's3': ['boto3==1.4.4', 'botocore==1.5.46'],
+    'zstd': ['zstandard==0.8.1'],
 }
 extra_requirements['all'] = sum(extra_requirements.values(), [])
 extra_requirements['oeuf-jambon-fromage'] = extra_requirements['all']
@@ -4,7 +4,8 @@ from effect2.testing import const, conste, noop, perform_sequence, asyncio_perfo
 
 from parsec.base import EEvent
 from parsec.backend.backend_api import execute_cmd
-from parsec.backend.vlob import EVlobCreate, EVlobRead, EVlobUpdate, VlobAtom, MockedVlobComponent
+from parsec.backend.vlob import (
+    EVlobCreate, EVlobRead, EVlobUpdate, EVlobHead, VlobAtom, VlobHead, MockedVlobComponent)
 from parsec.exceptions import VlobNotFound, TrustSeedError
 from parsec.tools import to_jsonb64
 
@@ -166,6 +167,26 @@ class TestVlobComponent:
             ]
             await asyncio_perform_sequence(sequence, eff)
 
+    async def test_vlob_head(self, component, vlob):
+        intent = EVlobUpdate(vlob.id, 2, vlob.write_trust_seed, b'Next version.')
+        eff = component.perform_vlob_update(intent)
+        sequence = [
+            (EEvent('vlob_updated', vlob.id), noop)
+        ]
+        await asyncio_perform_sequence(sequence, eff)
+        intent = EVlobCreate('456', b'bar')
+        other = await asyncio_perform_sequence([], component.perform_vlob_create(intent))
+        # Missing vlobs and wrong seeds are left out
+        intent = EVlobHead({vlob.id: vlob.read_trust_seed,
+                            other.id: 'dummy-seed',
+                            'dummy-id': 'dummy-seed'})
+        eff = component.perform_vlob_head(intent)
+        ret = await asyncio_perform_sequence([], eff)
+        assert ret == {vlob.id: VlobHead(vlob.id, 2, len(b'Next version.'))}
+        eff = component.perform_vlob_head(EVlobHead({}))
+        ret = await asyncio_perform_sequence([], eff)
+        assert ret == {}
+
 
 class TestVlobAPI:
 
@@ -353,3 +374,30 @@ class TestVlobAPI:
         ]
         ret = perform_sequence(sequence, eff)
         assert ret['status'] == 'trust_seed_error'
+
+    def test_vlob_head_ok(self):
+        eff = execute_cmd('vlob_head', {'vlobs': {'1234': 'TS4242', '5678': 'TS4343'}})
+        sequence = [
+            (EVlobHead({'1234': 'TS4242', '5678': 'TS4343'}),
+                const({'1234': VlobHead('1234', 42, 11)}))
+        ]
+        ret = perform_sequence(sequence, eff)
+        assert ret == {
+            'status': 'ok',
+            'vlobs': {'1234': {'version': 42, 'size': 11}}
+        }
+
+    @pytest.mark.parametrize('bad_msg', [
+        {'vlobs': {'1234': 'TS4242'}, 'bad_field': 'foo'},
+        {'vlobs': {'1234': 42}},
+        {'vlobs': {'1234': None}},
+        {'vlobs': [['1234', 'TS4242']]},
+        {'vlobs': None},
+        {}
+    ])
+    def test_vlob_head_bad_msg(self, bad_msg):
+        eff = execute_cmd('vlob_head', bad_msg)
+        sequence = [
+        ]
+        ret = perform_sequence(sequence, eff)
+        assert ret['status'] == 'bad_msg'
@@ -3,12 +3,21 @@ from unittest.mock import patch
 from effect2.testing import noop, perform_sequence
 
 from parsec.base import EEvent
+from parsec.core.file import File
 from parsec.core.identity import IdentityComponent, EIdentityLoad
 from parsec.crypto import RSAPublicKey, RSAPrivateKey, AESKey
 
 from tests.test_crypto import ALICE_PRIVATE_RSA
 
 
+@pytest.fixture(autouse=True)
+def clear_open_files():
+    # Loaded files are shared by the whole core
+    File.files.clear()
+    yield
+    File.files.clear()
+
+
 @pytest.fixture
 def alice_identity():
     component = IdentityComponent()
@@ -5,7 +5,8 @@ from parsec.core.backend import BackendCmd
 from parsec.core.backend_vlob import (
     EBackendVlobCreate, perform_vlob_create, VlobAccess,
     EBackendVlobRead, perform_vlob_read, VlobAtom,
-    EBackendVlobUpdate, perform_vlob_update
+    EBackendVlobUpdate, perform_vlob_update,
+    EBackendVlobHead, perform_vlob_head, VlobHead
 )
 
 
@@ -52,3 +53,17 @@ def test_perform_vlob_update():
     ]
     ret = perform_sequence(sequence, eff)
     assert ret is None
+
+
+def test_perform_vlob_head():
+    eff = perform_vlob_head(EBackendVlobHead({'42': 'RTS42', '43': 'RTS43'}))
+    backend_response = {
+        'status': 'ok',
+        'vlobs': {'42': {'version': 3, 'size': 4}}
+    }
+    sequence = [
+        (BackendCmd('vlob_head', {'vlobs': {'42': 'RTS42', '43': 'RTS43'}}),
+            const(backend_response))
+    ]
+    ret = perform_sequence(sequence, eff)
+    assert ret == {'42': VlobHead('42', 3, 4)}
@@ -145,6 +145,18 @@ class TestS3:
         with pytest.raises(BlockNotFound):
             await s3_block_connection.read('unknown_id')
 
+    async def test_block_exists(self, s3_block_connection):
+        assert await s3_block_connection.exists('42') is True
+        s3_block_connection.mocked_boto3_client.head_object.assert_called_once_with(
+            Bucket='bucket', Key='42')
+        s3_block_connection.mocked_boto3_client.head_object.side_effect = \
+            S3ClientError({'Error': {'Code': '404'}}, 'head_object')
+        assert await s3_block_connection.exists('unknown_id') is False
+        s3_block_connection.mocked_boto3_client.head_object.side_effect = \
+            S3ClientError({'Error': {'Code': '403'}}, 'head_object')
+        with pytest.raises(BlockError):
+            await s3_block_connection.exists('42')
+
     async def test_perform_block_create_no_connection(self, s3_block_connection):
         s3_block_connection.mocked_boto3_client.put_object.side_effect = \
             S3EndpointConnectionError(endpoint_url='put_object')
@@ -0,0 +1,171 @@
+import hashlib
+from uuid import uuid4
+
+from parsec.core.block_map import MAGIC, BlockIndex, ByteColumn
+from parsec.core.merkle import MerkleTree
+from parsec.tools import to_jsonb64, digest
+
+
+KEY_A = to_jsonb64(b'<dummy-key-00000000000000000001>')
+KEY_B = to_jsonb64(b'<dummy-key-00000000000000000002>')
+
+
+def block(block_id, data):
+    return {'block': block_id, 'digest': digest(data), 'size': len(data)}
+
+
+def test_byte_column():
+    column = ByteColumn()
+    column.append(b'ab')
+    column.append(b'')
+    # Longer values widen the whole column
+    column.append(b'cdef')
+    assert column.width == 4
+    assert [column[i] for i in range(len(column))] == [b'ab', b'', b'cdef']
+    other = ByteColumn()
+    other.extend(column, 1, 3)
+    assert [other[i] for i in range(len(other))] == [b'', b'cdef']
+    narrow = ByteColumn()
+    narrow.append(b'x')
+    column.extend(narrow, 0, 1)
+    assert column[3] == b'x'
+
+
+class TestBlockIndex:
+
+    def test_init(self):
+        blob = [{'blocks': [block('1', b'a' * 5), block('2', b'b' * 9)],
+                 'key': KEY_A},
+                {'blocks': [block('3', b''), block('4', b'c' * 9)],
+                 'key': KEY_B}]
+        index = BlockIndex(blob, 3)
+        assert index.version == 3
+        assert index.size == 23
+        assert len(index) == 4
+        assert list(index.ends) == [5, 14, 14, 23]
+        assert [index.start(i) for i in range(len(index))] == [0, 5, 14, 14]
+        assert [index.key(i) for i in range(len(index))] == [KEY_A, KEY_A, KEY_B, KEY_B]
+        # Keys are stored once per group
+        assert len(index.keys) == 2
+        assert index.block_ids() == ['1', '2', '3', '4']
+        assert index.entry(1) == blob[0]['blocks'][1]
+        assert index.tree.root == MerkleTree.from_blocks(blob[0]['blocks'] +
+                                                         blob[1]['blocks']).root
+
+    def test_entries(self):
+        block_id = uuid4().hex
+        own_key = to_jsonb64(b'<dummy-key-00000000000000000003>')
+        blob = [{'blocks': [block(block_id, b'abc')], 'key': KEY_A},
+                {'blocks': [{'size': 4}], 'key': None},
+                {'blocks': [{'data': to_jsonb64(b'de'), 'digest': digest(b'de'), 'size': 2}],
+                 'key': None},
+                {'blocks': [dict(block('5', b'fg'), key=own_key, compression='zlib')],
+                 'key': None}]
+        index = BlockIndex(blob)
+        assert index.has_block(0) and not index.is_hole(0)
+        # Hexadecimal ids are stored as bytes
+        assert index.ids[0] == bytes.fromhex(block_id)
+        assert index.block_id(0) == block_id
+        assert index.is_hole(1) and index.key(1) is None
+        assert index.is_inline(2) and index.data(2) == b'de'
+        assert index.key(3) == own_key
+        assert [index.entry(i) for i in range(len(index))] == [
+            group['blocks'][0] for group in blob]
+        assert index.group(0, len(index)) == blob
+
+    def test_digests(self):
+        blob = [{'blocks': [block('1', b'abc'), block('2', b''), {'size': 2},
+                            dict(block('3', b''), size=4)],
+                 'key': KEY_A}]
+        index = BlockIndex(blob)
+        assert index.has_digest(0) and index.digest(0) == hashlib.sha512(b'abc').digest()
+        assert index.has_digest(1)
+        assert not index.has_digest(2)
+        # Non-empty blocks with the digest of b'' were written by older versions
+        assert not index.has_digest(3)
+
+    def test_bounds_and_group(self):
+        blob = [{'blocks': [block('1', b'a' * 5), block('2', b'b' * 9)],
+                 'key': KEY_A},
+                {'blocks': [block('3', b'c' * 9)],
+                 'key': KEY_B}]
+        index = BlockIndex(blob)
+        assert index.bounds(0, 23) == (0, 3)
+        assert index.bounds(5, 9) == (1, 2)
+        assert index.bounds(3, 5) == (0, 1)
+        assert index.bounds(23, 10) == (3, 3)
+        assert index.group(0, 3) == blob
+        assert index.group(1, 3) == [{'blocks': [blob[0]['blocks'][1]], 'key': KEY_A}, blob[1]]
+        assert index.group(2, 2) == []
+
+    def test_slices(self):
+        blob = [{'blocks': [block('1', b'a' * 5), block('2', b'b' * 9)],
+                 'key': KEY_A},
+                {'blocks': [{'size': 3}], 'key': None},
+                {'blocks': [block('3', b'c' * 9)],
+                 'key': KEY_B}]
+        index = BlockIndex(blob)
+        new_group = {'blocks': [block('abcd', b'xy')], 'key': KEY_B}
+        new_index = BlockIndex([index.slice(0, 1), new_group, index.slice(1, 4)], 2)
+        assert new_index.version == 2
+        assert new_index.size == index.size + 2
+        assert list(new_index.ends) == [5, 7, 16, 19, 28]
+        assert new_index.block_ids() == ['1', 'abcd', '2', '3']
+        assert new_index.group(0, len(new_index)) == [
+            {'blocks': [blob[0]['blocks'][0]], 'key': KEY_A},
+            new_group,
+            {'blocks': [blob[0]['blocks'][1]], 'key': KEY_A},
+            blob[1],
+            blob[2]]
+        # Slices of a different index
+        other_index = BlockIndex([new_group])
+        mixed_index = BlockIndex([other_index.slice(0, 1), index.slice(2, 4)])
+        assert mixed_index.group(0, len(mixed_index)) == [new_group, blob[1], blob[2]]
+        assert len(BlockIndex([index.slice(1, 1)])) == 0
+
+    def test_dropped_block_ids(self):
+        blob = [{'blocks': [block('1', b'a'), block('2', b'b'), block('1', b'a')],
+                 'key': KEY_A},
+                {'blocks': [{'size': 3}], 'key': None},
+                {'blocks': [block('3', b'c')], 'key': KEY_B}]
+        index = BlockIndex(blob)
+        new_group = {'blocks': [block('4', b'd')], 'key': KEY_B}
+        assert index.dropped_block_ids([index.slice(0, len(index)), new_group]) == []
+        # Holes aren't blocks, deduplicated blocks are dropped once per entry
+        assert index.dropped_block_ids([index.slice(1, 2), new_group]) == ['1', '1', '3']
+        assert index.dropped_block_ids([index.slice(2, 4), index.slice(0, 1)]) == ['2', '3']
+        # Slices of another index don't keep anything
+        other_index = BlockIndex(blob)
+        assert index.dropped_block_ids([other_index.slice(0, 5)]) == index.block_ids()
+
+    def test_serialization(self):
+        blob = [{'blocks': [block(uuid4().hex, b'a' * 5), block('2', b'b' * 9)],
+                 'key': KEY_A},
+                {'blocks': [{'size': 3}], 'key': None},
+                {'blocks': [{'data': to_jsonb64(b'de'), 'digest': digest(b'de'), 'size': 2}],
+                 'key': None},
+                {'blocks': [dict(block('3', b'c' * 9), key=KEY_B, compression='zlib')],
+                 'key': None}]
+        index = BlockIndex(blob)
+        raw = index.to_bytes()
+        assert raw.startswith(MAGIC)
+        for loaded in (BlockIndex.loads(raw, 4), BlockIndex.loads(index.dumps(), 4)):
+            assert loaded.version == 4
+            assert loaded.size == index.size
+            assert list(loaded.ends) == list(index.ends)
+            assert loaded.group(0, len(loaded)) == blob
+            assert loaded.tree.root == index.tree.root
+        # Root is recorded in the compact form only
+        assert BlockIndex.loads(raw).stored_root == index.tree.root
+        assert BlockIndex.loads(index.dumps()).stored_root is None
+        assert BlockIndex.loads(BlockIndex().to_bytes()).size == 0
+
+    def test_serialization_drops_unused_keys(self):
+        blob = [{'blocks': [block('1', b'a')], 'key': KEY_A},
+                {'blocks': [block('2', b'b')], 'key': KEY_B}]
+        index = BlockIndex(blob)
+        new_index = BlockIndex([index.slice(1, 2)])
+        assert len(new_index.keys) == 2
+        loaded = BlockIndex.loads(new_index.to_bytes())
+        assert len(loaded.keys) == 1
+        assert loaded.group(0, len(loaded)) == [blob[1]]
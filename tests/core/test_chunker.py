@@ -0,0 +1,96 @@
+import random
+
+import pytest
+
+from parsec.core.chunker import (
+    GEAR, MASK_64, ContentDefinedChunker, FixedSizeChunker, chunker_factory)
+
+
+def random_content(length, seed=42):
+    generator = random.Random(seed)
+    return bytes(generator.getrandbits(8) for _ in range(length))
+
+
+@pytest.mark.parametrize('length', [0, 4095, 4096, 4097, 10000])
+def test_fixed_size_chunker(length):
+    content = random_content(length)
+    chunker = FixedSizeChunker(4096)
+    chunks = chunker.split(content)
+    assert b''.join(chunks) == content
+    assert all(len(chunk) == 4096 for chunk in chunks[:-1])
+    if content:
+        assert 0 < len(chunks[-1]) <= 4096
+    else:
+        assert chunks == []
+
+
+def test_fixed_size_chunker_bad_size():
+    with pytest.raises(ValueError):
+        FixedSizeChunker(0)
+
+
+@pytest.mark.parametrize('length', [0, 100, 1024, 50000, 200000])
+def test_content_defined_chunker(length):
+    content = random_content(length)
+    chunker = ContentDefinedChunker(min_size=1024, avg_size=4096, max_size=16384)
+    chunks = chunker.split(content)
+    assert b''.join(chunks) == content
+    for chunk in chunks[:-1]:
+        assert 1024 < len(chunk) <= 16384
+    # Chunking is deterministic
+    assert chunker.split(content) == chunks
+
+
+def reference_cut(chunker, data, start):
+    # Byte by byte gear hash, boundaries must not depend on how it is computed
+    remaining = len(data) - start
+    if remaining <= chunker.min_size:
+        return remaining
+    end = min(remaining, chunker.max_size)
+    fingerprint = 0
+    for position in range(chunker.min_size, end):
+        fingerprint = ((fingerprint << 1) + GEAR[data[start + position]]) & MASK_64
+        mask = chunker.mask_small if position < chunker.avg_size else chunker.mask_large
+        if not fingerprint & mask:
+            return position + 1
+    return end
+
+
+@pytest.mark.parametrize('sizes', [(1024, 4096, 16384), (16, 64, 128), (1, 1, 1)])
+def test_content_defined_chunker_boundaries(sizes):
+    content = random_content(50000)
+    chunker = ContentDefinedChunker(*sizes)
+    start = 0
+    for chunk in chunker.split(content):
+        assert len(chunk) == reference_cut(chunker, content, start)
+        start += len(chunk)
+
+
+def test_content_defined_chunker_stable_boundaries():
+    content = random_content(200000)
+    chunker = ContentDefinedChunker(min_size=1024, avg_size=4096, max_size=16384)
+    chunks = chunker.split(content)
+    # Insert data in the middle, only the chunks around the insertion change
+    position = 100000
+    modified = content[:position] + b'inserted data' + content[position:]
+    modified_chunks = chunker.split(modified)
+    common = set(chunks) & set(modified_chunks)
+    assert len(common) >= len(chunks) - 3
+
+
+def test_content_defined_chunker_bad_sizes():
+    with pytest.raises(ValueError):
+        ContentDefinedChunker(min_size=1024, avg_size=3000, max_size=16384)
+    with pytest.raises(ValueError):
+        ContentDefinedChunker(min_size=8192, avg_size=4096, max_size=16384)
+
+
+def test_chunker_factory():
+    chunker = chunker_factory('fixed', 8192)
+    assert isinstance(chunker, FixedSizeChunker)
+    assert chunker.block_size == 8192
+    chunker = chunker_factory('cdc', 8192)
+    assert isinstance(chunker, ContentDefinedChunker)
+    assert (chunker.min_size, chunker.avg_size, chunker.max_size) == (2048, 8192, 65536)
+    with pytest.raises(ValueError):
+        chunker_factory('unknown')
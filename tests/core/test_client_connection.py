@@ -1,11 +1,12 @@
 import pytest
 import attr
 from unittest.mock import Mock
-from effect2 import Effect, Constant, do, ComposedDispatcher
+from effect2 import Effect, Constant, do, ComposedDispatcher, TypeDispatcher
 
 from parsec.core.client_connection import (
-    on_connection_factory, EPushClientMsg, EClientSubscribeEvent, EClientUnsubscribeEvent)
-from parsec.base import EEvent, EventComponent, base_dispatcher
+    on_connection_factory, EPushClientMsg, EClientSend, EClientSubscribeEvent,
+    EClientUnsubscribeEvent, EClientId)
+from parsec.base import EEvent, ERegisterEvent, EventComponent, base_dispatcher
 
 
 @attr.s
@@ -25,6 +26,9 @@ class MockedWriter:
     def write(self, buff):
         self.written += buff
 
+    async def drain(self):
+        pass
+
 
 @pytest.fixture
 def dispatcher():
@@ -72,6 +76,23 @@ async def test_mix_cmds_and_pushed_msgs(dispatcher):
     assert writer.written == expected_written
 
 
+async def test_client_send(dispatcher):
+    reader = MockedReader(b'cmd\n')
+    writer = MockedWriter()
+
+    @do
+    def perform_cmd(cmd):
+        yield Effect(EPushClientMsg(b'event'))
+        yield Effect(EClientSend(b'frame1'))
+        yield Effect(EClientSend('frame2'))
+        return b'cmd_resp'
+
+    on_connection = on_connection_factory(perform_cmd, dispatcher)
+    await on_connection(reader, writer)
+    # Frames are sent right away, before the command's response
+    assert writer.written == b'frame1\nframe2\ncmd_resp\nevent\n'
+
+
 async def test_events(dispatcher):
     reader = MockedReader(b'cmd\n')
     writer = MockedWriter()
@@ -114,3 +135,32 @@ async def test_unsubscribe_events(dispatcher):
         b'cmd_resp\n'
         b'{"event": "eventA", "sender": "sender2"}\n'
         b'{"event": "eventB", "sender": "sender1"}\n')
+
+
+async def test_client_disconnected(dispatcher):
+    reader = MockedReader(b'cmd\n')
+    writer = MockedWriter()
+    disconnected = []
+
+    @attr.s
+    class EOnDisconnected:
+        event = attr.ib()
+        sender = attr.ib()
+
+    dispatcher = ComposedDispatcher(dispatcher, TypeDispatcher({
+        EOnDisconnected: lambda intent: disconnected.append(intent.sender)
+    }))
+
+    @do
+    def perform_cmd(cmd):
+        client = yield Effect(EClientId())
+        yield Effect(ERegisterEvent(EOnDisconnected, 'client_disconnected', client))
+        return client.encode()
+
+    on_connection = on_connection_factory(perform_cmd, dispatcher)
+    await on_connection(reader, writer)
+    # Each connection is given its own id, notified once the connection is closed
+    assert disconnected == [writer.written[:-1].decode()]
+    other_writer = MockedWriter()
+    await on_connection(MockedReader(b'cmd\n'), other_writer)
+    assert other_writer.written != writer.written
@@ -0,0 +1,39 @@
+import pytest
+
+from parsec.core.compression import COMPRESSORS, ZlibCompressor, compressor_factory, decompress
+from parsec.exceptions import CompressionError
+
+
+@pytest.mark.parametrize('data', [b'', b'a', b'abc' * 1000])
+def test_zlib_compressor(data):
+    compressor = ZlibCompressor(9)
+    compressed = compressor.compress(data)
+    assert compressor.decompress(compressed) == data
+    assert decompress('zlib', compressed) == data
+
+
+def test_zlib_compressor_bad_level():
+    with pytest.raises(ValueError):
+        ZlibCompressor(10)
+
+
+def test_compressor_factory():
+    assert compressor_factory('none') is None
+    compressor = compressor_factory('zlib')
+    assert isinstance(compressor, ZlibCompressor)
+    assert compressor.level == 6
+    assert compressor_factory('zlib', 1).level == 1
+    with pytest.raises(CompressionError):
+        compressor_factory('unknown')
+
+
+def test_missing_compression_package(monkeypatch):
+    class MissingCompressor:
+        def __init__(self, *args):
+            raise ImportError('No module named lz4')
+
+    monkeypatch.setitem(COMPRESSORS, 'lz4', MissingCompressor)
+    with pytest.raises(CompressionError):
+        compressor_factory('lz4')
+    with pytest.raises(CompressionError):
+        decompress('lz4', b'data')
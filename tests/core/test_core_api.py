@@ -1,7 +1,9 @@
 import pytest
-from effect2.testing import conste, noop, perform_sequence
+from effect2.testing import const, conste, noop, perform_sequence
 
 from parsec.core.core_api import execute_cmd, execute_raw_cmd, EClientSubscribeEvent
+from parsec.core.fs import EFileRead
+from parsec.core.synchronizer import ECacheStats
 from parsec.exceptions import ParsecError
 
 
@@ -23,6 +25,16 @@ def test_catch_parsec_exception():
     assert resp == {'status': 'error', 'label': 'msg'}
 
 
+def test_cache_stats():
+    eff = execute_cmd('cache_stats', {})
+    stats = {'hits': 1, 'misses': 0}
+    sequence = [
+        (ECacheStats(), const({'blocks': stats, 'vlobs': stats, 'user_vlob': stats}))
+    ]
+    resp = perform_sequence(sequence, eff)
+    assert resp == {'status': 'ok', 'blocks': stats, 'vlobs': stats, 'user_vlob': stats}
+
+
 class TestRawCMD:
     def test_execute(self):
         raw_cmd = b'{"cmd": "subscribe_event", "event": "foo", "sender": "bar"}'
@@ -33,6 +45,20 @@ class TestRawCMD:
         resp = perform_sequence(sequence, eff)
         assert resp == b'{"status": "ok"}'
 
+    @pytest.mark.parametrize('content', [
+        bytearray(b'foo'),
+        memoryview(b'foo'),
+    ])
+    def test_execute_file_read(self, content):
+        # Files are read into buffers that must be serialized as bytes
+        raw_cmd = b'{"cmd": "file_read", "path": "/foo"}'
+        eff = execute_raw_cmd(raw_cmd)
+        sequence = [
+            (EFileRead('/foo', 0, None), const(content))
+        ]
+        resp = perform_sequence(sequence, eff)
+        assert resp == b'{"content": "Zm9v\\n", "status": "ok"}'
+
     @pytest.mark.parametrize('bad_raw_cmd', [
         b'',
         b'not a json',
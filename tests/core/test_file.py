@@ -1,18 +1,38 @@
 from copy import deepcopy
+import hashlib
 import random
+import zlib
 
+import attr
+from effect2 import Effect
 from effect2.testing import const, conste, noop, perform_sequence
 import pytest
 
-from parsec.core.file import ContentBuilder, File
+from parsec.core.chunker import FixedSizeChunker
+from parsec.core.compression import ZlibCompressor
+from parsec.core.file import BlockIndex, ContentBuilder, File, OpenFileTable, ReadAhead, concat
+from parsec.core.merkle import MerkleTree
 from parsec.core.synchronizer import (EVlobCreate, EVlobList, EVlobRead, EVlobUpdate, EVlobDelete,
                                       EVlobSynchronize, EBlockCreate, EBlockSynchronize, EBlockRead,
-                                      EBlockDelete)
-from parsec.exceptions import BlockNotFound, FileError, VlobNotFound
+                                      EBlockPrefetch, EBlockReference, EBlockRelease)
+from parsec.crypto import derive_sym_key
+from parsec.exceptions import BlockIntegrityError, BlockNotFound, FileError, VlobNotFound
 from tests.test_crypto import mock_crypto_passthrough
 from parsec.tools import to_jsonb64, ejson_dumps, digest
 
 
+@attr.s
+class EConsume:
+    data = attr.ib()
+
+
+def regroup(matching_blocks):
+    # Existing blocks are returned as slices of the block index
+    for key in ('pre_excluded_blocks', 'included_blocks', 'post_excluded_blocks'):
+        blocks = BlockIndex(matching_blocks[key])
+        matching_blocks[key] = blocks.group(0, len(blocks))
+
+
 @pytest.fixture
 def file(mock_crypto_passthrough):
         block_id = '4567'
@@ -58,12 +78,100 @@ class TestContentBuilder:
         builder.write(b'after', 34)
         assert builder.contents == {8: b'before', 15: b'ABCde0123456789XYz', 34: b'after'}
 
+    def test_write_overlapping_several(self):
+        builder = ContentBuilder()
+        builder.write(b'abc', 0)
+        builder.write(b'def', 10)
+        builder.write(b'ghi', 20)
+        builder.write(b'0123456789', 2)
+        assert builder.contents == {0: b'ab0123456789f', 20: b'ghi'}
+        builder.write(b'XY', 13)
+        assert builder.contents == {0: b'ab0123456789fXY', 20: b'ghi'}
+        builder.write(b'-' * 30, 0)
+        assert builder.contents == {0: b'-' * 30}
+
+    def test_write_sequential(self):
+        builder = ContentBuilder()
+        buffer = None
+        for i in range(100):
+            builder.write(b'%02d' % i, i * 2)
+            if buffer is None:
+                buffer = builder.buffers[0]
+            # Already buffered data is extended in place
+            assert builder.buffers == [buffer]
+        assert builder.contents == {0: b''.join(b'%02d' % i for i in range(100))}
+
     def test_truncate(self):
         builder = ContentBuilder()
         builder.write(b'0123456789', 20)
         builder.write(b'abc', 40)
         builder.truncate(25)
         assert builder.contents == {20: b'01234'}
+        builder.truncate(20)
+        assert builder.contents == {}
+
+
+def test_concat():
+    block = b'0123456789'
+    data = concat([memoryview(block)[5:], b'abc', bytearray(b''), memoryview(block)[:2]])
+    assert isinstance(data, bytearray)
+    assert data == b'56789abc01'
+    assert concat([]) == b''
+
+
+class TestOpenFileTable:
+
+    def make_file(self, id, dirty=False, modifications=None):
+        file = File()
+        file.id = id
+        file.dirty = dirty
+        file.modifications = modifications or []
+        return file
+
+    def test_lru_eviction(self):
+        table = OpenFileTable(max_size=2)
+        files = [self.make_file(id) for id in 'abc']
+        table['a'] = files[0]
+        table['b'] = files[1]
+        assert table['a'] is files[0]
+        table['c'] = files[2]
+        # Least recently used file is evicted
+        assert 'b' not in table
+        assert len(table) == 2
+
+    def test_busy_files_not_evicted(self):
+        table = OpenFileTable(max_size=1)
+        dirty = self.make_file('dirty', dirty=True)
+        modified = self.make_file('modified', modifications=[(None, b'foo', 0)])
+        opened = self.make_file('opened')
+        table['dirty'] = dirty
+        table['modified'] = modified
+        table.acquire(opened)
+        table.acquire(opened)
+        table['idle'] = self.make_file('idle')
+        assert 'idle' not in table
+        assert len(table) == 3
+        table.release(opened)
+        assert 'opened' in table
+        table.release(opened)
+        assert 'opened' not in table
+        assert len(table) == 2
+
+    def test_rename(self):
+        table = OpenFileTable(max_size=1)
+        file = self.make_file('a')
+        table.acquire(file)
+        table.rename(file, 'b')
+        file.id = 'b'
+        assert 'a' not in table
+        assert table['b'] is file
+        table['c'] = self.make_file('c')
+        # Still referenced under its new id
+        assert 'b' in table
+        assert 'c' not in table
+        table.release(file)
+        table['c'] = self.make_file('c')
+        assert 'b' not in table
 
 
 class TestFile:
@@ -87,7 +195,7 @@ class TestFile:
                                                read_trust_seed,
                                                '43'))
         assert file == file2
-        File.files = {}
+        File.files.clear()
         # Test reloading commited and not commited file
         for synchronizer_vlob_list in [[vlob_id, other_vlob_id], [other_vlob_id]]:
             key = to_jsonb64(b'<dummy-key-00000000000000000001>')
@@ -100,7 +208,131 @@ class TestFile:
             file = perform_sequence(sequence, File.load(vlob_id, key, read_trust_seed, '43'))
             assert file.dirty is (vlob_id in synchronizer_vlob_list)
             assert file.version == (version - 1 if file.dirty else version)
-            File.files = {}
+            File.files.clear()
+
+    def test_copy(self, file, monkeypatch):
+        monkeypatch.setattr(File, 'chunker', FixedSizeChunker(4))
+        vlob = {'id': '2345', 'read_trust_seed': '44', 'write_trust_seed': '45'}
+        blob = [{'blocks': [{'block': '4567', 'digest': digest(b''), 'size': 0}],
+                 'key': to_jsonb64(b'<dummy-key-00000000000000000001>')}]
+        file.write(b'abc', 0)
+        sequence = [
+            (EBlockCreate(to_jsonb64(b'abc')), const('1')),
+            (EVlobUpdate('1234', '43', 1, to_jsonb64(ejson_dumps(blob + [{
+                'blocks': [{'block': '1', 'digest': digest(b'abc'), 'size': 3}],
+                'key': to_jsonb64(b'<dummy-key-00000000000000000003>')}]).encode())),
+                noop),
+            (EBlockReference(['4567', '1']), noop),
+            (EVlobCreate(to_jsonb64(ejson_dumps(blob + [{
+                'blocks': [{'block': '1', 'digest': digest(b'abc'), 'size': 3}],
+                'key': to_jsonb64(b'<dummy-key-00000000000000000003>')}]).encode())),
+                const(vlob)),
+        ]
+        copy = perform_sequence(sequence, file.copy())
+        assert copy.id == '2345'
+        assert File.files['2345'] is copy
+        assert copy.get_version() == 1
+        # Writes to the original do not affect the copy
+        file.write(b'x', 0)
+        sequence = [
+            (EBlockRead('1'), const({'content': to_jsonb64(b'abc')})),
+            (EBlockCreate(to_jsonb64(b'xbc')), const('2')),
+            (EVlobUpdate('1234', '43', 1, to_jsonb64(ejson_dumps(blob + [{
+                'blocks': [{'block': '2', 'digest': digest(b'xbc'), 'size': 3}],
+                'key': to_jsonb64(b'<dummy-key-00000000000000000005>')}]).encode())),
+                noop),
+            (EBlockRelease(['1']), noop),
+        ]
+        perform_sequence(sequence, file.flush())
+        sequence = [
+            (EBlockRead('1'), const({'content': to_jsonb64(b'abc')})),
+        ]
+        assert perform_sequence(sequence, copy.read()) == b'abc'
+
+    @pytest.mark.usefixtures('mock_crypto_passthrough')
+    def test_inline(self, monkeypatch):
+        monkeypatch.setattr(File, 'chunker', FixedSizeChunker(4))
+        monkeypatch.setattr(File, 'inline_threshold', 8)
+        vlob_id = '1234'
+
+        def inline(data):
+            return {'blocks': [{'data': to_jsonb64(data), 'digest': digest(data),
+                                'size': len(data)}],
+                    'key': None}
+
+        def group(blocks, key):
+            return {'blocks': [{'block': block_id, 'digest': digest(data), 'size': len(data)}
+                               for block_id, data in blocks],
+                    'key': to_jsonb64(key)}
+
+        def encode(blob):
+            return to_jsonb64(ejson_dumps(blob).encode())
+
+        # No block is created for a new file
+        sequence = [
+            (EVlobCreate(encode([inline(b'')])),
+                const({'id': vlob_id, 'read_trust_seed': '42', 'write_trust_seed': '43'})),
+        ]
+        file = perform_sequence(sequence, File.create())
+        # Small content is stored in the blob
+        file.write(b'abc', 0)
+        sequence = [
+            (EVlobUpdate(vlob_id, '43', 1, encode([inline(b'abc')])), noop),
+        ]
+        perform_sequence(sequence, file.flush())
+        assert perform_sequence([], file.read()) == b'abc'
+        # Growing past the threshold moves the data to blocks
+        file.write(b'defghi', 3)
+        defghi_group = group([('2', b'defg'), ('3', b'hi')], b'<dummy-key-00000000000000000002>')
+        sequence = [
+            (EBlockCreate(to_jsonb64(b'defg')), const('2')),
+            (EBlockCreate(to_jsonb64(b'hi')), const('3')),
+            (EVlobUpdate(vlob_id, '43', 1, encode([inline(b'abc'), defghi_group])), noop),
+            (EBlockCreate(to_jsonb64(b'abc')), const('1')),
+            (EVlobUpdate(vlob_id, '43', 1, encode([
+                group([('1', b'abc')], b'<dummy-key-00000000000000000003>'),
+                defghi_group])), noop),
+        ]
+        perform_sequence(sequence, file.flush())
+        # Shrinking below the threshold inlines the data again
+        file.truncate(2)
+        assert perform_sequence([], file.stat())['size'] == 2
+        sequence = [
+            (EBlockRead('1'), const({'content': to_jsonb64(b'abc')})),
+            (EVlobUpdate(vlob_id, '43', 1, encode([inline(b'ab')])), noop),
+            (EBlockRelease(['1', '2', '3']), noop),
+        ]
+        perform_sequence(sequence, file.flush())
+        assert perform_sequence([], file.read()) == b'ab'
+        # Writes and truncates past the end leave zeros
+        file.write(b'z', 3)
+        file.truncate(6)
+        sequence = [
+            (EVlobUpdate(vlob_id, '43', 1, encode([inline(b'ab\x00z\x00\x00')])), noop),
+        ]
+        perform_sequence(sequence, file.flush())
+
+    def test_compact_block_map(self, file, monkeypatch):
+        monkeypatch.setattr(File, 'compact_block_map_threshold', 1)
+        vlob_id = '1234'
+        blob = [{'blocks': [{'block': '1', 'digest': digest(b'abc'), 'size': 3},
+                            {'block': '2', 'digest': digest(b'de'), 'size': 2}],
+                 'key': to_jsonb64(b'<dummy-key-00000000000000000001>')}]
+        # Block maps with more entries than the threshold are stored in binary form
+        encrypted_blob = to_jsonb64(BlockIndex(blob).to_bytes())
+        sequence = [
+            (EVlobUpdate(vlob_id, '43', 1, encrypted_blob), noop),
+        ]
+        perform_sequence(sequence, file._update_blob(blob))
+        file._block_index = None
+        sequence = [
+            (EVlobRead(vlob_id, '42', 1),
+                const({'id': vlob_id, 'blob': encrypted_blob, 'version': 1})),
+            (EBlockRead('1'), const({'content': to_jsonb64(b'abc')})),
+            (EBlockRead('2'), const({'content': to_jsonb64(b'de')})),
+        ]
+        assert perform_sequence(sequence, file.read()) == b'abcde'
+        assert file._block_index.group(0, 2) == blob
 
     def test_get_vlob(self, file):
         assert file.get_vlob() == {'id': '1234',
@@ -111,6 +343,7 @@ class TestFile:
     def test_get_blocks(self, file):
         file.dirty = False
         file.version = 1
+        file._block_index = None
         vlob_id = '1234'
         block_ids = ['4567', '5678', '6789']
         chunk_digest = digest(b'')
@@ -151,8 +384,12 @@ class TestFile:
             (EVlobRead(vlob_id, '42', 1),
                 const({'id': vlob_id, 'blob': blob, 'version': 1})),
         ]
+        file._block_index = None
         read_content = perform_sequence(sequence, file.read())
         assert read_content == b''
+        # Block index is cached for this version
+        read_content = perform_sequence([], file.read())
+        assert read_content == b''
         # Not empty file
         content = b'This is a test content.'
         block_ids = ['4567', '5678', '6789']
@@ -172,6 +409,7 @@ class TestFile:
                  'key': to_jsonb64(b'<dummy-key-00000000000000000002>')}]
         blob = ejson_dumps(blob).encode()
         blob = to_jsonb64(blob)
+        file._block_index = None
         sequence = [
             (EVlobRead(vlob_id, '42', 1),
                 const({'id': vlob_id, 'blob': blob, 'version': 1})),
@@ -187,8 +425,6 @@ class TestFile:
         # Offset
         offset = 5
         sequence = [
-            (EVlobRead(vlob_id, '42', 1),
-                const({'id': vlob_id, 'blob': blob, 'version': 1})),
             (EBlockRead(block_ids[1]),
                 const({'content': to_jsonb64(chunk_2), 'creation_date': '2012-01-01T00:00:00'})),
             (EBlockRead(block_ids[2]),
@@ -199,16 +435,204 @@ class TestFile:
         # Size
         size = 9
         sequence = [
-            (EVlobRead(vlob_id, '42', 1),
-                const({'id': vlob_id, 'blob': blob, 'version': 1})),
             (EBlockRead(block_ids[1]),
                 const({'content': to_jsonb64(chunk_2), 'creation_date': '2012-01-01T00:00:00'}))
         ]
         read_content = perform_sequence(sequence, file.read(offset=offset, size=size))
         assert read_content == content[offset:][:size]
+        # Range straddling blocks
+        offset = 3
+        size = 13
+        sequence = [
+            (EBlockRead(block_ids[0]),
+                const({'content': to_jsonb64(chunk_1), 'creation_date': '2012-01-01T00:00:00'})),
+            (EBlockRead(block_ids[1]),
+                const({'content': to_jsonb64(chunk_2), 'creation_date': '2012-01-01T00:00:00'})),
+            (EBlockRead(block_ids[2]),
+                const({'content': to_jsonb64(chunk_3), 'creation_date': '2012-01-01T00:00:00'}))
+        ]
+        read_content = perform_sequence(sequence, file.read(offset=offset, size=size))
+        assert read_content == content[offset:][:size]
         assert file.dirty is False
         assert file.version == 1
 
+    def test_read_ahead(self, file, monkeypatch):
+        monkeypatch.setattr(File, 'read_ahead_size', 4)
+        file.dirty = False
+        file.version = 1
+        block_ids = ['1', '2', '3', '4', '5']
+        chunks = [b'ab', b'cd', b'ef', b'gh', b'ij']
+        key = to_jsonb64(b'<dummy-key-00000000000000000001>')
+        blob = [{'blocks': [{'block': block_id, 'digest': digest(chunk), 'size': len(chunk)}
+                            for block_id, chunk in zip(block_ids, chunks)],
+                 'key': key}]
+        file._block_index = BlockIndex(blob, 1)
+
+        def block_read(index):
+            return (EBlockRead(block_ids[index]),
+                    const({'content': to_jsonb64(chunks[index]),
+                           'creation_date': '2012-01-01T00:00:00'}))
+
+        # First read, access pattern is not known yet
+        read_content = perform_sequence([block_read(0)], file.read(size=2, offset=0))
+        assert read_content == b'ab'
+        # Sequential read, next blocks are prefetched
+        sequence = [
+            block_read(1),
+            (EBlockPrefetch(['3', '4']), noop)
+        ]
+        read_content = perform_sequence(sequence, file.read(size=2, offset=2))
+        assert read_content == b'cd'
+        # Blocks already prefetched are not requested again
+        sequence = [
+            block_read(2),
+            (EBlockPrefetch(['5']), noop)
+        ]
+        read_content = perform_sequence(sequence, file.read(size=2, offset=4))
+        assert read_content == b'ef'
+        # Random access stops read-ahead
+        read_content = perform_sequence([block_read(0)], file.read(size=2, offset=0))
+        assert read_content == b'ab'
+        read_content = perform_sequence([block_read(4)], file.read(size=2, offset=8))
+        assert read_content == b'ij'
+        # Each reader has its own read-ahead, interleaving them keeps both sequential
+        first, second = ReadAhead(), ReadAhead()
+        perform_sequence([block_read(0)], file.read(2, 0, first))
+        perform_sequence([block_read(2)], file.read(2, 4, second))
+        sequence = [
+            block_read(1),
+            (EBlockPrefetch(['3', '4']), noop)
+        ]
+        perform_sequence(sequence, file.read(2, 2, first))
+        sequence = [
+            block_read(3),
+            (EBlockPrefetch(['5']), noop)
+        ]
+        perform_sequence(sequence, file.read(2, 6, second))
+
+    def test_read_stream(self, file, monkeypatch):
+        monkeypatch.setattr(File, 'read_parallelism', 2)
+        file.dirty = False
+        file.version = 1
+        vlob_id = '1234'
+        content = b'This is a test content.'
+        block_ids = ['4567', '5678', '6789']
+        chunks = [content[:5], content[5:14], content[14:]]
+        blob = [{'blocks': [{'block': block_id, 'digest': digest(chunk), 'size': len(chunk)}
+                            for block_id, chunk in zip(block_ids, chunks)],
+                 'key': to_jsonb64(b'<dummy-key-00000000000000000001>')}]
+        blob = ejson_dumps(blob).encode()
+        blob = to_jsonb64(blob)
+        file._block_index = None
+
+        def consumer(data):
+            return Effect(EConsume(bytes(data)))
+
+        # Data is consumed before the next window of blocks is fetched
+        sequence = [
+            (EVlobRead(vlob_id, '42', 1),
+                const({'id': vlob_id, 'blob': blob, 'version': 1})),
+            (EBlockRead(block_ids[0]),
+                const({'content': to_jsonb64(chunks[0]), 'creation_date': '2012-01-01T00:00:00'})),
+            (EBlockRead(block_ids[1]),
+                const({'content': to_jsonb64(chunks[1]), 'creation_date': '2012-01-01T00:00:00'})),
+            (EConsume(content[3:5]), noop),
+            (EConsume(chunks[1]), noop),
+            (EBlockRead(block_ids[2]),
+                const({'content': to_jsonb64(chunks[2]), 'creation_date': '2012-01-01T00:00:00'})),
+            (EConsume(content[14:16]), noop),
+        ]
+        ret = perform_sequence(sequence, file.read_stream(consumer, size=13, offset=3))
+        assert ret == 13
+        # Empty range
+        ret = perform_sequence([], file.read_stream(consumer, offset=30))
+        assert ret == 0
+
+    def test_get_root_hash(self, file):
+        vlob_id = '1234'
+        file.version = 2
+        file.dirty = False
+        blob = [{'blocks': [{'block': '1', 'digest': digest(b'abc'), 'size': 3}, {'size': 2}],
+                 'key': to_jsonb64(b'<dummy-key-00000000000000000001>')}]
+        file._block_index = BlockIndex(blob, 2)
+        root = to_jsonb64(MerkleTree.from_blocks(blob[0]['blocks']).root)
+        # No block is fetched
+        assert perform_sequence([], file.get_root_hash()) == root
+        # Same content in another version gives the same root
+        sequence = [
+            (EVlobRead(vlob_id, '42', 1),
+                const({'id': vlob_id, 'blob': to_jsonb64(ejson_dumps(blob).encode()),
+                       'version': 1})),
+        ]
+        assert perform_sequence(sequence, file.get_root_hash(1)) == root
+        with pytest.raises(FileError):
+            perform_sequence([], file.get_root_hash(3))
+
+    def test_verify(self, file):
+        blob = [{'blocks': [{'block': '1', 'digest': digest(b'abc'), 'size': 3},
+                            {'block': '2', 'digest': digest(b'de'), 'size': 2},
+                            {'size': 3},
+                            {'block': '3', 'digest': digest(b'f'), 'size': 1}],
+                 'key': to_jsonb64(b'<dummy-key-00000000000000000001>')}]
+        file._block_index = BlockIndex(blob, file.get_version())
+        root = to_jsonb64(file._block_index.tree.root)
+        sequence = [
+            (EBlockRead('1'), const({'content': to_jsonb64(b'abc')})),
+            (EBlockRead('2'), const({'content': to_jsonb64(b'xx')})),
+        ]
+        ret = perform_sequence(sequence, file.verify(max_blocks=2))
+        assert ret == {'root': root, 'next': 2, 'corrupted': [3]}
+        # Scrub is resumed, holes are not fetched
+        sequence = [
+            (EBlockRead('3'), conste(BlockNotFound('Block not found.'))),
+        ]
+        ret = perform_sequence(sequence, file.verify(2, root=root))
+        assert ret == {'root': root, 'next': None, 'corrupted': [8]}
+        # Scrub restarts when the file changed
+        sequence = [
+            (EBlockRead('1'), const({'content': to_jsonb64(b'abc')})),
+        ]
+        ret = perform_sequence(sequence, file.verify(2, max_blocks=1, root='b3RoZXI=\n'))
+        assert ret == {'root': root, 'next': 1, 'corrupted': []}
+
+    def test_verify_stored_root(self, file):
+        blob = [{'blocks': [{'block': '1', 'digest': digest(b'abc'), 'size': 3},
+                            {'block': '2', 'digest': digest(b''), 'size': 2}],
+                 'key': to_jsonb64(b'<dummy-key-00000000000000000001>')}]
+        index = BlockIndex.loads(BlockIndex(blob).to_bytes(), file.get_version())
+        file._block_index = index
+        root = to_jsonb64(index.stored_root)
+        assert perform_sequence([], file.get_root_hash()) == root
+        # Blocks with a legacy digest are only checked for being readable
+        sequence = [
+            (EBlockRead('1'), const({'content': to_jsonb64(b'abc')})),
+            (EBlockRead('2'), const({'content': to_jsonb64(b'xx')})),
+        ]
+        ret = perform_sequence(sequence, file.verify())
+        assert ret == {'root': root, 'next': None, 'corrupted': []}
+        # Entries not matching the recorded root are not trusted
+        index.stored_root = hashlib.sha256(b'other').digest()
+        with pytest.raises(FileError):
+            perform_sequence([], file.verify())
+
+    def test_read_checks_digests(self, file):
+        file.dirty = False
+        file.version = 1
+        blob = [{'blocks': [{'block': '1', 'digest': digest(b'abc'), 'size': 3},
+                            {'block': '2', 'digest': digest(b''), 'size': 2}],
+                 'key': to_jsonb64(b'<dummy-key-00000000000000000001>')}]
+        file._block_index = BlockIndex(blob, 1)
+        # Legacy digests can't be checked
+        sequence = [
+            (EBlockRead('2'), const({'content': to_jsonb64(b'de')})),
+        ]
+        assert perform_sequence(sequence, file.read(offset=3)) == b'de'
+        sequence = [
+            (EBlockRead('1'), const({'content': to_jsonb64(b'abd')})),
+        ]
+        with pytest.raises(BlockIntegrityError):
+            perform_sequence(sequence, file.read(size=3))
+
     def test_write(self, file):
         file.dirty = False
         file.version = 2
@@ -254,6 +678,7 @@ class TestFile:
             (EVlobRead(vlob_id, '42', 1),
                 const({'id': vlob_id, 'blob': blob, 'version': 1}))
         ]
+        file._block_index = None
         ret = perform_sequence(sequence, file.stat())
         assert ret == {'type': 'file',
                        'id': vlob_id,
@@ -264,7 +689,7 @@ class TestFile:
         # TODO check created and updated time are different
         # Truncate in buffer
         file.truncate(20)
-        ret = perform_sequence(sequence, file.stat())
+        ret = perform_sequence([], file.stat())
         assert ret == {'type': 'file',
                        'id': vlob_id,
                        'created': '2012-01-01T00:00:00',
@@ -273,7 +698,7 @@ class TestFile:
                        'version': 1}
         # Write in buffer
         file.write(b'foo', 30)
-        ret = perform_sequence(sequence, file.stat())
+        ret = perform_sequence([], file.stat())
         assert ret == {'type': 'file',
                        'id': vlob_id,
                        'created': '2012-01-01T00:00:00',
@@ -347,11 +772,7 @@ class TestFile:
         sequence = [
             (EVlobRead(vlob_id, '42', 6),  # Discard
                 const({'id': vlob_id, 'blob': blob, 'version': 6})),
-            (EBlockDelete('4567'),
-                conste(BlockNotFound('Block not found.'))),
-            (EBlockDelete('5678'),
-                noop),
-            (EBlockDelete('6789'),
+            (EBlockRelease(['4567', '5678', '6789']),
                 noop),
             (EVlobDelete('1234'),
                 noop),
@@ -368,11 +789,7 @@ class TestFile:
         sequence = [
             (EVlobRead(vlob_id, '42', 7),
                 const({'id': vlob_id, 'blob': new_blob, 'version': 7})),
-            (EBlockDelete('4567'),
-                conste(BlockNotFound('Block not found.'))),
-            (EBlockDelete('7654'),
-                noop),
-            (EBlockDelete('6789'),
+            (EBlockRelease(['4567', '7654', '6789']),
                 noop),
             (EVlobDelete('1234'),
                 noop),
@@ -475,25 +892,18 @@ class TestFile:
         sequence = [
             (EVlobRead(vlob_id, '42', 2),  # Get blocks
                 const({'id': vlob_id, 'blob': blob, 'version': 2})),
-            (EVlobRead(vlob_id, '42', 2),  # Matching blocks
-                const({'id': vlob_id, 'blob': blob, 'version': 2})),
             (EBlockRead(block_ids[1]),
                 const({'content': to_jsonb64(chunk_2), 'creation_date': '2012-01-01T00:00:00'})),
             (EBlockCreate(to_jsonb64(new_chuck_2)),
                 const(new_block_id)),
             (EVlobUpdate(vlob_id, '43', 3, new_blob),
                 noop),
-            (EVlobRead(vlob_id, '42', 3),  # Matching blocks
-                const({'id': vlob_id, 'blob': new_blob, 'version': 3})),
             (EBlockCreate(to_jsonb64(new_chunk_4)),
                 const(new_block_2_id)),
             (EVlobUpdate(vlob_id, '43', 3, new_blob_2),
                 noop),
-            (EVlobRead(vlob_id, '42', 3),
-                const({'id': vlob_id, 'blob': new_blob_2, 'version': 3})),
-            (EBlockDelete('5678'),
-                conste(BlockNotFound('Block not found.'))),
-            (EBlockDelete('6789'),
+            # Block created by the truncate and replaced by the write is released too
+            (EBlockRelease(['5678', '6789', new_block_id]),
                 noop),
         ]
         ret = perform_sequence(sequence, file.flush())
@@ -501,6 +911,111 @@ class TestFile:
         assert file.dirty is True
         assert file.version == 2
 
+    def test_flush_append(self, file, monkeypatch):
+        monkeypatch.setattr(File, 'chunker', FixedSizeChunker(4))
+        vlob_id = '1234'
+
+        def group(blocks, key):
+            return {'blocks': [{'block': block_id, 'digest': digest(data), 'size': len(data)}
+                               for block_id, data in blocks],
+                    'key': to_jsonb64(key)}
+
+        def encode(blob):
+            return to_jsonb64(ejson_dumps(blob).encode())
+
+        empty_group = group([('4567', b'')], b'<dummy-key-00000000000000000001>')
+        abc_group = group([('1', b'abc')], b'<dummy-key-00000000000000000003>')
+        de_group = group([('2', b'de')], b'<dummy-key-00000000000000000004>')
+        packed_group = group([('3', b'abcd'), ('4', b'e')], b'<dummy-key-00000000000000000005>')
+        # Existing blocks are not read back, only new data is chunked
+        file.write(b'abc', 0)
+        sequence = [
+            (EBlockCreate(to_jsonb64(b'abc')), const('1')),
+            (EVlobUpdate(vlob_id, '43', 1, encode([empty_group, abc_group])), noop),
+        ]
+        perform_sequence(sequence, file.flush())
+        # Small tail blocks are packed once they fill a block
+        file.write(b'de', 3)
+        sequence = [
+            (EBlockCreate(to_jsonb64(b'de')), const('2')),
+            (EVlobUpdate(vlob_id, '43', 1, encode([empty_group, abc_group, de_group])), noop),
+            (EBlockRead('4567'), const({'content': to_jsonb64(b'')})),
+            (EBlockRead('1'), const({'content': to_jsonb64(b'abc')})),
+            (EBlockRead('2'), const({'content': to_jsonb64(b'de')})),
+            (EBlockCreate(to_jsonb64(b'abcd')), const('3')),
+            (EBlockCreate(to_jsonb64(b'e')), const('4')),
+            (EVlobUpdate(vlob_id, '43', 1, encode([packed_group])), noop),
+            (EBlockRelease(['4567', '1', '2']), noop),
+        ]
+        perform_sequence(sequence, file.flush())
+        assert file.dirty is True
+
+    def test_sparse(self, file, monkeypatch):
+        monkeypatch.setattr(File, 'chunker', FixedSizeChunker(4))
+        monkeypatch.setattr(File, 'read_ahead_size', 0)
+        vlob_id = '1234'
+
+        def group(blocks, key):
+            return {'blocks': [{'block': block_id, 'digest': digest(data), 'size': len(data)}
+                               for block_id, data in blocks],
+                    'key': to_jsonb64(key)}
+
+        def hole(size):
+            return {'blocks': [{'size': size}], 'key': None}
+
+        def encode(blob):
+            return to_jsonb64(ejson_dumps(blob).encode())
+
+        empty_group = group([('4567', b'')], b'<dummy-key-00000000000000000001>')
+        ab_group = group([('1', b'ab')], b'<dummy-key-00000000000000000003>')
+        xy_group = group([('2', b'XY')], b'<dummy-key-00000000000000000004>')
+        # Growing truncate only records a hole
+        file.truncate(6)
+        assert perform_sequence([], file.stat())['size'] == 6
+        sequence = [
+            (EVlobUpdate(vlob_id, '43', 1, encode([empty_group, hole(6)])), noop),
+        ]
+        perform_sequence(sequence, file.flush())
+        # Writing past the end leaves a hole
+        file.write(b'ab', 8)
+        sequence = [
+            (EBlockCreate(to_jsonb64(b'ab')), const('1')),
+            (EVlobUpdate(vlob_id, '43', 1, encode([empty_group, hole(6), hole(2), ab_group])),
+                noop),
+        ]
+        perform_sequence(sequence, file.flush())
+        # Holes are read as zeros without fetching anything
+        sequence = [
+            (EBlockRead('1'), const({'content': to_jsonb64(b'ab')})),
+        ]
+        assert perform_sequence(sequence, file.read()) == b'\x00' * 8 + b'ab'
+        assert perform_sequence([], file.read(4, 1)) == b'\x00' * 4
+        # Writing inside a hole splits it
+        file.write(b'XY', 2)
+        sequence = [
+            (EBlockCreate(to_jsonb64(b'XY')), const('2')),
+            (EVlobUpdate(vlob_id, '43', 1,
+                         encode([empty_group, hole(2), xy_group, hole(2), hole(2), ab_group])),
+                noop),
+        ]
+        perform_sequence(sequence, file.flush())
+        sequence = [
+            (EBlockRead('2'), const({'content': to_jsonb64(b'XY')})),
+            (EBlockRead('1'), const({'content': to_jsonb64(b'ab')})),
+        ]
+        assert perform_sequence(sequence, file.read()) == b'\x00\x00XY' + b'\x00' * 4 + b'ab'
+        # Shrinking truncate cuts the hole
+        file.truncate(3)
+        sequence = [
+            (EBlockRead('2'), const({'content': to_jsonb64(b'XY')})),
+            (EBlockCreate(to_jsonb64(b'X')), const('3')),
+            (EVlobUpdate(vlob_id, '43', 1, encode([
+                hole(2), group([('3', b'X')], b'<dummy-key-00000000000000000005>')])), noop),
+            (EBlockRelease(['4567', '2', '1']), noop),
+        ]
+        perform_sequence(sequence, file.flush())
+        assert perform_sequence([], file.stat())['size'] == 3
+
     def test_commit(self, file):
         vlob_id = '1234'
         content = b'This is a test content.'
@@ -537,9 +1052,8 @@ class TestFile:
         new_blob = ejson_dumps(new_blob).encode()
         new_blob = to_jsonb64(new_blob)
         file.truncate(9)
+        file._block_index = None
         sequence = [
-            (EVlobRead('1234', '42', 1),
-                const({'id': '1234', 'blob': blob, 'version': 1})),
             (EVlobRead('1234', '42', 1),
                 const({'id': '1234', 'blob': blob, 'version': 1})),
             (EBlockRead(block_ids[1]),
@@ -548,14 +1062,8 @@ class TestFile:
                 const(new_block_id)),
             (EVlobUpdate(vlob_id, '43', 1, new_blob),
                 noop),
-            (EVlobRead('1234', '42', 1),
-                const({'id': '1234', 'blob': new_blob, 'version': 1})),
-            (EBlockDelete('5678'),
-                conste(BlockNotFound('Block not found.'))),
-            (EBlockDelete('6789'),
+            (EBlockRelease(['5678', '6789']),
                 noop),
-            (EVlobRead('1234', '42', 1),
-                const({'id': '1234', 'blob': new_blob, 'version': 1})),
             (EBlockSynchronize('4567'),
                 const(True)),
             (EBlockSynchronize('7654'),
@@ -569,6 +1077,46 @@ class TestFile:
         assert file.dirty is False
         assert file.version == 1
 
+    def test_compact(self, file, monkeypatch):
+        monkeypatch.setattr(File, 'chunker', FixedSizeChunker(4))
+        monkeypatch.setattr(File, 'compaction_threshold', 2)
+        vlob_id = '1234'
+
+        def group(blocks, key):
+            return {'blocks': [{'block': block_id, 'digest': digest(data), 'size': len(data)}
+                               for block_id, data in blocks],
+                    'key': to_jsonb64(key)}
+
+        key_1 = b'<dummy-key-00000000000000000011>'
+        key_2 = b'<dummy-key-00000000000000000012>'
+        blob = [group([('1', b'abcd'), ('2', b'e')], key_1),
+                group([('3', b'fg')], key_2),
+                {'blocks': [{'size': 3}], 'key': None},
+                group([('4', b'h'), ('5', b'ijkl'), ('6', b'm')], key_2)]
+        file._block_index = BlockIndex(blob, file.get_version())
+        # Isolated undersized blocks are left as is
+        assert perform_sequence([], file.compact(threshold=3)) == 0
+        new_blob = [group([('1', b'abcd')], key_1),
+                    group([('7', b'efg')], b'<dummy-key-00000000000000000003>'),
+                    blob[2],
+                    blob[3]]
+        sequence = [
+            (EBlockRead('2'), const({'content': to_jsonb64(b'e')})),
+            (EBlockRead('3'), const({'content': to_jsonb64(b'fg')})),
+            (EBlockCreate(to_jsonb64(b'efg')), const('7')),
+            (EVlobUpdate(vlob_id, '43', 1, to_jsonb64(ejson_dumps(new_blob).encode())), noop),
+            (EBlockRelease(['2', '3']), noop),
+            (EBlockSynchronize('1'), const(True)),
+            (EBlockSynchronize('7'), const(True)),
+            (EBlockSynchronize('4'), const(True)),
+            (EBlockSynchronize('5'), const(True)),
+            (EBlockSynchronize('6'), const(True)),
+            (EVlobSynchronize(vlob_id), const(True)),
+        ]
+        # Fragmented files are compacted on commit
+        perform_sequence(sequence, file.commit())
+        assert perform_sequence([], file.compact()) == 0
+
     def test_discard(self, file):
         content = b'This is a test content.'
         block_ids = ['4567', '5678', '6789']
@@ -590,14 +1138,11 @@ class TestFile:
         blob = ejson_dumps(blob).encode()
         blob = to_jsonb64(blob)
         # Already synchronized
+        file._block_index = None
         sequence = [
             (EVlobRead('1234', '42', 1),
                 const({'id': '1234', 'blob': blob, 'version': 1})),
-            (EBlockDelete('4567'),
-                conste(BlockNotFound('Block not found.'))),
-            (EBlockDelete('5678'),
-                noop),
-            (EBlockDelete('6789'),
+            (EBlockRelease(['4567', '5678', '6789']),
                 noop),
             (EVlobDelete('1234'),
                 conste(VlobNotFound('Block not found.')))  # TODO vlob OR block exceptin
@@ -610,11 +1155,7 @@ class TestFile:
         sequence = [
             (EVlobRead('1234', '42', 1),
                 const({'id': '1234', 'blob': blob, 'version': 1})),
-            (EBlockDelete('4567'),
-                noop),
-            (EBlockDelete('5678'),
-                noop),
-            (EBlockDelete('6789'),
+            (EBlockRelease(['4567', '5678', '6789']),
                 noop),
             (EVlobDelete('1234'),
                 noop)
@@ -650,6 +1191,69 @@ class TestFile:
             assert block['digest'] == digest(content[index * block_size:index + 1 * block_size])
         assert file.dirty is True
 
+    def test_build_deduplicated_file_blocks(self, file, monkeypatch):
+        monkeypatch.setattr(File, 'dedup_secret', b'secret')
+        file.dirty = False
+        chunk = b'a' * 4096
+        content = chunk * 2 + b'b'
+        chunk_key = derive_sym_key(b'secret', chunk).key
+        chunk_id = hashlib.sha256(chunk_key).hexdigest()
+        tail_key = derive_sym_key(b'secret', b'b').key
+        tail_id = hashlib.sha256(tail_key).hexdigest()
+        sequence = [
+            (EBlockCreate(to_jsonb64(chunk), chunk_id), const(chunk_id)),
+            (EBlockCreate(to_jsonb64(chunk), chunk_id), const(chunk_id)),
+            (EBlockCreate(to_jsonb64(b'b'), tail_id), const(tail_id)),
+        ]
+        blocks = perform_sequence(sequence, file._build_file_blocks(content))
+        assert blocks == {'blocks': [{'block': chunk_id,
+                                      'digest': digest(chunk),
+                                      'key': to_jsonb64(chunk_key),
+                                      'size': 4096},
+                                     {'block': chunk_id,
+                                      'digest': digest(chunk),
+                                      'key': to_jsonb64(chunk_key),
+                                      'size': 4096},
+                                     {'block': tail_id,
+                                      'digest': digest(b'b'),
+                                      'key': to_jsonb64(tail_key),
+                                      'size': 1}],
+                          'key': None}
+        assert file.dirty is True
+        # Blocks are read back with their own key
+        file._block_index = BlockIndex([blocks], file.get_version())
+        sequence = [
+            (EBlockRead(chunk_id), const({'content': to_jsonb64(chunk)})),
+            (EBlockRead(tail_id), const({'content': to_jsonb64(b'b')})),
+        ]
+        read_content = perform_sequence(sequence, file.read(offset=4096))
+        assert read_content == chunk + b'b'
+
+    def test_build_compressed_file_blocks(self, file, monkeypatch):
+        monkeypatch.setattr(File, 'compressor', ZlibCompressor())
+        chunk = b'a' * 4096
+        content = chunk + b'b'
+        sequence = [
+            (EBlockCreate(to_jsonb64(zlib.compress(chunk, 6))), const('1')),
+            # Incompressible data is stored raw
+            (EBlockCreate(to_jsonb64(b'b')), const('2')),
+        ]
+        blocks = perform_sequence(sequence, file._build_file_blocks(content))
+        assert blocks['blocks'] == [{'block': '1',
+                                     'compression': 'zlib',
+                                     'digest': digest(chunk),
+                                     'size': 4096},
+                                    {'block': '2',
+                                     'digest': digest(b'b'),
+                                     'size': 1}]
+        # Blocks are decompressed transparently
+        file._block_index = BlockIndex([blocks], file.get_version())
+        sequence = [
+            (EBlockRead('1'), const({'content': to_jsonb64(zlib.compress(chunk))})),
+            (EBlockRead('2'), const({'content': to_jsonb64(b'b')})),
+        ]
+        assert perform_sequence(sequence, file.read()) == content
+
     def test_find_matching_blocks(self, file):
         vlob_id = '1234'
         block_size = 4096
@@ -692,11 +1296,13 @@ class TestFile:
         blob = ejson_dumps([blocks[i] for i in range(0, len(blocks))]).encode()
         blob = to_jsonb64(blob)
         # All matching blocks
+        file._block_index = None
         sequence = [
             (EVlobRead(vlob_id, '42', 1),
                 const({'id': vlob_id, 'blob': blob, 'version': 1}))
         ]
         matching_blocks = perform_sequence(sequence, file._find_matching_blocks())
+        regroup(matching_blocks)
         assert matching_blocks == {'pre_excluded_blocks': [],
                                    'pre_excluded_data': b'',
                                    'pre_included_data': b'',
@@ -710,13 +1316,12 @@ class TestFile:
         offset = (blocks[0]['blocks'][0]['size'] + blocks[0]['blocks'][1]['size'] +
                   blocks[1]['blocks'][0]['size'] + blocks[2]['blocks'][0]['size'] - delta)
         sequence = [
-            (EVlobRead(vlob_id, '42', 1),
-                const({'id': vlob_id, 'blob': blob, 'version': 1})),
             (EBlockRead('2003'),
                 const({'content': block_contents['2003'],
-                           'creation_date': '2012-01-01T00:00:00'}))
+                       'creation_date': '2012-01-01T00:00:00'}))
         ]
         matching_blocks = perform_sequence(sequence, file._find_matching_blocks(None, offset))
+        regroup(matching_blocks)
         pre_excluded_data = contents[2][:blocks[2]['blocks'][0]['size'] - delta]
         pre_included_data = contents[2][-delta:]
         assert matching_blocks == {'pre_excluded_blocks': [blocks[0], blocks[1]],
@@ -733,13 +1338,12 @@ class TestFile:
         offset = (blocks[0]['blocks'][0]['size'] + blocks[0]['blocks'][1]['size'] +
                   blocks[1]['blocks'][0]['size'] + blocks[2]['blocks'][0]['size'] - delta)
         sequence = [
-            (EVlobRead(vlob_id, '42', 1),
-                const({'id': vlob_id, 'blob': blob, 'version': 1})),
             (EBlockRead(id='2003'),
                 const({'content': block_contents['2003'],
                        'creation_date': '2012-01-01T00:00:00'}))
         ]
         matching_blocks = perform_sequence(sequence, file._find_matching_blocks(size, offset))
+        regroup(matching_blocks)
         pre_excluded_data = contents[2][:blocks[2]['blocks'][0]['size'] - delta]
         pre_included_data = contents[2][-delta:][:size]
         post_excluded_data = contents[2][-delta:][size:]
@@ -761,8 +1365,6 @@ class TestFile:
         offset = (blocks[0]['blocks'][0]['size'] + blocks[0]['blocks'][1]['size'] +
                   blocks[1]['blocks'][0]['size'] + blocks[2]['blocks'][0]['size'] - delta)
         sequence = [
-            (EVlobRead(vlob_id, '42', 1),
-                const({'id': vlob_id, 'blob': blob, 'version': 1})),
             (EBlockRead('2003'),
                 const({'content': block_contents['2003'],
                        'creation_date': '2012-01-01T00:00:00'})),
@@ -771,6 +1373,7 @@ class TestFile:
                        'creation_date': '2012-01-01T00:00:00'}))
         ]
         matching_blocks = perform_sequence(sequence, file._find_matching_blocks(size, offset))
+        regroup(matching_blocks)
         pre_excluded_data = contents[2][:-delta]
         pre_included_data = contents[2][-delta:]
         post_included_data = contents[4][:2 * delta]
@@ -791,11 +1394,9 @@ class TestFile:
         size += blocks[3]['blocks'][2]['size']
         offset = (blocks[0]['blocks'][0]['size'] + blocks[0]['blocks'][1]['size'] +
                   blocks[1]['blocks'][0]['size'] + blocks[2]['blocks'][0]['size'])
-        sequence = [
-            (EVlobRead(vlob_id, '42', 1),
-                const({'id': vlob_id, 'blob': blob, 'version': 1})),
-        ]
+        sequence = []
         matching_blocks = perform_sequence(sequence, file._find_matching_blocks(size, offset))
+        regroup(matching_blocks)
         assert matching_blocks == {'pre_excluded_blocks': [blocks[0], blocks[1], blocks[2]],
                                    'pre_excluded_data': b'',
                                    'pre_included_data': b'',
@@ -805,11 +1406,9 @@ class TestFile:
                                    'post_excluded_blocks': [blocks[4], blocks[5]]
                                    }
         # With total size
-        sequence = [
-            (EVlobRead(vlob_id, '42', 1),
-                const({'id': vlob_id, 'blob': blob, 'version': 1})),
-        ]
+        sequence = []
         matching_blocks = perform_sequence(sequence, file._find_matching_blocks(total_length, 0))
+        regroup(matching_blocks)
         assert matching_blocks == {'pre_excluded_blocks': [],
                                    'pre_excluded_data': b'',
                                    'pre_included_data': b'',
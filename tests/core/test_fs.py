@@ -5,17 +5,23 @@ from effect2.testing import const, conste, noop, perform_sequence
 from freezegun import freeze_time
 from unittest.mock import Mock
 
+from parsec.base import ERegisterEvent, EUnregisterEvent
+from parsec.core.client_connection import EClientId
 from parsec.core.file import File
+from parsec.core.merkle import MerkleTree
 from parsec.core.fs import (FSComponent, ESynchronize, EGroupCreate, EDustbinShow, EManifestHistory,
-                            EManifestRestore, EFileCreate, EFileRead, EFileWrite, EFileTruncate,
-                            EFileHistory, EFileRestore, EFolderCreate, EStat, EMove, EDelete,
-                            EUndelete)
+                            EManifestRestore, EFileCreate, EFileOpen, EFileClose,
+                            EFileHandlesRelease, EFileRead,
+                            EFileReadStream, EFileWrite, EFileTruncate, EFileHistory, EFileRestore,
+                            EFileRootHash, EFileVerify, EFolderCreate, EStat, EMove, ECopy,
+                            EDelete, EUndelete)
 from parsec.core.identity import EIdentityGet, IdentityComponent, Identity
 from parsec.core.synchronizer import (
     EUserVlobSynchronize, EUserVlobRead, EUserVlobUpdate, EVlobCreate, EVlobList, EVlobRead,
-    EVlobUpdate, EVlobDelete, EBlockCreate, EBlockDelete, SynchronizerComponent)
+    EVlobUpdate, EVlobDelete, EBlockCreate, EBlockRelease, EBlockRead, EBlockReference,
+    SynchronizerComponent)
 from parsec.exceptions import (
-    ManifestError, BlockNotFound, VlobNotFound)
+    FileError, ManifestError, VlobNotFound)
 from parsec.tools import ejson_dumps, to_jsonb64, digest
 
 
@@ -61,7 +67,7 @@ def file(app, alice_identity, mock_crypto_passthrough):
     ]
     ret = perform_sequence(sequence, eff)
     assert ret is None
-    File.files = {}
+    File.files.clear()
 
 
 def test_perform_synchronize(app, alice_identity):
@@ -71,7 +77,6 @@ def test_perform_synchronize(app, alice_identity):
     eff = app.perform_synchronize(ESynchronize())
     sequence = [
         (EIdentityGet(), const(alice_identity)),
-        (EVlobList(), const([])),
         (EUserVlobUpdate(1, blob), noop),
         (EUserVlobSynchronize(), noop)
     ]
@@ -110,8 +115,8 @@ def test_perform_dustbin_show(app, alice_identity, file):
             (EVlobList(), const([])),
             (EVlobRead(vlob['id'], vlob['read_trust_seed'], 1),
                 const({'id': vlob['id'], 'blob': blob, 'version': 1})),
-            (EBlockDelete('4567'),
-                conste(BlockNotFound('Block not found.'))),
+            (EBlockRelease(['4567']),
+                noop),
             (EVlobDelete('2345'),
                 conste(VlobNotFound('Vlob not found.'))),
         ]
@@ -158,9 +163,7 @@ def test_perform_file_create(app, alice_identity, file):
         (EBlockCreate(''), const(block_id)),
         (EVlobCreate(blob), const(vlob)),
         (EIdentityGet(), const(alice_identity)),
-        (EVlobRead(vlob['id'], vlob['read_trust_seed'], 1),
-            const({'id': vlob['id'], 'blob': blob, 'version': 1})),
-        (EBlockDelete(block_id), noop),
+        (EBlockRelease([block_id]), noop),
         (EVlobDelete(vlob['id']), noop),
     ]
     with pytest.raises(ManifestError):
@@ -188,6 +191,109 @@ def test_perform_file_read(app, file, alice_identity):
     assert file == b''
 
 
+def test_perform_file_open_close(app, file, alice_identity):
+    vlob = {'id': '2345', 'read_trust_seed': '42', 'write_trust_seed': '43'}
+    blob = [{'blocks': [{'block': '4567', 'digest': digest(b''), 'size': 0}],
+             'key': to_jsonb64(b'<dummy-key-00000000000000000001>')}]
+    blob = ejson_dumps(blob).encode()
+    blob = to_jsonb64(blob)
+    eff = app.perform_file_open(EFileOpen('/foo'))
+    sequence = [
+        (EIdentityGet(), const(alice_identity)),
+        (EIdentityGet(), const(alice_identity)),
+        (EVlobRead(vlob['id'], vlob['read_trust_seed']),
+            const({'id': vlob['id'], 'blob': blob, 'version': 1})),
+        (EVlobList(),
+            const([vlob['id']])),
+        (EClientId(), const('client')),
+        (ERegisterEvent(EFileHandlesRelease, 'client_disconnected', 'client'), noop),
+    ]
+    handle = perform_sequence(sequence, eff)
+    sequence = [
+        (EIdentityGet(), const(alice_identity)),
+        (EIdentityGet(), const(alice_identity)),
+        (EClientId(), const('client')),
+    ]
+    other_handle = perform_sequence(sequence, app.perform_file_open(EFileOpen('/foo')))
+    assert handle != other_handle
+    # No path resolution when using the handle
+    eff = app.perform_file_read(EFileRead(None, handle=handle))
+    sequence = [
+        (EClientId(), const('client')),
+        (EVlobRead(vlob['id'], vlob['read_trust_seed'], 1),
+            const({'id': vlob['id'], 'blob': blob, 'version': 1}))
+    ]
+    assert perform_sequence(sequence, eff) == b''
+    sequence = [(EClientId(), const('client'))]
+    perform_sequence(sequence, app.perform_file_write(EFileWrite(None, b'foo', 0, handle=handle)))
+    perform_sequence(sequence, app.perform_file_truncate(EFileTruncate(None, 2, handle=handle)))
+    assert app.handles['client'][handle].file.modifications
+    # Handles are scoped to the client connection
+    with pytest.raises(FileError):
+        perform_sequence([(EClientId(), const('other client'))],
+                         app.perform_file_read(EFileRead(None, handle=handle)))
+    with pytest.raises(FileError):
+        perform_sequence([(EClientId(), const('other client'))],
+                         app.perform_file_close(EFileClose(handle)))
+    perform_sequence(sequence, app.perform_file_close(EFileClose(handle)))
+    perform_sequence(sequence, app.perform_file_close(EFileClose(other_handle)))
+    assert not app.handles['client']
+    with pytest.raises(FileError):
+        perform_sequence(sequence, app.perform_file_read(EFileRead(None, handle=handle)))
+    with pytest.raises(FileError):
+        perform_sequence(sequence, app.perform_file_close(EFileClose(handle)))
+
+
+def test_perform_file_handles_release(app, file, alice_identity):
+    blob = [{'blocks': [{'block': '4567', 'digest': digest(b''), 'size': 0}],
+             'key': to_jsonb64(b'<dummy-key-00000000000000000001>')}]
+    blob = to_jsonb64(ejson_dumps(blob).encode())
+    sequence = [
+        (EIdentityGet(), const(alice_identity)),
+        (EIdentityGet(), const(alice_identity)),
+        (EVlobRead('2345', '42'),
+            const({'id': '2345', 'blob': blob, 'version': 1})),
+        (EVlobList(),
+            const([])),
+        (EClientId(), const('client')),
+        (ERegisterEvent(EFileHandlesRelease, 'client_disconnected', 'client'), noop),
+    ]
+    handle = perform_sequence(sequence, app.perform_file_open(EFileOpen('/foo')))
+    opened_file = app.handles['client'][handle].file
+    assert File.files._references[opened_file.id] == 1
+    # Handles left open are released when the client disconnects
+    sequence = [
+        (EUnregisterEvent(EFileHandlesRelease, 'client_disconnected', 'client'), noop),
+    ]
+    eff = app.perform_file_handles_release(EFileHandlesRelease('client_disconnected', 'client'))
+    perform_sequence(sequence, eff)
+    assert app.handles == {}
+    assert opened_file.id not in File.files._references
+
+
+def test_perform_file_read_stream(app, file, alice_identity):
+    vlob = {'id': '2345', 'read_trust_seed': '42', 'write_trust_seed': '43'}
+    blob = [{'blocks': [{'block': '4567', 'digest': digest(b''), 'size': 0}],
+             'key': to_jsonb64(b'<dummy-key-00000000000000000001>')}]
+    blob = ejson_dumps(blob).encode()
+    blob = to_jsonb64(blob)
+    consumer = Mock()
+    eff = app.perform_file_read_stream(EFileReadStream('/foo', consumer))
+    sequence = [
+        (EIdentityGet(), const(alice_identity)),
+        (EIdentityGet(), const(alice_identity)),
+        (EVlobRead(vlob['id'], vlob['read_trust_seed']),
+            const({'id': vlob['id'], 'blob': blob, 'version': 1})),
+        (EVlobList(),
+            const([vlob['id']])),
+        (EVlobRead(vlob['id'], vlob['read_trust_seed'], 1),
+            const({'id': vlob['id'], 'blob': blob, 'version': 1}))
+    ]
+    ret = perform_sequence(sequence, eff)
+    assert ret == 0
+    consumer.assert_not_called()
+
+
 def test_perform_file_write(app, file, alice_identity):
     vlob = {'id': '2345', 'read_trust_seed': '42', 'write_trust_seed': '43'}
     blob = [{'blocks': [{'block': '4567', 'digest': digest(b''), 'size': 0}],
@@ -205,6 +311,8 @@ def test_perform_file_write(app, file, alice_identity):
     ]
     ret = perform_sequence(sequence, eff)
     assert ret is None
+    # Recorded in the manifest holding the file
+    assert app.user_manifest.modified_files == {vlob['id']: '/foo'}
 
 
 def test_perform_file_truncate(app, file, alice_identity):
@@ -224,6 +332,53 @@ def test_perform_file_truncate(app, file, alice_identity):
     ]
     ret = perform_sequence(sequence, eff)
     assert ret is None
+    assert app.user_manifest.modified_files == {vlob['id']: '/foo'}
+
+
+def test_perform_file_root_hash(app, file, alice_identity):
+    vlob = {'id': '2345', 'read_trust_seed': '42', 'write_trust_seed': '43'}
+    blob = [{'blocks': [{'block': '4567', 'digest': digest(b''), 'size': 0}],
+             'key': to_jsonb64(b'<dummy-key-00000000000000000001>')}]
+    blob = ejson_dumps(blob).encode()
+    blob = to_jsonb64(blob)
+    eff = app.perform_file_root_hash(EFileRootHash('/foo'))
+    sequence = [
+        (EIdentityGet(), const(alice_identity)),
+        (EIdentityGet(), const(alice_identity)),
+        (EVlobRead(vlob['id'], vlob['read_trust_seed']),
+            const({'id': vlob['id'], 'blob': blob, 'version': 1})),
+        (EVlobList(),
+            const([vlob['id']])),
+        (EVlobRead(vlob['id'], vlob['read_trust_seed'], 1),
+            const({'id': vlob['id'], 'blob': blob, 'version': 1}))
+    ]
+    ret = perform_sequence(sequence, eff)
+    assert ret == to_jsonb64(MerkleTree.from_blocks([{'digest': digest(b''), 'size': 0,
+                                                      'block': '4567'}]).root)
+
+
+def test_perform_file_verify(app, file, alice_identity):
+    vlob = {'id': '2345', 'read_trust_seed': '42', 'write_trust_seed': '43'}
+    blob = [{'blocks': [{'block': '4567', 'digest': digest(b''), 'size': 0}],
+             'key': to_jsonb64(b'<dummy-key-00000000000000000001>')}]
+    blob = ejson_dumps(blob).encode()
+    blob = to_jsonb64(blob)
+    eff = app.perform_file_verify(EFileVerify('/foo'))
+    sequence = [
+        (EIdentityGet(), const(alice_identity)),
+        (EIdentityGet(), const(alice_identity)),
+        (EVlobRead(vlob['id'], vlob['read_trust_seed']),
+            const({'id': vlob['id'], 'blob': blob, 'version': 1})),
+        (EVlobList(),
+            const([vlob['id']])),
+        (EVlobRead(vlob['id'], vlob['read_trust_seed'], 1),
+            const({'id': vlob['id'], 'blob': blob, 'version': 1})),
+        (EBlockRead('4567'),
+            const({'content': to_jsonb64(b'')}))
+    ]
+    ret = perform_sequence(sequence, eff)
+    assert ret['next'] is None
+    assert ret['corrupted'] == []
 
 
 @pytest.mark.xfail
@@ -261,7 +416,7 @@ def test_perform_file_restore(app, file, alice_identity):
             const([])),
         (EVlobRead(vlob['id'], vlob['read_trust_seed'], 2),
             const({'id': vlob['id'], 'blob': blob, 'version': 2})),
-        (EBlockDelete('4567'),
+        (EBlockRelease(['4567']),
             noop),
         (EVlobDelete(vlob['id']),
             noop),
@@ -271,6 +426,7 @@ def test_perform_file_restore(app, file, alice_identity):
             noop),
     ]
     perform_sequence(sequence, eff)
+    assert app.user_manifest.modified_files == {vlob['id']: '/foo'}
 
 
 def test_perform_folder_create(app, alice_identity):
@@ -310,6 +466,67 @@ def test_perform_move(app, alice_identity):
     assert ret is None
 
 
+def test_perform_copy(app, file, alice_identity):
+    vlob = {'id': '2345', 'read_trust_seed': '42', 'write_trust_seed': '43'}
+    new_vlob = {'id': '3456', 'read_trust_seed': '44', 'write_trust_seed': '45'}
+    blob = [{'blocks': [{'block': '4567', 'digest': digest(b''), 'size': 0}],
+             'key': to_jsonb64(b'<dummy-key-00000000000000000001>')}]
+    blob = ejson_dumps(blob).encode()
+    blob = to_jsonb64(blob)
+    eff = app.perform_copy(ECopy('/foo', '/bar'))
+    # Only the block map is written, blocks are shared
+    sequence = [
+        (EIdentityGet(), const(alice_identity)),
+        (EIdentityGet(), const(alice_identity)),
+        (EVlobRead(vlob['id'], vlob['read_trust_seed']),
+            const({'id': vlob['id'], 'blob': blob, 'version': 1})),
+        (EVlobList(),
+            const([vlob['id']])),
+        (EVlobRead(vlob['id'], vlob['read_trust_seed'], 1),
+            const({'id': vlob['id'], 'blob': blob, 'version': 1})),
+        (EBlockReference(['4567']),
+            noop),
+        (EVlobCreate(blob),
+            const(new_vlob)),
+        (EIdentityGet(), const(alice_identity))
+    ]
+    ret = perform_sequence(sequence, eff)
+    assert ret is None
+    assert app.user_manifest.entries['/bar']['id'] == new_vlob['id']
+
+
+def test_perform_copy_bad_destination(app, file, alice_identity):
+    vlob = {'id': '2345', 'read_trust_seed': '42', 'write_trust_seed': '43'}
+    new_vlob = {'id': '3456', 'read_trust_seed': '44', 'write_trust_seed': '45'}
+    blob = [{'blocks': [{'block': '4567', 'digest': digest(b''), 'size': 0}],
+             'key': to_jsonb64(b'<dummy-key-00000000000000000001>')}]
+    blob = ejson_dumps(blob).encode()
+    blob = to_jsonb64(blob)
+    eff = app.perform_copy(ECopy('/foo', '/foo'))
+    sequence = [
+        (EIdentityGet(), const(alice_identity)),
+        (EIdentityGet(), const(alice_identity)),
+        (EVlobRead(vlob['id'], vlob['read_trust_seed']),
+            const({'id': vlob['id'], 'blob': blob, 'version': 1})),
+        (EVlobList(),
+            const([vlob['id']])),
+        (EVlobRead(vlob['id'], vlob['read_trust_seed'], 1),
+            const({'id': vlob['id'], 'blob': blob, 'version': 1})),
+        (EBlockReference(['4567']),
+            noop),
+        (EVlobCreate(blob),
+            const(new_vlob)),
+        (EIdentityGet(), const(alice_identity)),
+        # Copy is discarded, shared blocks only lose a reference
+        (EBlockRelease(['4567']),
+            noop),
+        (EVlobDelete(new_vlob['id']),
+            noop)
+    ]
+    with pytest.raises(ManifestError):
+        perform_sequence(sequence, eff)
+
+
 def test_perform_delete(app, alice_identity):
     eff = app.perform_folder_create(EFolderCreate('/dir'))
     sequence = [
@@ -339,12 +556,18 @@ def test_perform_undelete(app, alice_identity, file):
             const([])),
         (EVlobRead(vlob['id'], vlob['read_trust_seed'], 1),
             const({'id': vlob['id'], 'blob': blob, 'version': 1})),
-        (EBlockDelete('4567'),
-            conste(BlockNotFound('Block not found.'))),
+        (EBlockRelease(['4567']),
+            noop),
         (EVlobDelete('2345'),
             conste(VlobNotFound('Vlob not found.')))
     ]
     ret = perform_sequence(sequence, eff)
+    # Files of the dustbin only leave the manifest modified when updated
+    app.user_manifest.modified = False
+    sequence = [(EIdentityGet(), const(alice_identity))] * 4
+    perform_sequence(sequence, app.perform_file_write(EFileWrite('/foo', b'foo', 0)))
+    assert app.user_manifest.modified is True
+    assert vlob['id'] not in app.user_manifest.modified_files
     eff = app.perform_undelete(EUndelete('2345'))
     sequence = [
         (EIdentityGet(), const(alice_identity))
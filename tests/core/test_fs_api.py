@@ -1,13 +1,16 @@
 import pytest
 from effect2.testing import const, noop, perform_sequence
 
+from parsec.core.client_connection import EClientSend
 from parsec.core.core_api import execute_cmd
 from parsec.core.fs import (
     ESynchronize, EGroupCreate, EDustbinShow, EManifestHistory, EManifestRestore,
-    EFileCreate, EFileRead, EFileWrite, EFileTruncate, EFileHistory, EFileRestore, EFolderCreate,
-    EStat, EMove, EDelete, EUndelete
+    EFileCreate, EFileOpen, EFileClose, EFileRead, EFileReadStream, EFileWrite, EFileTruncate,
+    EFileHistory, EFileRestore, EFileRootHash, EFileVerify, EFolderCreate, EStat, EMove, ECopy,
+    EDelete, EUndelete
 )
-from parsec.tools import to_jsonb64
+from parsec.core.fs_api import STREAM_FRAME_SIZE, send_file_read_frames
+from parsec.tools import ejson_dumps, to_jsonb64
 
 
 def test_api_synchronize():
@@ -87,6 +90,48 @@ def test_api_file_create():
     assert resp == {'status': 'ok'}
 
 
+def test_api_file_open():
+    eff = execute_cmd('file_open', {'path': '/foo'})
+    sequence = [
+        (EFileOpen('/foo'),
+            const(1)),
+    ]
+    resp = perform_sequence(sequence, eff)
+    assert resp == {'status': 'ok', 'handle': 1}
+
+
+def test_api_file_close():
+    eff = execute_cmd('file_close', {'handle': 1})
+    sequence = [
+        (EFileClose(1),
+            noop),
+    ]
+    resp = perform_sequence(sequence, eff)
+    assert resp == {'status': 'ok'}
+
+
+def test_api_file_read_by_handle():
+    eff = execute_cmd('file_read', {'handle': 1, 'size': 3})
+    sequence = [
+        (EFileRead(None, 0, 3, 1),
+            const('foo')),
+    ]
+    resp = perform_sequence(sequence, eff)
+    assert resp == {'status': 'ok', 'content': 'foo'}
+
+
+@pytest.mark.parametrize('bad_msg', [
+    {'path': '/foo', 'handle': 1},
+    {'handle': 'foo'},
+    {'offset': 0},
+])
+def test_api_file_read_bad_msg(bad_msg):
+    eff = execute_cmd('file_read', bad_msg)
+    sequence = []
+    resp = perform_sequence(sequence, eff)
+    assert resp['status'] == 'bad_msg'
+
+
 def test_api_file_read():
     eff = execute_cmd('file_read', {'path': '/foo'})
     sequence = [
@@ -97,6 +142,29 @@ def test_api_file_read():
     assert resp == {'status': 'ok', 'content': 'foo'}
 
 
+def test_api_file_read_stream():
+    eff = execute_cmd('file_read', {'path': '/foo', 'offset': 3, 'stream': True})
+    sequence = [
+        (EFileReadStream('/foo', send_file_read_frames, 3, None),
+            const(42)),
+    ]
+    resp = perform_sequence(sequence, eff)
+    assert resp == {'status': 'ok', 'content': '', 'more': False}
+
+
+def test_send_file_read_frames():
+    data = b'a' * STREAM_FRAME_SIZE + b'b'
+    sequence = [
+        (EClientSend(ejson_dumps({'status': 'ok',
+                                  'content': to_jsonb64(b'a' * STREAM_FRAME_SIZE),
+                                  'more': True})),
+            noop),
+        (EClientSend(ejson_dumps({'status': 'ok', 'content': to_jsonb64(b'b'), 'more': True})),
+            noop),
+    ]
+    perform_sequence(sequence, send_file_read_frames(memoryview(data)))
+
+
 def test_api_file_write():
     eff = execute_cmd('file_write', {'path': '/foo', 'content': to_jsonb64(b'foo'), 'offset': 0})
     sequence = [
@@ -107,6 +175,16 @@ def test_api_file_write():
     assert resp == {'status': 'ok'}
 
 
+def test_api_file_write_by_handle():
+    eff = execute_cmd('file_write', {'handle': 1, 'content': to_jsonb64(b'foo'), 'offset': 2})
+    sequence = [
+        (EFileWrite(None, b'foo', 2, 1),
+            noop),
+    ]
+    resp = perform_sequence(sequence, eff)
+    assert resp == {'status': 'ok'}
+
+
 def test_api_file_truncate():
     eff = execute_cmd('file_truncate', {'path': '/foo', 'length': 5})
     sequence = [
@@ -117,6 +195,39 @@ def test_api_file_truncate():
     assert resp == {'status': 'ok'}
 
 
+def test_api_file_root_hash():
+    eff = execute_cmd('file_root_hash', {'path': '/foo', 'version': 2})
+    sequence = [
+        (EFileRootHash('/foo', 2),
+            const('cm9vdA==\n')),
+    ]
+    resp = perform_sequence(sequence, eff)
+    assert resp == {'status': 'ok', 'root': 'cm9vdA==\n'}
+
+
+def test_api_file_verify():
+    eff = execute_cmd('file_verify', {'path': '/foo', 'max_blocks': 10})
+    sequence = [
+        (EFileVerify('/foo', 0, 10, None),
+            const({'root': 'cm9vdA==\n', 'next': 10, 'corrupted': [4096]})),
+    ]
+    resp = perform_sequence(sequence, eff)
+    assert resp == {'status': 'ok', 'root': 'cm9vdA==\n', 'next': 10, 'corrupted': [4096]}
+
+
+@pytest.mark.parametrize('bad_msg', [
+    {'path': '/foo', 'start': -1},
+    {'path': '/foo', 'max_blocks': 'foo'},
+    {'path': '/foo', 'unknown': 'field'},
+    {}
+])
+def test_api_file_verify_bad_msg(bad_msg):
+    eff = execute_cmd('file_verify', bad_msg)
+    sequence = []
+    resp = perform_sequence(sequence, eff)
+    assert resp['status'] == 'bad_msg'
+
+
 @pytest.mark.xfail
 def test_api_file_history():
     raise NotImplementedError()
@@ -159,6 +270,16 @@ def test_api_move():
     assert resp == {'status': 'ok'}
 
 
+def test_api_file_copy():
+    eff = execute_cmd('file_copy', {'src': '/foo', 'dst': '/bar'})
+    sequence = [
+        (ECopy('/foo', '/bar'),
+            noop),
+    ]
+    resp = perform_sequence(sequence, eff)
+    assert resp == {'status': 'ok'}
+
+
 def test_api_delete():
     eff = execute_cmd('delete', {'path': '/foo'})
     sequence = [
@@ -5,12 +5,13 @@ from freezegun import freeze_time
 import pytest
 
 from parsec.core.file import File
-from parsec.core.manifest import GroupManifest, Manifest, UserManifest
+from parsec.core.manifest import EntryTree, GroupManifest, Manifest, UserManifest
 from parsec.core.synchronizer import (
     EUserVlobSynchronize, EUserVlobRead, EUserVlobUpdate, EVlobCreate, EVlobList, EVlobRead,
-    EVlobUpdate, EVlobDelete, EVlobSynchronize, EBlockCreate, EBlockDelete, EBlockSynchronize)
+    EVlobUpdate, EVlobDelete, EVlobHead, EVlobSynchronize, EBlockCreate, EBlockRelease,
+    EBlockSynchronize)
 from parsec.crypto import generate_sym_key
-from parsec.exceptions import BlockNotFound, ManifestError, ManifestNotFound, VlobNotFound
+from parsec.exceptions import ManifestError, ManifestNotFound, VlobNotFound
 from parsec.tools import to_jsonb64, ejson_loads, ejson_dumps, digest
 
 from tests.test_crypto import mock_crypto_passthrough, ALICE_PRIVATE_RSA
@@ -78,13 +79,18 @@ class TestManifest:
         file = perform_sequence(sequence, File.create())
         vlob = file.get_vlob()
         manifest.add_file('/foo', vlob)
-        sequence = [
-            (EVlobRead(vlob_id, '42'),
-                const({'id': vlob_id, 'blob': blob, 'version': 1}))
-        ]
-        ret = perform_sequence(sequence, manifest.is_dirty())
+        ret = perform_sequence([], manifest.is_dirty())
         assert ret is True
-        File.files = {}
+        assert manifest.modified_files == {vlob_id: '/foo'}
+        # Only the recorded changes are looked at, file updates are recorded by the fs
+        manifest.clear_modified()
+        ret = perform_sequence([], manifest.is_dirty())
+        assert ret is False
+        manifest.record_file_update(vlob_id, '/foo')
+        ret = perform_sequence([], manifest.is_dirty())
+        assert ret is True
+        manifest.clear_modified()
+        File.files.clear()
         sequence = [
             (EVlobRead(vlob_id, '42'),
                 const({'id': vlob_id, 'blob': blob, 'version': 1})),
@@ -92,14 +98,34 @@ class TestManifest:
                 const([vlob_id])),
             (EVlobRead(vlob_id, '42', 1),
                 const({'id': vlob_id, 'blob': blob, 'version': 1})),
-            (EBlockDelete(block_id),
+            (EBlockRelease([block_id]),
                 noop),
             (EVlobDelete(vlob_id),
                 noop)
         ]
         perform_sequence(sequence, manifest.delete('/foo'))
         ret = perform_sequence([], manifest.is_dirty())
-        assert ret is False
+        assert ret is True
+        # Deleted files are left to the dustbin
+        assert manifest.modified_files == {}
+        assert manifest.entries.touched == {'/foo'}
+
+    def test_modified_entries(self):
+        manifest = Manifest()
+        foo_vlob = {'id': 'vlob_1'}
+        bar_vlob = {'id': 'vlob_2'}
+        manifest.create_folder('/dir')
+        manifest.add_file('/dir/foo', foo_vlob)
+        manifest.add_file('/bar', bar_vlob)
+        assert manifest.modified_entries() == [('/bar', bar_vlob), ('/dir/foo', foo_vlob)]
+        # Recorded paths follow the moves
+        manifest.move('/dir', '/new_dir')
+        assert manifest.modified_files == {'vlob_1': '/new_dir/foo', 'vlob_2': '/bar'}
+        # Stale paths, e.g. from a handle opened before a move, are looked up
+        manifest.record_file_update('vlob_1', '/dir/foo')
+        assert manifest.modified_entries() == [('/bar', bar_vlob), ('/new_dir/foo', foo_vlob)]
+        del manifest.entries['/bar']
+        assert manifest.modified_entries() == [('/new_dir/foo', foo_vlob)]
 
     @freeze_time("2012-01-01")
     def test_diff(self):
@@ -188,26 +214,9 @@ class TestManifest:
         # Recreate entries and dustbin from original manifest
         backup_original = deepcopy(manifest.original_manifest)
         sequence = [
-            (EVlobRead('vlob_5', 'rts'),
-                const({'id': 'vlob_5', 'version': 1, 'blob': ''})),
-            (EVlobRead('vlob_4', 'rts'),
-                const({'id': 'vlob_4', 'version': 1, 'blob': ''})),
-            (EVlobRead('vlob_2', 'rts'),
-                const({'id': 'vlob_2', 'version': 1, 'blob': ''})),
-            (EVlobRead('vlob_3', 'rts'),
-                const({'id': 'vlob_3', 'version': 1, 'blob': ''})),
-            (EVlobRead('vlob_6', 'rts'),
-                const({'id': 'vlob_6', 'version': 1, 'blob': ''})),
-            (EVlobRead('vlob_7', 'rts'),
-                const({'id': 'vlob_7', 'version': 1, 'blob': ''})),
-            (EVlobRead('vlob_9', 'rts'),
-                const({'id': 'vlob_9', 'version': 1, 'blob': ''})),
-            (EVlobRead('vlob_6', 'rts'),
-                const({'id': 'vlob_6', 'version': 1, 'blob': ''})),
-            (EVlobRead('vlob_7', 'rts'),
-                const({'id': 'vlob_7', 'version': 1, 'blob': ''})),
-            (EVlobRead('vlob_8', 'rts'),
-                const({'id': 'vlob_8', 'version': 1, 'blob': ''})),
+            (EVlobHead({'vlob_2': 'rts', 'vlob_3': 'rts', 'vlob_4': 'rts', 'vlob_5': 'rts',
+                        'vlob_6': 'rts', 'vlob_7': 'rts', 'vlob_8': 'rts', 'vlob_9': 'rts'}),
+                const({'vlob_%s' % i: 1 for i in range(2, 10)})),
         ]
         dump = perform_sequence(sequence, manifest.dumps())
         new_manifest = ejson_loads(dump)
@@ -360,6 +369,67 @@ class TestManifest:
             }
         }
 
+    def test_merge(self):
+        vlobs = [{'id': 'vlob_%s' % i, 'key': 'key', 'read_trust_seed': 'rts',
+                  'write_trust_seed': 'wts'} for i in range(10)]
+        base = {'entries': {'/': None,
+                            '/A-B-C': vlobs[1],
+                            '/A-B-nil': vlobs[2],
+                            '/A-nil-B': vlobs[7],
+                            '/dir': None,
+                            '/dir/foo': vlobs[3],
+                            '/old': None,
+                            '/old/bar': vlobs[5]},
+                'dustbin': [vlobs[4], vlobs[5], vlobs[6]],
+                'versions': {}}
+        manifest = Manifest()
+        manifest.original_manifest = deepcopy(base)
+        manifest.entries = deepcopy(base['entries'])
+        manifest.dustbin = deepcopy(base['dustbin'])
+        manifest.entries['/A-B-C'] = vlobs[2]
+        manifest.entries['/A-B-nil'] = vlobs[3]
+        del manifest.entries['/A-nil-B']
+        manifest.entries['/nil-A-B'] = vlobs[7]
+        manifest.move('/dir', '/moved')
+        del manifest.entries['/old/bar']
+        del manifest.entries['/old']
+        manifest.dustbin = [vlobs[6], vlobs[7], vlobs[8]]
+        remote = {'entries': {'/': None,
+                              '/A-B-C': vlobs[3],
+                              '/A-nil-B': vlobs[8],
+                              '/nil-A-B': vlobs[8],
+                              '/dir': None,
+                              '/dir/foo': vlobs[3],
+                              '/old': None,
+                              '/old/bar': vlobs[5]},
+                 'dustbin': [vlobs[4], vlobs[9]],
+                 'versions': {}}
+        backup_remote = deepcopy(remote)
+        merged = manifest.merge(remote)
+        assert remote == backup_remote
+        assert merged['entries'] == {'/': None,
+                                     '/A-B-C': vlobs[2],
+                                     '/A-B-C-conflict': vlobs[3],
+                                     '/A-B-nil-deleted': vlobs[3],
+                                     '/A-nil-B-recreated': vlobs[8],
+                                     '/nil-A-B': vlobs[7],
+                                     '/nil-A-B-conflict': vlobs[8],
+                                     '/moved': None,
+                                     '/moved/foo': vlobs[3]}
+        assert merged['dustbin'] == [vlobs[9], vlobs[7], vlobs[8]]
+        # Same result as patching with the whole diff
+        local = {'entries': dict(manifest.entries), 'dustbin': manifest.dustbin, 'versions': {}}
+        patched = manifest.patch(remote, manifest.diff(base, local))
+        assert patched['entries'] == merged['entries']
+        assert patched['dustbin'] == merged['dustbin']
+        # Nothing changed locally
+        manifest.original_manifest = deepcopy(base)
+        manifest.entries = deepcopy(base['entries'])
+        manifest.dustbin = deepcopy(base['dustbin'])
+        merged = manifest.merge(remote)
+        assert merged['entries'] == remote['entries']
+        assert merged['dustbin'] == remote['dustbin']
+
     def test_get_version(self):
         manifest = Manifest()
         sequence = [
@@ -370,11 +440,7 @@ class TestManifest:
                                    'key': 'key',
                                    'read_trust_seed': 'rts',
                                    'write_trust_seed': 'wts'})
-        sequence = [
-            (EVlobRead('vlob_1', 'rts'),
-                const({'id': 'vlob_1', 'version': 1, 'blob': ''})),
-        ]
-        ret = perform_sequence(sequence, manifest.get_version())
+        ret = perform_sequence([], manifest.get_version())
         assert ret == 1
         # TODO check after synchronization
 
@@ -396,12 +462,8 @@ class TestManifest:
                                  'read_trust_seed': 'rts',
                                  'write_trust_seed': 'wts'})  # TODO too intrusive ?
         sequence = [
-            (EVlobRead('vlob_2', 'rts'),
-                lambda _: raise_(VlobNotFound('Vlob not found.'))),
-            (EVlobRead('vlob_1', 'rts'),
-                const({'id': 'vlob_1', 'version': 2, 'blob': ''})),
-            (EVlobRead('vlob_3', 'rts'),
-                const({'id': 'vlob_2', 'version': 1, 'blob': ''}))
+            (EVlobHead({'vlob_1': 'rts', 'vlob_2': 'rts', 'vlob_3': 'rts'}),
+                const({'vlob_1': 2, 'vlob_3': 1})),
         ]
         vlobs_versions = perform_sequence(sequence, manifest.get_vlobs_versions())
         assert vlobs_versions == {'vlob_1': 2, 'vlob_2': None, 'vlob_3': 1}
@@ -411,8 +473,8 @@ class TestManifest:
         manifest = Manifest()
         manifest.add_file('/foo', vlob)
         sequence = [
-            (EVlobRead('vlob_1', 'rts'),
-                const({'id': vlob['id'], 'version': 2, 'blob': ''})),
+            (EVlobHead({'vlob_1': 'rts'}),
+                const({vlob['id']: 2})),
         ]
         dump = perform_sequence(sequence, manifest.dumps(original_manifest=False))
         dump = ejson_loads(dump)
@@ -475,6 +537,21 @@ class TestManifest:
         assert manifest.entries['/test'] is None
         assert manifest.entries['/test/test']
 
+    def test_move_into_itself(self):
+        manifest = Manifest()
+        manifest.create_folder('/test/foo', parents=True)
+        manifest.create_folder('/test_bar')
+        with pytest.raises(ManifestError):
+            manifest.move('/test', '/test/foo/bar')
+        # Prefix of the path is not enough to be a parent
+        manifest.move('/test_bar', '/test/bar')
+        assert perform_sequence([], manifest.stat('/test')) == {'type': 'folder',
+                                                                 'children': ['bar', 'foo']}
+        assert dict(manifest.entries) == {'/': None,
+                                          '/test': None,
+                                          '/test/foo': None,
+                                          '/test/bar': None}
+
     def test_move_and_source_not_exists(self):
         manifest = Manifest()
         with pytest.raises(ManifestNotFound):
@@ -529,7 +606,7 @@ class TestManifest:
             manifest.add_file(persistent_path, persistent_vlob)
         for i in range(1):
             manifest.add_file(path, vlob)
-            File.files = {}
+            File.files.clear()
             sequence = [
                 (EVlobRead(vlob_id, '42'),
                     const({'id': vlob_id, 'blob': blob, 'version': 1})),
@@ -537,8 +614,8 @@ class TestManifest:
                     const([] if synchronize else [vlob_id])),
                 (EVlobRead(vlob_id, '42', 1),
                     const({'id': vlob_id, 'blob': blob, 'version': 1})),
-                (EBlockDelete(block_id),
-                    lambda _: raise_(BlockNotFound('Block not found.')) if synchronize else None),
+                (EBlockRelease([block_id]),
+                    noop),
                 (EVlobDelete(vlob_id),
                     lambda _: raise_(VlobNotFound('Vlob not found.')) if synchronize else None)
             ]
@@ -562,8 +639,8 @@ class TestManifest:
                 const([] if synchronize else [persistent_vlob_id])),
             (EVlobRead(persistent_vlob_id, '42', 1),
                 const({'id': persistent_vlob_id, 'blob': blob, 'version': 1})),
-            (EBlockDelete(block_id),
-                lambda _: raise_(BlockNotFound('Block not found.')) if synchronize else None),
+            (EBlockRelease([block_id]),
+                noop),
             (EVlobDelete(persistent_vlob_id),
                 lambda _: raise_(VlobNotFound('Vlob not found.')) if synchronize else None)
         ]
@@ -572,7 +649,7 @@ class TestManifest:
             assert path not in manifest.entries
         assert '/persistent' in manifest.entries
         # Remove root
-        File.files = {}
+        File.files.clear()
         perform_sequence(sequence, manifest.delete('/'))
         assert '/persistent' not in manifest.entries
         assert '/' in manifest.entries
@@ -600,7 +677,7 @@ class TestManifest:
         # Working
         manifest.create_folder('/test_dir')
         manifest.add_file(path, vlob)
-        File.files = {}
+        File.files.clear()
         sequence = [
             (EVlobRead(vlob_id, '42'),
                 const({'id': vlob_id, 'blob': blob, 'version': 1})),
@@ -608,8 +685,8 @@ class TestManifest:
                 const([])),
             (EVlobRead(vlob_id, '42', 1),
                 const({'id': vlob_id, 'blob': blob, 'version': 1})),
-            (EBlockDelete(id='4567'),
-                lambda _: raise_(BlockNotFound('Block not found.'))),
+            (EBlockRelease(['4567']),
+                noop),
             (EVlobDelete(id='1234'),
                 lambda _: raise_(VlobNotFound('Vlob not found.')))
         ]
@@ -624,7 +701,7 @@ class TestManifest:
         with pytest.raises(ManifestNotFound):
             manifest.undelete_file(vlob['id'])
         # Restore path already used
-        File.files = {}
+        File.files.clear()
         sequence = [
             (EVlobRead(vlob_id, '42'),
                 const({'id': vlob_id, 'blob': blob, 'version': 1})),
@@ -632,8 +709,8 @@ class TestManifest:
                 const([])),
             (EVlobRead(vlob_id, '42', 1),
                 const({'id': vlob_id, 'blob': blob, 'version': 1})),
-            (EBlockDelete(id='4567'),
-                lambda _: raise_(BlockNotFound('Block not found.'))),
+            (EBlockRelease(['4567']),
+                noop),
             (EVlobDelete(id='1234'),
                 lambda _: raise_(VlobNotFound('Vlob not found.')))
         ]
@@ -708,7 +785,7 @@ class TestManifest:
                 assert ret == {'type': 'folder', 'children': ['Belgium', 'France', 'index']}
                 ret = perform_sequence([], manifest.stat('/countries/France/cities' + final_slash))
                 assert ret == {'type': 'folder', 'children': []}
-                File.files = {}
+                File.files.clear()
                 sequence = [
                     (EVlobRead(vlob_id, '42'),
                         const({'id': vlob_id, 'blob': blob, 'version': 1})),
@@ -773,7 +850,7 @@ class TestManifest:
         dustbin = manifest.show_dustbin()
         assert dustbin == []
         manifest.add_file('/foo', vlob)
-        File.files = {}
+        File.files.clear()
         sequence = [
             (EVlobRead(vlob_id, '42'),
                 const({'id': vlob_id, 'blob': blob, 'version': 1})),
@@ -781,8 +858,8 @@ class TestManifest:
                 const([])),
             (EVlobRead(vlob_id, '42', 1),
                 const({'id': vlob_id, 'blob': blob, 'version': 1})),
-            (EBlockDelete(id='4567'),
-                lambda _: raise_(BlockNotFound('Block not found.'))),
+            (EBlockRelease(['4567']),
+                noop),
             (EVlobDelete(id='1234'),
                 lambda _: raise_(VlobNotFound('Vlob not found.')))
         ]
@@ -790,7 +867,7 @@ class TestManifest:
         manifest.create_folder('/test_dir')
         for i in [1, 2]:
             manifest.add_file(path, vlob)
-            File.files = {}
+            File.files.clear()
             sequence = [
                 (EVlobRead(vlob_id, '42'),
                     const({'id': vlob_id, 'blob': blob, 'version': 1})),
@@ -798,8 +875,8 @@ class TestManifest:
                     const([])),
                 (EVlobRead(vlob_id, '42', 1),
                     const({'id': vlob_id, 'blob': blob, 'version': 1})),
-                (EBlockDelete(id='4567'),
-                    lambda _: raise_(BlockNotFound('Block not found.'))),
+                (EBlockRelease(['4567']),
+                    noop),
                 (EVlobDelete(id='1234'),
                     lambda _: raise_(VlobNotFound('Vlob not found.')))
             ]
@@ -836,10 +913,10 @@ class TestManifest:
                     'write_trust_seed': '123'}
         # With good vlobs only
         manifest.add_file('/foo', good_vlob)
-        File.files = {}
+        File.files.clear()
         sequence = [
-            (EVlobRead(vlob_id, '42'),
-                const({'id': vlob_id, 'blob': blob, 'version': 1}))
+            (EVlobHead({vlob_id: '42'}),
+                const({vlob_id: 1}))
         ]
         dump = perform_sequence(sequence, manifest.dumps())
         sequence = [
@@ -855,15 +932,15 @@ class TestManifest:
                 const([])),
             (EVlobRead(vlob_id, '42', 1),
                 const({'id': vlob_id, 'blob': blob, 'version': 1})),
-            (EBlockDelete('4567'),
-                lambda _: raise_(BlockNotFound('Block not found.'))),
+            (EBlockRelease(['4567']),
+                noop),
             (EVlobDelete('1234'),
                 lambda _: raise_(VlobNotFound('Vlob not found.')))
         ]
         perform_sequence(sequence, manifest.delete('/foo'))
         sequence = [
-            (EVlobRead(vlob_id, '42'),
-                const({'id': vlob_id, 'blob': blob, 'version': 1}))
+            (EVlobHead({vlob_id: '42'}),
+                const({vlob_id: 1}))
         ]
         dump = perform_sequence(sequence, manifest.dumps())
         sequence = [
@@ -875,10 +952,8 @@ class TestManifest:
         # With a bad vlob
         manifest.add_file('/bad', bad_vlob)
         sequence = [
-            (EVlobRead(bad_vlob['id'], bad_vlob['read_trust_seed']),
-                lambda _: raise_(VlobNotFound('Vlob not found.'))),
-            (EVlobRead(vlob_id, '42'),
-                const({'id': vlob_id, 'blob': blob, 'version': 1}))
+            (EVlobHead({vlob_id: '42', bad_vlob['id']: bad_vlob['read_trust_seed']}),
+                const({vlob_id: 1})),
         ]
         dump = perform_sequence(sequence, manifest.dumps())
         sequence = [
@@ -894,17 +969,15 @@ class TestManifest:
                 const([])),
             (EVlobRead(bad_vlob['id'], bad_vlob['read_trust_seed'], 1),
                 const({'id': bad_vlob['id'], 'blob': blob, 'version': 1})),
-            (EBlockDelete('4567'),
-                lambda _: raise_(BlockNotFound('Block not found.'))),
+            (EBlockRelease(['4567']),
+                noop),
             (EVlobDelete(bad_vlob['id']),
                 lambda _: raise_(VlobNotFound('Vlob not found.')))
         ]
         perform_sequence(sequence, manifest.delete('/bad'))
         sequence = [
-            (EVlobRead(vlob_id, '42'),
-                const({'id': vlob_id, 'blob': blob, 'version': 1})),
-            (EVlobRead(bad_vlob['id'], bad_vlob['read_trust_seed'], None),
-                lambda _: raise_(VlobNotFound('Vlob not found.')))
+            (EVlobHead({vlob_id: '42', bad_vlob['id']: bad_vlob['read_trust_seed']}),
+                const({vlob_id: 1}))
         ]
         dump = perform_sequence(sequence, manifest.dumps())
         sequence = [
@@ -969,8 +1042,8 @@ class TestGroupManifest:
         # No old version (use original) and no new version (dump current)
         group_manifest.add_file('/foo', foo_vlob)
         sequence = [
-            (EVlobRead(foo_vlob['id'], foo_vlob['read_trust_seed']),
-                const({'id': foo_vlob['id'], 'blob': '', 'version': 1}))
+            (EVlobHead({foo_vlob['id']: foo_vlob['read_trust_seed']}),
+                const({foo_vlob['id']: 1}))
         ]
         diff = perform_sequence(sequence, group_manifest.diff_versions())
         assert diff == {'entries': {'added': {'/foo': foo_vlob}, 'changed': {}, 'removed': {}},
@@ -1042,7 +1115,7 @@ class TestGroupManifest:
                          'versions': {'123': 1, '234': 1}}
         new_blob = ejson_dumps(new_blob_dict).encode()
         new_blob = to_jsonb64(new_blob)
-        File.files = {}
+        File.files.clear()
         sequence = [
             (EVlobRead('1234', '42'),
                 const({'id': '1234', 'blob': new_blob, 'version': 2})),
@@ -1088,7 +1161,7 @@ class TestGroupManifest:
                          'versions': {'123': 1, '234': 1}}
         new_blob = ejson_dumps(new_blob_dict).encode()
         new_blob = to_jsonb64(new_blob)
-        File.files = {}
+        File.files.clear()
         sequence = [
             (EVlobRead('1234', '42'),
                 const({'id': '1234', 'blob': new_blob, 'version': 1})),
@@ -1134,7 +1207,7 @@ class TestGroupManifest:
                          'versions': {'123': 1, '234': 1}}
         new_blob = ejson_dumps(new_blob_dict).encode()
         new_blob = to_jsonb64(new_blob)
-        File.files = {}
+        File.files.clear()
         sequence = [
             (EVlobRead('1234', '42'),
                 const({'id': '1234', 'blob': new_blob, 'version': 2})),
@@ -1142,8 +1215,6 @@ class TestGroupManifest:
                 const({'id': foo_vlob['id'], 'blob': to_jsonb64(b'foo'), 'version': 1})),
             (EVlobRead(dust_vlob['id'], dust_vlob['read_trust_seed'], 1),
                 const({'id': dust_vlob['id'], 'blob': to_jsonb64(b'dust'), 'version': 1})),
-            (EVlobRead(bar_vlob['id'], bar_vlob['read_trust_seed']),
-                const({'id': bar_vlob['id'], 'blob': to_jsonb64(b'bar'), 'version': 1})),
             (EVlobRead(foo_vlob['id'], foo_vlob['read_trust_seed']),
                 const({'id': foo_vlob['id'], 'blob': new_blob, 'version': 1})),
             (EVlobList(),
@@ -1160,6 +1231,34 @@ class TestGroupManifest:
         assert group_manifest.entries['/bar'] == bar_vlob
         assert group_manifest.entries['/foo'] == foo_vlob
 
+    def test_reload_twice_keeps_local_changes(self, group_manifest):
+        group_manifest.create_folder('/bar')
+
+        def remote(entries, version):
+            blob = {'entries': entries, 'dustbin': [], 'versions': {}}
+            blob = to_jsonb64(ejson_dumps(blob).encode())
+            return (EVlobRead('1234', '42'),
+                    const({'id': '1234', 'blob': blob, 'version': version}))
+
+        perform_sequence([remote({'/': None, '/foo': None}, 2)],
+                         group_manifest.reload(reset=False))
+        # Local changes survive a merge into an already merged manifest
+        perform_sequence([remote({'/': None, '/foo': None, '/baz': None}, 3)],
+                         group_manifest.reload(reset=False))
+        assert group_manifest.entries == {'/': None, '/bar': None, '/baz': None, '/foo': None}
+        manifest_blob = {'entries': {'/': None, '/bar': None, '/baz': None, '/foo': None},
+                         'dustbin': [],
+                         'versions': {}}
+        manifest_blob = to_jsonb64(ejson_dumps(manifest_blob).encode())
+        sequence = [
+            (EVlobUpdate('1234', '43', 4, manifest_blob),
+                noop),
+            (EVlobSynchronize('1234'),
+                const(True)),
+        ]
+        perform_sequence(sequence, group_manifest.commit())
+        assert group_manifest.original_manifest['entries'] == group_manifest.entries
+
     def test_reload_without_reset_and_no_new_version(self, group_manifest):
         group_manifest.version = 1
         bar_vlob = {'id': '234',
@@ -1201,8 +1300,6 @@ class TestGroupManifest:
         manifest_blob = ejson_dumps(manifest_blob).encode()
         manifest_blob = to_jsonb64(manifest_blob)
         sequence = [
-            (EVlobList(),
-                const([manifest_vlob_id])),
             (EVlobUpdate(manifest_vlob_id, '43', 1, manifest_blob),
                 noop),
             (EVlobSynchronize(manifest_vlob_id),
@@ -1244,12 +1341,8 @@ class TestGroupManifest:
                          'versions': {new_file_vlob['id']: 1}}
         manifest_blob = ejson_dumps(manifest_blob).encode()
         manifest_blob = to_jsonb64(manifest_blob)
-        File.files = {}
+        File.files.clear()
         sequence = [
-            (EVlobRead(file_vlob_id, '42'),
-                const({'id': file_vlob_id, 'blob': file_blob, 'version': 1})),
-            (EVlobList(),
-                const([file_vlob_id])),
             (EVlobRead(file_vlob_id, '42'),
                 const({'id': file_vlob_id, 'blob': file_blob, 'version': 1})),
             (EVlobList(),
@@ -1260,8 +1353,8 @@ class TestGroupManifest:
                 const(True)),
             (EVlobSynchronize(file_vlob_id),
                 const(new_file_vlob)),
-            (EVlobRead(new_file_vlob['id'], new_file_vlob['read_trust_seed']),
-                const({'id': new_file_vlob['id'], 'blob': file_blob, 'version': 1})),
+            (EVlobHead({new_file_vlob['id']: new_file_vlob['read_trust_seed']}),
+                const({new_file_vlob['id']: 1})),
             (EVlobUpdate(manifest_new_vlob['id'],
                          manifest_new_vlob['write_trust_seed'],
                          2,
@@ -1272,24 +1365,13 @@ class TestGroupManifest:
         ]
         ret = perform_sequence(sequence, group_manifest.commit())
         assert group_manifest.get_vlob() == manifest_new_vlob
-        sequence = [
-            (EVlobRead(new_file_vlob['id'], new_file_vlob['read_trust_seed']),
-                const({'id': new_file_vlob['id'], 'blob': file_blob, 'version': 1}))
-        ]
-        version = perform_sequence(sequence, group_manifest.get_version())
+        assert group_manifest.modified_files == {}
+        version = perform_sequence([], group_manifest.get_version())
         assert version == 2
         assert group_manifest.version == 2
         # Save without modifications
-        sequence = [
-            (EVlobRead(new_file_vlob['id'], new_file_vlob['read_trust_seed']),
-                const({'id': new_file_vlob['id'], 'blob': file_blob, 'version': 1}))
-        ]
-        ret = perform_sequence(sequence, group_manifest.commit())
-        sequence = [
-            (EVlobRead(new_file_vlob['id'], new_file_vlob['read_trust_seed']),
-                const({'id': new_file_vlob['id'], 'blob': file_blob, 'version': 1}))
-        ]
-        version = perform_sequence(sequence, group_manifest.get_version())
+        ret = perform_sequence([], group_manifest.commit())
+        version = perform_sequence([], group_manifest.get_version())
         assert version == 2
         assert group_manifest.version == 2
 
@@ -1344,10 +1426,8 @@ class TestGroupManifest:
                 const({'id': '3456new',
                        'read_trust_seed': 'rtsnew',
                        'write_trust_seed': 'wtsnew'})),
-            (EVlobRead('2345new', 'rtsnew'),
-                const({'id': '2345', 'blob': to_jsonb64(b'foo'), 'version': 1})),
-            (EVlobRead('3456new', 'rtsnew'),
-                const({'id': '3456new', 'blob': to_jsonb64(b'bar'), 'version': 1})),
+            (EVlobHead({'2345new': 'rtsnew', '3456new': 'rtsnew'}),
+                const({'2345new': 1, '3456new': 1})),
             (EVlobCreate(new_blob),
                 const({'id': '1234new',
                        'read_trust_seed': 'rtsnew',
@@ -1395,7 +1475,7 @@ class TestGroupManifest:
                      'versions': {'2345': 2}}
         blob = ejson_dumps(blob_dict).encode()
         blob = to_jsonb64(blob)
-        File.files = {}
+        File.files.clear()
         sequence = [
             (EVlobRead('1234', '42', 5),
                 const({'id': '1234', 'blob': blob, 'version': 5})),
@@ -1411,7 +1491,7 @@ class TestGroupManifest:
                 const([])),
             (EVlobRead('2345', '42', 3),
                 const({'id': '2345', 'blob': file_blob, 'version': 3})),
-            (EBlockDelete('4567'),
+            (EBlockRelease(['4567']),
                 noop),
             (EVlobDelete('2345'),
                 noop),
@@ -1429,7 +1509,7 @@ class TestGroupManifest:
                      'versions': {'2345': 2}}
         blob = ejson_dumps(blob_dict).encode()
         blob = to_jsonb64(blob)
-        File.files = {}
+        File.files.clear()
         sequence = [
             (EVlobRead('1234', '42', 3),
                 const({'id': '1234', 'blob': blob, 'version': 3})),
@@ -1445,7 +1525,7 @@ class TestGroupManifest:
                 const([])),
             (EVlobRead('2345', '42', 3),
                 const({'id': '2345', 'blob': file_blob, 'version': 3})),
-            (EBlockDelete('4567'),
+            (EBlockRelease(['4567']),
                 noop),
             (EVlobDelete('2345'),
                 noop),
@@ -1507,8 +1587,8 @@ class TestUserManifest:
         ]
         perform_sequence(sequence, user_manifest.import_group_vlob('share', group_vlob))
         sequence = [
-            (EVlobRead(foo_vlob['id'], foo_vlob['read_trust_seed']),
-                const({'id': foo_vlob['id'], 'blob': blob, 'version': 1}))
+            (EVlobHead({foo_vlob['id']: foo_vlob['read_trust_seed']}),
+                const({foo_vlob['id']: 1}))
         ]
         diff = perform_sequence(sequence, user_manifest.diff_versions())
         assert diff == {'entries': {'added': {'/foo': foo_vlob}, 'changed': {}, 'removed': {}},
@@ -1558,9 +1638,10 @@ class TestUserManifest:
         file = perform_sequence(sequence, File.create())
         file_vlob = file.get_vlob()
         user_manifest_with_group.add_file('/foo', file_vlob)
+        # Vlobs with local changes are answered by the synchronizer
         sequence = [
-            (EVlobRead(file_vlob['id'], '42'),
-                const({'id': file_vlob['id'], 'blob': file_blob, 'version': 1}))
+            (EVlobHead({file_vlob['id']: '42'}),
+                const({file_vlob['id']: 1})),
         ]
         dump = perform_sequence(sequence, user_manifest_with_group.dumps(original_manifest=False))
         dump = ejson_loads(dump)
@@ -1664,8 +1745,8 @@ class TestUserManifest:
                        'read_trust_seed': new_file_vlob['read_trust_seed'],
                        'write_trust_seed': new_file_vlob['write_trust_seed'],
                        'version': 1})),
-            (EVlobRead('234', 'rtsnew'),
-                const({'id': '234', 'blob': to_jsonb64(b'foo'), 'version': 1})),
+            (EVlobHead({'234': 'rtsnew'}),
+                const({'234': 1})),
             (EVlobCreate(new_group_blob),
                 const({'id': '2345',
                        'read_trust_seed': 'rtsnew',
@@ -1727,9 +1808,12 @@ class TestUserManifest:
         assert retrieved_manifest.get_vlob() == new_vlob
 
     def test_remove_group(self, user_manifest_with_group):
-        user_manifest_with_group.remove_group('share')
+        user_manifest_with_group.modified = False
         with pytest.raises(ManifestNotFound):
-            user_manifest_with_group.remove_group('share')
+            user_manifest_with_group.remove_group('unknown')
+        assert user_manifest_with_group.modified is False
+        user_manifest_with_group.remove_group('share')
+        assert user_manifest_with_group.modified is True
 
     def test_reload_not_consistent(self, user_manifest):
         # File not consistent
@@ -1791,7 +1875,7 @@ class TestUserManifest:
         new_blob = ejson_dumps(new_blob_dict).encode()
         new_blob = to_jsonb64(new_blob)
         group_blob = to_jsonb64(b'{"dustbin": [], "entries": {"/": null}, "versions": {}}')
-        File.files = {}
+        File.files.clear()
         sequence = [
             (EUserVlobRead(),
                 const({'blob': new_blob, 'version': 2})),
@@ -1841,7 +1925,7 @@ class TestUserManifest:
         new_blob = ejson_dumps(new_blob_dict).encode()
         new_blob = to_jsonb64(new_blob)
         group_blob = to_jsonb64(b'{"dustbin": [], "entries": {"/": null}, "versions": {}}')
-        File.files = {}
+        File.files.clear()
         sequence = [
             (EUserVlobRead(),
                 const({'blob': new_blob, 'version': 1})),
@@ -1891,7 +1975,7 @@ class TestUserManifest:
         new_blob = ejson_dumps(new_blob_dict).encode()
         new_blob = to_jsonb64(new_blob)
         group_blob = to_jsonb64(b'{"dustbin": [], "entries": {"/": null}, "versions": {}}')
-        File.files = {}
+        File.files.clear()
         sequence = [
             (EUserVlobRead(),
                 const({'blob': new_blob, 'version': 2})),
@@ -1901,8 +1985,6 @@ class TestUserManifest:
                 const({'id': dust_vlob['id'], 'blob': to_jsonb64(b'dust'), 'version': 1})),
             (EVlobRead('1234', '42'),
                 const({'id': '1234', 'blob': group_blob, 'version': 1})),
-            (EVlobRead('234', '234'),
-                const({'id': '234', 'blob': to_jsonb64(b'foo'), 'version': 1})),
             (EVlobRead('123', '123'),
                 const({'id': '123', 'blob': new_blob, 'version': 1})),
             (EVlobList(),
@@ -1919,6 +2001,20 @@ class TestUserManifest:
         assert user_manifest_with_group.entries['/bar'] == bar_vlob
         assert user_manifest_with_group.entries['/foo'] == foo_vlob
 
+    def test_reload_twice_keeps_local_changes(self, user_manifest):
+        user_manifest.create_folder('/bar')
+
+        def remote(entries, version):
+            blob = {'entries': entries, 'groups': {}, 'dustbin': [], 'versions': {}}
+            blob = to_jsonb64(ejson_dumps(blob).encode())
+            return (EUserVlobRead(), const({'blob': blob, 'version': version}))
+
+        perform_sequence([remote({'/': None, '/foo': None}, 2)],
+                         user_manifest.reload(reset=False))
+        perform_sequence([remote({'/': None, '/foo': None, '/baz': None}, 3)],
+                         user_manifest.reload(reset=False))
+        assert user_manifest.entries == {'/': None, '/bar': None, '/baz': None, '/foo': None}
+
     def test_reload_without_reset_and_no_new_version(self,
                                                      user_manifest_with_group,
                                                      group_manifest):
@@ -1991,14 +2087,8 @@ class TestUserManifest:
         group_blob = {'entries': {'/': None}, 'dustbin': [], 'versions': {}}
         group_blob = ejson_dumps(group_blob).encode()
         group_blob = to_jsonb64(group_blob)
-        File.files = {}
+        File.files.clear()
         sequence = [
-            (EVlobRead(file_vlob_id, '42'),
-                const({'id': file_vlob_id, 'blob': file_vlob, 'version': 1})),
-            (EVlobList(),
-                const(['1234', file_vlob_id])),
-            (EVlobList(),
-                const(['1234', file_vlob_id])),
             (EVlobUpdate('1234', '43', 1, group_blob),
                 noop),
             (EVlobSynchronize('1234'),
@@ -2013,8 +2103,8 @@ class TestUserManifest:
                 const(True)),
             (EVlobSynchronize(file_vlob_id),
                 const(new_file_vlob)),
-            (EVlobRead(new_file_vlob['id'], new_file_vlob['read_trust_seed']),
-                const({'id': new_file_vlob['id'], 'blob': file_blob, 'version': 1})),
+            (EVlobHead({new_file_vlob['id']: new_file_vlob['read_trust_seed']}),
+                const({new_file_vlob['id']: 1})),
             (EUserVlobUpdate(1, blob),
                 noop),
             (EUserVlobSynchronize(),
@@ -2024,11 +2114,7 @@ class TestUserManifest:
         assert ret is None
         assert user_manifest_with_group.version == 1
         # Save without modifications
-        sequence = [
-            (EVlobRead(new_file_vlob['id'], new_file_vlob['read_trust_seed']),
-                const({'id': new_file_vlob['id'], 'blob': file_vlob, 'version': 1}))
-        ]
-        ret = perform_sequence(sequence, user_manifest_with_group.commit())
+        ret = perform_sequence([], user_manifest_with_group.commit())
         assert user_manifest_with_group.version == 1
 
     def test_restore_manifest(self, user_manifest):
@@ -2066,7 +2152,7 @@ class TestUserManifest:
                      'versions': {'2345': 2}}
         blob = ejson_dumps(blob_dict).encode()
         blob = to_jsonb64(blob)
-        File.files = {}
+        File.files.clear()
         sequence = [
             (EUserVlobRead(5),
                 const({'blob': blob, 'version': 5})),
@@ -2082,7 +2168,7 @@ class TestUserManifest:
                 const([])),
             (EVlobRead('2345', '42', 3),
                 const({'id': '2345', 'blob': file_blob, 'version': 3})),
-            (EBlockDelete('4567'),
+            (EBlockRelease(['4567']),
                 noop),
             (EVlobDelete('2345'),
                 noop),
@@ -2101,7 +2187,7 @@ class TestUserManifest:
                      'versions': {'2345': 2}}
         blob = ejson_dumps(blob_dict).encode()
         blob = to_jsonb64(blob)
-        File.files = {}
+        File.files.clear()
         sequence = [
             (EUserVlobRead(3),
                 const({'blob': blob, 'version': 3})),
@@ -2117,7 +2203,7 @@ class TestUserManifest:
                 const([])),
             (EVlobRead('2345', '42', 3),
                 const({'id': '2345', 'blob': file_blob, 'version': 3})),
-            (EBlockDelete('4567'),
+            (EBlockRelease(['4567']),
                 noop),
             (EVlobDelete('2345'),
                 noop),
@@ -2158,11 +2244,11 @@ class TestUserManifest:
                     'write_trust_seed': '123'}
         # With good vlobs only
         user_manifest_with_group.add_file('/foo', good_vlob)
-        sequence = [
-            (EVlobRead('1234', '42'),
-                const({'id': '1234', 'blob': blob, 'version': 1}))
+        sequence_dumps = [
+            (EVlobHead({vlob_id: '42'}),
+                const({vlob_id: 1})),
         ]
-        dump = perform_sequence(sequence, user_manifest_with_group.dumps())
+        dump = perform_sequence(sequence_dumps, user_manifest_with_group.dumps())
         group_blob = {'entries': {'/': None}, 'dustbin': [], 'versions': {}}
         group_blob = ejson_dumps(group_blob).encode()
         group_blob = to_jsonb64(group_blob)
@@ -2178,11 +2264,7 @@ class TestUserManifest:
         # With a bad vlob
         group_manifest.update_vlob(bad_vlob)
         user_manifest_with_group.group_manifests['share'] = group_manifest
-        sequence = [
-            (EVlobRead('1234', '42'),
-                const({'id': '1234', 'blob': blob, 'version': 1}))
-        ]
-        dump = perform_sequence(sequence, user_manifest_with_group.dumps())
+        dump = perform_sequence(sequence_dumps, user_manifest_with_group.dumps())
         sequence = [
             (EVlobRead('1234', '42', 1),
                 const({'id': '1234', 'blob': blob, 'version': 1})),
@@ -2193,11 +2275,7 @@ class TestUserManifest:
             sequence, user_manifest_with_group.check_consistency(ejson_loads(dump)))
         assert consistency is False
         user_manifest_with_group.remove_group('share')
-        sequence = [
-            (EVlobRead('1234', '42'),
-                const({'id': '1234', 'blob': blob, 'version': 1}))
-        ]
-        dump = perform_sequence(sequence, user_manifest_with_group.dumps())
+        dump = perform_sequence(sequence_dumps, user_manifest_with_group.dumps())
         sequence = [
             (EVlobRead('1234', '42', 1),
                 const({'id': '1234', 'blob': blob, 'version': 1}))
@@ -2205,3 +2283,62 @@ class TestUserManifest:
         consistency = perform_sequence(
             sequence, user_manifest_with_group.check_consistency(ejson_loads(dump)))
         assert consistency is True
+
+
+class TestEntryTree:
+
+    def test_mapping(self):
+        tree = EntryTree({'/': None, '/a': None, '/a/b': {'id': '1'}})
+        assert len(tree) == 3
+        assert tree == {'/': None, '/a': None, '/a/b': {'id': '1'}}
+        assert '/a/b' in tree
+        assert '/a/c' not in tree and '/a/b/c' not in tree and '/z' not in tree
+        tree['/a/c'] = {'id': '2'}
+        assert list(tree) == ['/', '/a', '/a/b', '/a/c']
+        del tree['/a']
+        # Children stay in place without their parent
+        assert tree == {'/': None, '/a/b': {'id': '1'}, '/a/c': {'id': '2'}}
+        with pytest.raises(KeyError):
+            tree['/a']
+        with pytest.raises(KeyError):
+            del tree['/a']
+        del tree['/a/b']
+        del tree['/a/c']
+        assert tree == {'/': None}
+        assert not tree._root.children
+        # Paths without their parents are allowed
+        tree['/x-conflict/y'] = None
+        assert '/x-conflict' not in tree
+        assert len(tree) == 2
+
+    def test_walk_and_children(self):
+        tree = EntryTree({'/': None, '/a': None, '/a/b': {'id': '1'}, '/a/b2': None,
+                          '/a/b2/c': {'id': '2'}, '/ab': {'id': '3'}})
+        assert list(tree.walk('/a')) == [('/a', None), ('/a/b', {'id': '1'}),
+                                         ('/a/b2', None), ('/a/b2/c', {'id': '2'})]
+        assert list(tree.walk('/missing')) == []
+        assert tree.children('/') == {'a': None, 'ab': {'id': '3'}}
+        assert tree.children('/a/b') == {}
+        assert tree.children('/missing') == {}
+
+    def test_move(self):
+        tree = EntryTree({'/': None, '/a': None, '/a/b': {'id': '1'}, '/c': None})
+        tree.move('/a', '/c/d')
+        assert tree == {'/': None, '/c': None, '/c/d': None, '/c/d/b': {'id': '1'}}
+        assert tree.children('/') == {'c': None}
+        # Destination already holding entries without being one
+        tree['/e/f'] = {'id': '2'}
+        tree.move('/c/d', '/e')
+        assert tree == {'/': None, '/c': None, '/e': None, '/e/b': {'id': '1'},
+                        '/e/f': {'id': '2'}}
+        with pytest.raises(KeyError):
+            tree.move('/missing', '/g')
+
+    def test_touched(self):
+        tree = EntryTree({'/': None, '/a': None, '/a/b': {'id': '1'}, '/c': None})
+        assert tree.touched == set()
+        tree['/a/b'] = {'id': '2'}
+        del tree['/c']
+        tree.move('/a', '/d')
+        assert tree.touched == {'/a/b', '/c', '/a', '/d'}
+        assert sorted(tree.touched_roots()) == ['/a', '/c', '/d']
@@ -0,0 +1,45 @@
+import hashlib
+
+import pytest
+
+from parsec.core.merkle import (MerkleTree, block_leaf_hash, data_leaf_hash, leaf_hash,
+                                verify_proof)
+from parsec.tools import digest
+
+
+def leaves(count):
+    return [data_leaf_hash(str(i).encode()) for i in range(count)]
+
+
+def test_leaf_hash():
+    block = {'block': '1', 'digest': digest(b'foo'), 'size': 3}
+    assert block_leaf_hash(block) == data_leaf_hash(b'foo')
+    # Size is part of the leaf
+    assert leaf_hash(4, hashlib.sha512(b'foo').digest()) != data_leaf_hash(b'foo')
+    assert block_leaf_hash({'size': 3}) == leaf_hash(3)
+    assert leaf_hash(3) != leaf_hash(4)
+
+
+def test_empty_tree():
+    tree = MerkleTree([])
+    assert len(tree) == 0
+    assert tree.root == hashlib.sha256(b'').digest()
+
+
+@pytest.mark.parametrize('count', [1, 2, 3, 7, 8, 33])
+def test_proofs(count):
+    tree = MerkleTree(leaves(count))
+    assert len(tree) == count
+    for index, leaf in enumerate(leaves(count)):
+        proof = tree.proof(index)
+        assert len(proof) <= count.bit_length()
+        assert verify_proof(leaf, proof, tree.root)
+        assert tree.verify(index, leaf, tree.root)
+        assert not tree.verify(index, data_leaf_hash(b'corrupted'), tree.root)
+        assert not tree.verify(index, leaf, MerkleTree(leaves(count + 1)).root)
+
+
+def test_root_depends_on_content_and_order():
+    assert MerkleTree(leaves(5)).root == MerkleTree(leaves(5)).root
+    assert MerkleTree(leaves(5)).root != MerkleTree(leaves(4)).root
+    assert MerkleTree(leaves(5)).root != MerkleTree(list(reversed(leaves(5)))).root
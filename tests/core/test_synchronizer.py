@@ -1,31 +1,36 @@
+import asyncio
 import pytest
 
 from arrow import Arrow
+from effect2 import TypeDispatcher, asyncio_perform, parallel
 from effect2.testing import const, conste, noop, perform_sequence
 from freezegun import freeze_time
 
 from parsec.core.backend_vlob import (EBackendVlobCreate, EBackendVlobUpdate, EBackendVlobRead,
-                                      VlobAccess, VlobAtom)
+                                      EBackendVlobHead, VlobAccess, VlobAtom, VlobHead)
 from parsec.core.backend_user_vlob import (EBackendUserVlobUpdate, EBackendUserVlobRead,
                                            UserVlobAtom)
 from parsec.core.block import (Block, EBlockCreate as EBackendBlockCreate,
+                               EBlockExists as EBackendBlockExists,
                                EBlockRead as EBackendBlockRead)
 from parsec.core.synchronizer import (
-    EBlockCreate, EBlockRead, EBlockDelete, EBlockList, EBlockSynchronize, ECacheClean,
+    EBlockCreate, EBlockRead, EBlockPrefetch, EBlockReference, EBlockRelease,
+    EBlockGarbageCollect, EBlockDelete, EBlockList, EBlockSynchronize, ECacheClean, ECacheStats,
     EUserVlobRead, EUserVlobUpdate, EUserVlobExist, EUserVlobDelete,
     EUserVlobSynchronize, EVlobCreate, EVlobRead, EVlobUpdate, EVlobDelete, EVlobList,
-    EVlobSynchronize, ESynchronize, SynchronizerComponent)
-from parsec.exceptions import BlockError, BlockNotFound, UserVlobNotFound, VlobNotFound
+    EVlobHead, EVlobSynchronize, ESynchronize, SynchronizerComponent)
+from parsec.exceptions import (
+    BlockError, BlockNotFound, BlockAlreadyExists, UserVlobNotFound, VlobNotFound)
 
 
 @pytest.fixture
 def app():
-    return SynchronizerComponent(cache_size=10)
+    return SynchronizerComponent(block_cache_size=1024)
 
 
 @pytest.fixture
 def app_no_cache():
-    return SynchronizerComponent(cache_size=0)
+    return SynchronizerComponent(block_cache_size=0)
 
 
 def test_perform_block_create(app):
@@ -39,6 +44,33 @@ def test_perform_block_create(app):
     assert block['content'] == content
 
 
+def test_perform_block_create_content_addressed(app):
+    content = 'foo'
+    eff = app.perform_block_create(EBlockCreate(content, 'abc'))
+    block_id = perform_sequence([], eff)
+    assert block_id == 'abc'
+    assert app.block_references == {'abc': 1}
+    # Already known locally
+    eff = app.perform_block_create(EBlockCreate(content, 'abc'))
+    block_id = perform_sequence([], eff)
+    assert block_id == 'abc'
+    assert app.block_references == {'abc': 2}
+    # Block is kept as long as it is referenced
+    eff = app.perform_block_delete(EBlockDelete('abc'))
+    perform_sequence([], eff)
+    assert 'abc' in app.blocks
+    eff = app.perform_block_delete(EBlockDelete('abc'))
+    perform_sequence([], eff)
+    assert 'abc' not in app.blocks
+    assert app.block_references == {}
+    # Already in block store
+    app.block_cache['def'] = {'id': 'def', 'content': content}
+    eff = app.perform_block_create(EBlockCreate(content, 'def'))
+    block_id = perform_sequence([], eff)
+    assert block_id == 'def'
+    assert 'def' not in app.blocks
+
+
 def test_perform_block_read(app, app_no_cache):
     local_content = 'foo'
     eff = app.perform_block_create(EBlockCreate(local_content))
@@ -51,7 +83,7 @@ def test_perform_block_read(app, app_no_cache):
     assert block['content'] == local_content
     remote_content = b'bar'
     # Read remote block
-    assert app.block_cache.currsize == 0
+    assert len(app.block_cache) == 0
     eff = app.perform_block_read(EBlockRead('123'))
     sequence = [
         (EBackendBlockRead('123'),
@@ -61,9 +93,9 @@ def test_perform_block_read(app, app_no_cache):
     assert sorted(list(block.keys())) == ['content', 'id']
     assert block['id']
     assert block['content'] == remote_content
-    assert app.block_cache.currsize == 1
+    assert len(app.block_cache) == 1
     # Read remote block with cache disabled
-    assert app_no_cache.block_cache.currsize == 0
+    assert len(app_no_cache.block_cache) == 0
     eff = app_no_cache.perform_block_read(EBlockRead('123'))
     sequence = [
         (EBackendBlockRead('123'),
@@ -73,7 +105,7 @@ def test_perform_block_read(app, app_no_cache):
     assert sorted(list(block.keys())) == ['content', 'id']
     assert block['id']
     assert block['content'] == remote_content
-    assert app_no_cache.block_cache.currsize == 0
+    assert len(app_no_cache.block_cache) == 0
     # Read block in cache
     eff = app.perform_block_read(EBlockRead('123'))
     block = perform_sequence([], eff)
@@ -99,6 +131,84 @@ def test_perform_block_read(app, app_no_cache):
         block = perform_sequence(sequence, eff)
 
 
+def test_perform_block_prefetch(app):
+    local_id = perform_sequence([], app.perform_block_create(EBlockCreate('foo')))
+    app.block_cache['123'] = {'id': '123', 'content': b'cached'}
+    eff = app.perform_block_prefetch(EBlockPrefetch([local_id, '123', '456', '789', '890']))
+    sequence = [
+        (EBackendBlockRead('456'),
+            const(Block('456', b'bar'))),
+        (EBackendBlockRead('789'),
+            conste(BlockNotFound('Block not found.'))),
+        # Any error is only logged, prefetching is best effort
+        (EBackendBlockRead('890'),
+            conste(RuntimeError('Connection lost.'))),
+    ]
+    perform_sequence(sequence, eff)
+    assert app.block_cache['456'] == {'id': '456', 'content': b'bar'}
+    assert '789' not in app.block_cache
+    assert '890' not in app.block_cache
+    assert local_id not in app.block_cache
+    assert app.prefetched == {'456': 3}
+
+
+def test_perform_block_prefetch_budget(app):
+    app.prefetch_budget = 4
+    eff = app.perform_block_prefetch(EBlockPrefetch(['1', '2', '3']))
+    sequence = [
+        (EBackendBlockRead('1'), const(Block('1', b'foo'))),
+        (EBackendBlockRead('2'), const(Block('2', b'bar'))),
+    ]
+    perform_sequence(sequence, eff)
+    assert '3' not in app.block_cache
+    assert app.prefetched == {'1': 3, '2': 3}
+    # Reading a prefetched block frees its share of the budget
+    perform_sequence([], app.perform_block_read(EBlockRead('1')))
+    eff = app.perform_block_prefetch(EBlockPrefetch(['3', '4']))
+    sequence = [
+        (EBackendBlockRead('3'), const(Block('3', b'baz'))),
+    ]
+    perform_sequence(sequence, eff)
+    assert app.prefetched == {'2': 3, '3': 3}
+    # So does evicting it from the cache
+    del app.block_cache['2']
+    del app.block_cache['3']
+    eff = app.perform_block_prefetch(EBlockPrefetch(['4']))
+    sequence = [
+        (EBackendBlockRead('4'), const(Block('4', b'qux'))),
+    ]
+    perform_sequence(sequence, eff)
+    assert app.prefetched == {'4': 3}
+
+
+async def test_perform_block_read_coalesce_fetches(app):
+    fetches = []
+
+    async def perform_backend_block_read(intent):
+        fetches.append(intent.id)
+        await asyncio.sleep(0.01)
+        if intent.id == '456':
+            raise BlockError('Block error.')
+        return Block(intent.id, b'foo')
+
+    dispatcher = TypeDispatcher({EBackendBlockRead: perform_backend_block_read})
+    # Readers of a block being prefetched wait for it instead of fetching it again
+    eff = parallel([app.perform_block_prefetch(EBlockPrefetch(['123'])),
+                    app.perform_block_read(EBlockRead('123')),
+                    app.perform_block_read(EBlockRead('123'))])
+    ret = await asyncio_perform(dispatcher, eff)
+    assert ret[1:] == [{'id': '123', 'content': b'foo'}] * 2
+    assert fetches == ['123']
+    assert app.block_fetches == {}
+    # Fetch errors are reported to all the readers
+    eff = parallel([app.perform_block_read(EBlockRead('456')),
+                    app.perform_block_read(EBlockRead('456'))])
+    with pytest.raises(BlockNotFound):
+        await asyncio_perform(dispatcher, eff)
+    assert fetches == ['123', '456']
+    assert app.block_fetches == {}
+
+
 def test_perform_block_delete(app):
     content = 'foo'
     eff = app.perform_block_create(EBlockCreate(content))
@@ -109,19 +219,66 @@ def test_perform_block_delete(app):
         perform_sequence([], eff)
         assert app.last_modified == Arrow.fromdatetime(frozen_datetime())
     # Delete in cache
-    app.block_cache[block_id] = {'foo': 'bar'}
-    assert app.block_cache.currsize == 1
+    app.block_cache[block_id] = {'id': block_id, 'content': 'bar'}
+    assert len(app.block_cache) == 1
     with freeze_time('2012-01-01') as frozen_datetime:
         eff = app.perform_block_delete(EBlockDelete(block_id))
         perform_sequence([], eff)
         assert app.last_modified == Arrow.fromdatetime(frozen_datetime())
-    assert app.block_cache.currsize == 0
+    assert len(app.block_cache) == 0
     # Not found
     with pytest.raises(BlockNotFound):
         eff = app.perform_block_delete(EBlockDelete(block_id))
         perform_sequence([], eff)
 
 
+def test_perform_block_reference(app):
+    eff = app.perform_block_create(EBlockCreate('foo'))
+    block_id = perform_sequence([], eff)
+    # Committed blocks no longer in cache are counted as well
+    eff = app.perform_block_reference(EBlockReference([block_id, '1234']))
+    perform_sequence([], eff)
+    assert app.block_references == {block_id: 2, '1234': 2}
+    # Block is kept until its last reference is deleted
+    eff = app.perform_block_delete(EBlockDelete(block_id))
+    perform_sequence([], eff)
+    assert block_id in app.blocks
+    eff = app.perform_block_delete(EBlockDelete(block_id))
+    perform_sequence([], eff)
+    assert block_id not in app.blocks
+    assert app.block_references == {'1234': 2}
+
+
+def test_perform_block_garbage_collect(app):
+    block_ids = []
+    for _ in range(3):
+        eff = app.perform_block_create(EBlockCreate('foo'))
+        block_ids.append(perform_sequence([], eff))
+    eff = app.perform_block_reference(EBlockReference(block_ids[:1]))
+    perform_sequence([], eff)
+    # Release is deferred
+    eff = app.perform_block_release(EBlockRelease(block_ids + ['unknown']))
+    perform_sequence([], eff)
+    assert all(block_id in app.blocks for block_id in block_ids)
+    # Deletions are done in batches
+    eff = app.perform_block_garbage_collect(EBlockGarbageCollect(2))
+    assert perform_sequence([], eff) == 2
+    assert block_ids[0] in app.blocks  # Still referenced
+    assert block_ids[1] not in app.blocks
+    assert block_ids[2] in app.blocks
+    eff = app.perform_block_garbage_collect(EBlockGarbageCollect())
+    assert perform_sequence([], eff) == 2
+    assert block_ids[2] not in app.blocks
+    eff = app.perform_block_garbage_collect(EBlockGarbageCollect())
+    assert perform_sequence([], eff) == 0
+    # Released blocks are not synchronized
+    eff = app.perform_block_release(EBlockRelease(block_ids[:1]))
+    perform_sequence([], eff)
+    eff = app.perform_synchronize(ESynchronize())
+    assert perform_sequence([], eff) is False
+    assert app.blocks == {}
+
+
 def test_perform_block_list(app):
     content = 'foo'
     eff = app.perform_block_create(EBlockCreate(content))
@@ -152,7 +309,7 @@ def test_perform_block_synchronize(app, app_no_cache):
     eff = app_no_cache.perform_block_create(EBlockCreate(content))
     block_2_id = perform_sequence([], eff)
     # With cache enabled
-    assert app.block_cache.currsize == 0
+    assert len(app.block_cache) == 0
     eff = app.perform_block_synchronize(EBlockSynchronize(block_id))
     sequence = [
         (EBackendBlockCreate(block_id, content),
@@ -161,9 +318,9 @@ def test_perform_block_synchronize(app, app_no_cache):
     synchronization = perform_sequence(sequence, eff)
     assert synchronization is True
     assert block_id not in app.blocks
-    assert app.block_cache.currsize == 1
+    assert len(app.block_cache) == 1
     # With cache disabled
-    assert app_no_cache.block_cache.currsize == 0
+    assert len(app_no_cache.block_cache) == 0
     eff = app_no_cache.perform_block_synchronize(EBlockSynchronize(block_2_id))
     sequence = [
         (EBackendBlockCreate(block_2_id, content),
@@ -172,11 +329,57 @@ def test_perform_block_synchronize(app, app_no_cache):
     synchronization = perform_sequence(sequence, eff)
     assert synchronization is True
     assert block_2_id not in app_no_cache.blocks
-    assert app_no_cache.block_cache.currsize == 0
+    assert len(app_no_cache.block_cache) == 0
     # Do nothing
     eff = app.perform_block_synchronize(EBlockSynchronize(block_2_id))
     synchronization = perform_sequence([], eff)
     assert synchronization is False
+    # Content-addressed block already in block store
+    eff = app.perform_block_create(EBlockCreate(content, 'abc'))
+    perform_sequence([], eff)
+    eff = app.perform_block_synchronize(EBlockSynchronize('abc'))
+    sequence = [
+        (EBackendBlockExists('abc'),
+            const(True))
+    ]
+    synchronization = perform_sequence(sequence, eff)
+    assert synchronization is True
+    assert 'abc' not in app.blocks
+    # Committed blocks are still reference counted, even once out of the cache
+    assert app.block_references == {'abc': 1}
+    del app.block_cache['abc']
+    eff = app.perform_block_create(EBlockCreate(content, 'abc'))
+    perform_sequence([], eff)
+    assert app.block_references == {'abc': 2}
+    # Releasing the committed reference keeps the new local copy
+    eff = app.perform_block_delete(EBlockDelete('abc'))
+    perform_sequence([], eff)
+    assert 'abc' in app.blocks
+    assert app.block_references == {'abc': 1}
+    del app.blocks['abc']
+    # Random id block must not collide
+    eff = app.perform_block_create(EBlockCreate(content))
+    block_id = perform_sequence([], eff)
+    eff = app.perform_block_synchronize(EBlockSynchronize(block_id))
+    sequence = [
+        (EBackendBlockCreate(block_id, content),
+            conste(BlockAlreadyExists('Block already exists.')))
+    ]
+    with pytest.raises(BlockAlreadyExists):
+        perform_sequence(sequence, eff)
+    # Content-addressed block uploaded by someone else after the check
+    eff = app.perform_block_create(EBlockCreate(content, 'def'))
+    perform_sequence([], eff)
+    eff = app.perform_block_synchronize(EBlockSynchronize('def'))
+    sequence = [
+        (EBackendBlockExists('def'),
+            const(False)),
+        (EBackendBlockCreate('def', content),
+            conste(BlockAlreadyExists('Block already exists.')))
+    ]
+    synchronization = perform_sequence(sequence, eff)
+    assert synchronization is True
+    assert 'def' not in app.blocks
 
 
 def test_perform_user_vlob_read(app, app_no_cache):
@@ -184,7 +387,7 @@ def test_perform_user_vlob_read(app, app_no_cache):
     eff = app.perform_user_vlob_update(EUserVlobUpdate(1, local_blob))
     perform_sequence([], eff)
     # Read remote user vlob
-    assert app.user_vlob_cache.currsize == 0
+    assert len(app.user_vlob_cache) == 0
     remote_blob = b'bar'
     eff = app.perform_user_vlob_read(EUserVlobRead(2))
     sequence = [
@@ -195,9 +398,9 @@ def test_perform_user_vlob_read(app, app_no_cache):
     assert sorted(list(user_vlob.keys())) == ['blob', 'version']
     assert user_vlob['blob'] == remote_blob.decode()  # TODO decode?
     assert user_vlob['version'] == 2
-    assert app.user_vlob_cache.currsize == 1
+    assert len(app.user_vlob_cache) == 1
     # Read remote user vlob with cache disabled
-    assert app_no_cache.user_vlob_cache.currsize == 0
+    assert len(app_no_cache.user_vlob_cache) == 0
     remote_blob = b'bar'
     eff = app_no_cache.perform_user_vlob_read(EUserVlobRead(2))
     sequence = [
@@ -208,7 +411,7 @@ def test_perform_user_vlob_read(app, app_no_cache):
     assert sorted(list(user_vlob.keys())) == ['blob', 'version']
     assert user_vlob['blob'] == remote_blob.decode()  # TODO decode?
     assert user_vlob['version'] == 2
-    assert app_no_cache.user_vlob_cache.currsize == 0
+    assert len(app_no_cache.user_vlob_cache) == 0
     # Read user vlob in cache
     remote_blob = b'bar'
     eff = app.perform_user_vlob_read(EUserVlobRead(2))
@@ -251,13 +454,13 @@ def test_perform_user_vlob_delete(app):
         perform_sequence([], eff)
         assert app.last_modified == Arrow.fromdatetime(frozen_datetime())
     # Delete in cache
-    app.user_vlob_cache[2] = {'foo': 'bar'}
-    assert app.user_vlob_cache.currsize == 1
+    app.user_vlob_cache[2] = {'blob': 'bar', 'version': 2}
+    assert len(app.user_vlob_cache) == 1
     with freeze_time('2012-01-01') as frozen_datetime:
         eff = app.perform_user_vlob_delete(EUserVlobDelete(2))
         perform_sequence([], eff)
         assert app.last_modified == Arrow.fromdatetime(frozen_datetime())
-    assert app.user_vlob_cache.currsize == 0
+    assert len(app.user_vlob_cache) == 0
     # Not found
     with pytest.raises(UserVlobNotFound):
         eff = app.perform_user_vlob_delete(EUserVlobDelete(2))
@@ -280,7 +483,7 @@ def test_perform_user_vlob_synchronize(app, app_no_cache):
     eff = app.perform_user_vlob_update(EUserVlobUpdate(1, blob))
     perform_sequence([], eff)
     # With cache enabled
-    assert app.user_vlob_cache.currsize == 0
+    assert len(app.user_vlob_cache) == 0
     eff = app.perform_user_vlob_synchronize(EUserVlobSynchronize())
     sequence = [
         (EBackendUserVlobUpdate(1, blob.encode()),  # TODO encode ok ?
@@ -289,11 +492,11 @@ def test_perform_user_vlob_synchronize(app, app_no_cache):
     synchronization = perform_sequence(sequence, eff)
     assert synchronization is True
     assert app.user_vlob is None
-    assert app.user_vlob_cache.currsize == 1
+    assert len(app.user_vlob_cache) == 1
     # With cache disabled
     eff = app_no_cache.perform_user_vlob_update(EUserVlobUpdate(1, blob))
     perform_sequence([], eff)
-    assert app_no_cache.user_vlob_cache.currsize == 0
+    assert len(app_no_cache.user_vlob_cache) == 0
     eff = app_no_cache.perform_user_vlob_synchronize(EUserVlobSynchronize())
     sequence = [
         (EBackendUserVlobUpdate(1, blob.encode()),  # TODO encode ok ?
@@ -302,7 +505,7 @@ def test_perform_user_vlob_synchronize(app, app_no_cache):
     synchronization = perform_sequence(sequence, eff)
     assert synchronization is True
     assert app_no_cache.user_vlob is None
-    assert app_no_cache.user_vlob_cache.currsize == 0
+    assert len(app_no_cache.user_vlob_cache) == 0
     # Do nothing
     eff = app.perform_user_vlob_synchronize(EUserVlobSynchronize())
     synchronization = perform_sequence([], eff)
@@ -328,7 +531,7 @@ def test_perform_vlob_read(app, app_no_cache):
     eff = app.perform_vlob_update(EVlobUpdate('123', '43', 1, local_blob))
     perform_sequence([], eff)
     # Read remote vlob
-    assert app.vlob_cache.currsize == 0
+    assert len(app.vlob_cache) == 0
     remote_blob = b'bar'
     eff = app.perform_vlob_read(EVlobRead('123', 'ABC', 2))
     sequence = [
@@ -340,9 +543,9 @@ def test_perform_vlob_read(app, app_no_cache):
     assert vlob['id'] == '123'
     assert vlob['blob'] == remote_blob.decode()  # TODO decode?
     assert vlob['version'] == 2
-    assert app.vlob_cache.currsize == 1
+    assert len(app.vlob_cache) == 1
     # Read remote vlob with cache disabled
-    assert app_no_cache.vlob_cache.currsize == 0
+    assert len(app_no_cache.vlob_cache) == 0
     remote_blob = b'bar'
     eff = app_no_cache.perform_vlob_read(EVlobRead('123', 'ABC', 2))
     sequence = [
@@ -354,7 +557,7 @@ def test_perform_vlob_read(app, app_no_cache):
     assert vlob['id'] == '123'
     assert vlob['blob'] == remote_blob.decode()  # TODO decode?
     assert vlob['version'] == 2
-    assert app_no_cache.vlob_cache.currsize == 0
+    assert len(app_no_cache.vlob_cache) == 0
     # Read vlob in cache
     remote_blob = b'bar'
     eff = app.perform_vlob_read(EVlobRead('123', 'ABC', 2))
@@ -401,6 +604,20 @@ def test_perform_vlob_delete(app):
         perform_sequence([], eff)
 
 
+def test_perform_vlob_head(app):
+    vlob = perform_sequence([], app.perform_vlob_create(EVlobCreate('foo')))
+    # Local vlobs are answered without the backend, missing vlobs are left out
+    eff = app.perform_vlob_head(EVlobHead({vlob['id']: '42', '123': 'rts', '456': 'rts'}))
+    sequence = [
+        (EBackendVlobHead({'123': 'rts', '456': 'rts'}),
+            const({'123': VlobHead('123', 3, 10)})),
+    ]
+    versions = perform_sequence(sequence, eff)
+    assert versions == {vlob['id']: 1, '123': 3}
+    eff = app.perform_vlob_head(EVlobHead({vlob['id']: '42'}))
+    assert perform_sequence([], eff) == {vlob['id']: 1}
+
+
 def test_perform_vlob_list(app):
     blob = 'foo'
     eff = app.perform_vlob_create(EVlobCreate(blob))
@@ -432,7 +649,7 @@ def test_perform_vlob_synchronize(app, app_no_cache):
     eff = app.perform_vlob_update(EVlobUpdate('123', 'ABC', 1, blob))
     perform_sequence([], eff)
     # With cache enabled
-    assert app.vlob_cache.currsize == 0
+    assert len(app.vlob_cache) == 0
     eff = app.perform_vlob_synchronize(EVlobSynchronize('123'))
     sequence = [
         (EBackendVlobCreate(blob.encode()),  # TODO encode ok ?
@@ -443,11 +660,11 @@ def test_perform_vlob_synchronize(app, app_no_cache):
     eff = app.perform_vlob_list(EVlobList())
     vlob_list = perform_sequence([], eff)
     assert vlob_list == []
-    assert app.vlob_cache.currsize == 1
+    assert len(app.vlob_cache) == 1
     # With cache disabled
     eff = app_no_cache.perform_vlob_update(EVlobUpdate('123', 'ABC', 1, blob))
     perform_sequence([], eff)
-    assert app_no_cache.vlob_cache.currsize == 0
+    assert len(app_no_cache.vlob_cache) == 0
     eff = app_no_cache.perform_vlob_synchronize(EVlobSynchronize('123'))
     sequence = [
         (EBackendVlobCreate(blob.encode()),  # TODO encode ok ?
@@ -458,14 +675,14 @@ def test_perform_vlob_synchronize(app, app_no_cache):
     eff = app_no_cache.perform_vlob_list(EVlobList())
     vlob_list = perform_sequence([], eff)
     assert vlob_list == []
-    assert app_no_cache.vlob_cache.currsize == 0
+    assert len(app_no_cache.vlob_cache) == 0
     # Update vlob
     blob = 'bar'
     eff = app.perform_vlob_update(EVlobUpdate('123', 'ABC', 2, blob))
     perform_sequence([], eff)
     vlob = app.vlobs['123']
     # With cache enabled
-    assert app.vlob_cache.currsize == 1
+    assert len(app.vlob_cache) == 1
     eff = app.perform_vlob_synchronize(EVlobSynchronize('123'))
     sequence = [
         (EBackendVlobUpdate('123', 'ABC', 2, blob.encode()),  # TODO encode ok ?
@@ -476,10 +693,10 @@ def test_perform_vlob_synchronize(app, app_no_cache):
     eff = app.perform_vlob_list(EVlobList())
     vlob_list = perform_sequence([], eff)
     assert vlob_list == []
-    assert app.vlob_cache.currsize == 2
+    assert len(app.vlob_cache) == 2
     # With cache disabled
     app_no_cache.vlobs['123'] = vlob
-    assert app_no_cache.vlob_cache.currsize == 0
+    assert len(app_no_cache.vlob_cache) == 0
     eff = app_no_cache.perform_vlob_synchronize(EVlobSynchronize('123'))
     sequence = [
         (EBackendVlobUpdate('123', 'ABC', 2, blob.encode()),  # TODO encode ok ?
@@ -490,7 +707,7 @@ def test_perform_vlob_synchronize(app, app_no_cache):
     eff = app_no_cache.perform_vlob_list(EVlobList())
     vlob_list = perform_sequence([], eff)
     assert vlob_list == []
-    assert app_no_cache.vlob_cache.currsize == 0
+    assert len(app_no_cache.vlob_cache) == 0
     # Vlob synchronized
     eff = app.perform_vlob_synchronize(EVlobSynchronize('123'))
     synchronization = perform_sequence([], eff)
@@ -546,18 +763,38 @@ def test_perform_synchronize(app):
 
 
 def test_perform_cache_clean(app):
-    app.block_cache['123'] = {'foo': 'bar'}
-    app.vlob_cache[('123', 1)] = {'foo': 'bar'}
-    app.user_vlob_cache[2] = {'foo': 'bar'}
-    assert app.block_cache.currsize == 1
-    assert app.vlob_cache.currsize == 1
-    assert app.user_vlob_cache.currsize == 1
+    app.block_cache['123'] = {'id': '123', 'content': 'bar'}
+    app.vlob_cache[('123', 1)] = {'id': '123', 'blob': 'bar', 'version': 1}
+    app.user_vlob_cache[2] = {'blob': 'bar', 'version': 2}
+    assert len(app.block_cache) == 1
+    assert len(app.vlob_cache) == 1
+    assert len(app.user_vlob_cache) == 1
     eff = app.perform_cache_clean(ECacheClean())
     ret = perform_sequence([], eff)
     assert ret is None
-    assert app.block_cache.currsize == 0
-    assert app.vlob_cache.currsize == 0
-    assert app.user_vlob_cache.currsize == 0
+    assert len(app.block_cache) == 0
+    assert len(app.vlob_cache) == 0
+    assert len(app.user_vlob_cache) == 0
+
+
+def test_perform_cache_stats(app):
+    app.block_cache['123'] = {'id': '123', 'content': 'foo'}
+    app.block_cache['456'] = {'id': '456', 'content': 'x' * 1022}
+    assert '123' not in app.block_cache  # Evicted to keep the cache under 1024 bytes
+    with pytest.raises(KeyError):
+        app.block_cache['123']
+    assert app.block_cache['456']
+    app.vlob_cache[('123', 1)] = {'id': '123', 'blob': 'bar', 'version': 1}
+    eff = app.perform_cache_stats(ECacheStats())
+    stats = perform_sequence([], eff)
+    assert stats == {
+        'blocks': {'size': 1022, 'max_size': 1024, 'entries': 1,
+                   'hits': 1, 'misses': 1, 'evictions': 1},
+        'vlobs': {'size': 3, 'max_size': 1024, 'entries': 1,
+                  'hits': 0, 'misses': 0, 'evictions': 0},
+        'user_vlob': {'size': 0, 'max_size': 1024, 'entries': 0,
+                      'hits': 0, 'misses': 0, 'evictions': 0},
+    }
 
 
 def test_perform_periodic_synchronization(app):
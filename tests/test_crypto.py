@@ -2,7 +2,7 @@ import pytest
 from unittest.mock import patch
 
 from parsec.crypto import (
-    load_private_key, load_public_key, load_sym_key, generate_sym_key,
+    load_private_key, load_public_key, load_sym_key, generate_sym_key, derive_sym_key,
     BasePrivateAsymKey, BasePublicAsymKey, InvalidSignature,
     RSAPublicKey, RSAPrivateKey, AESKey, InvalidTag,
     encrypt_with_password, decrypt_with_password
@@ -253,6 +253,13 @@ class TestAESSymCrypto:
         with pytest.raises(InvalidTag):
             badsymkey.decrypt(crypted)
 
+    def test_derive_key(self):
+        key = derive_sym_key(b'secret', b'foo')
+        assert key.key == derive_sym_key(b'secret', b'foo').key
+        assert key.key != derive_sym_key(b'secret', b'bar').key
+        assert key.key != derive_sym_key(b'other secret', b'foo').key
+        assert key.decrypt(key.encrypt(b'foo')) == b'foo'
+
 
 def test_encrypt_with_password():
     password = b'foo'